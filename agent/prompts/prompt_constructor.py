@@ -1,10 +1,11 @@
 import json
 import re
 from pathlib import Path
-from typing import Any, TypedDict
+from typing import Any, TypedDict, cast
 
 from browser_env import Action, ActionParsingError, Trajectory
 from browser_env.env_config import URL_MAPPINGS
+from browser_env.token_budget import OBS_ESTIMATE_MARGIN, estimate_tokens
 from browser_env.utils import StateInfo
 from llms import lm_config
 from llms.tokenizers import Tokenizer
@@ -35,6 +36,15 @@ class PromptConstructor(object):
         self.instruction: Instruction = instruction
         self.tokenizer = tokenizer
 
+    def truncate_obs(self, obs: str, max_obs_length: int) -> str:
+        """Truncate the observation to max_obs_length tokens, an observation
+        the env already fitted into the budget is not tokenized"""
+        if estimate_tokens(obs) <= max_obs_length * OBS_ESTIMATE_MARGIN:
+            return obs
+        return self.tokenizer.decode(
+            self.tokenizer.encode(obs)[:max_obs_length]
+        )
+
     def get_lm_api_input(
         self, intro: str, examples: list[tuple[str, str]], current: str
     ) -> APIInput:
@@ -191,7 +201,7 @@ class DirectPromptConstructor(PromptConstructor):
         obs = state_info["observation"][self.obs_modality]
         max_obs_length = self.lm_config.gen_config["max_obs_length"]
         if max_obs_length:
-            obs = self.tokenizer.decode(self.tokenizer.encode(obs)[:max_obs_length])  # type: ignore[arg-type]
+            obs = self.truncate_obs(cast(str, obs), max_obs_length)
 
         page = state_info["info"]["page"]
         url = page.url
@@ -247,7 +257,7 @@ class CoTPromptConstructor(PromptConstructor):
         obs = state_info["observation"][self.obs_modality]
         max_obs_length = self.lm_config.gen_config["max_obs_length"]
         if max_obs_length:
-            obs = self.tokenizer.decode(self.tokenizer.encode(obs)[:max_obs_length])  # type: ignore[arg-type]
+            obs = self.truncate_obs(cast(str, obs), max_obs_length)
 
         page = state_info["info"]["page"]
         url = page.url
@@ -306,7 +316,7 @@ class IntentionPromptConstructor(PromptConstructor):
         obs = state_info["observation"][self.obs_modality]
         max_obs_length = self.lm_config.gen_config["max_obs_length"]
         if max_obs_length:
-            obs = self.tokenizer.decode(self.tokenizer.encode(obs)[:max_obs_length])  # type: ignore[arg-type]
+            obs = self.truncate_obs(cast(str, obs), max_obs_length)
 
         page = state_info["info"]["page"]
         url = page.url
@@ -375,8 +385,10 @@ class InsightPromptConstructor(PromptConstructor):
         previous_obs = previous_state_info["observation"][self.obs_modality]
         max_obs_length = self.lm_config.gen_config["max_obs_length"]
         if max_obs_length:
-            obs = self.tokenizer.decode(self.tokenizer.encode(obs)[:max_obs_length])  # type: ignore[arg-type]
-            previous_obs = self.tokenizer.decode(self.tokenizer.encode(previous_obs)[:max_obs_length])  # type: ignore[arg-type]
+            obs = self.truncate_obs(cast(str, obs), max_obs_length)
+            previous_obs = self.truncate_obs(
+                cast(str, previous_obs), max_obs_length
+            )
 
         page = state_info["info"]["page"]
         url = page.url
@@ -31,18 +31,35 @@ from .actions import (
     create_type_action,
     is_equivalent,
 )
+from .asset_cache import AssetCache
 from .async_envs import AsyncScriptBrowserEnv
+from .batch_envs import BatchScriptBrowserEnv
+from .checkpoint import EnvCheckpoint
 from .envs import ScriptBrowserEnv
-from .processors import ObservationMetadata
+from .processors import (
+    ObservationMetadata,
+    ReductionRule,
+    default_reduction_rules,
+)
+from .routing import RoutingProfile, RoutingRule, default_routing_rules
 from .trajectory import Trajectory
-from .utils import DetachedPage, StateInfo
+from .utils import DetachedPage, Screenshot, StateInfo
 
 __all__ = [
     "ScriptBrowserEnv",
     "AsyncScriptBrowserEnv",
+    "BatchScriptBrowserEnv",
+    "AssetCache",
+    "EnvCheckpoint",
     "DetachedPage",
+    "Screenshot",
     "StateInfo",
     "ObservationMetadata",
+    "ReductionRule",
+    "default_reduction_rules",
+    "RoutingProfile",
+    "RoutingRule",
+    "default_routing_rules",
     "Action",
     "ActionTypes",
     "action2str",
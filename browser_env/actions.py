@@ -9,7 +9,7 @@ import re
 import string
 from enum import IntEnum
 from itertools import chain
-from typing import Any, TypedDict, Union, cast
+from typing import Any, Mapping, TypedDict, Union, cast
 
 import numpy as np
 import numpy.typing as npt
@@ -132,6 +132,18 @@ def action2str(action: Action, action_set_tag: str, semantic_element: str = "")
                 action_str = (
                     f"hover [{element_id}] where [{element_id}] is {semantic_element}"
                 )
+            case ActionTypes.MOUSE_CLICK | ActionTypes.MOUSE_HOVER:
+                # as the id action on the element at the coordinates, if any
+                verb = (
+                    "click"
+                    if action["action_type"] == ActionTypes.MOUSE_CLICK
+                    else "hover"
+                )
+                if element_id:
+                    action_str = f"{verb} [{element_id}] where [{element_id}] is {semantic_element}"
+                else:
+                    x, y = action["coords"]
+                    action_str = f"mouse_{verb} [{x:.3f}] [{y:.3f}]"
             case ActionTypes.SCROLL:
                 action_str = f"scroll [{action['direction']}]"
             case ActionTypes.KEY_PRESS:
@@ -160,6 +172,23 @@ def action2str(action: Action, action_set_tag: str, semantic_element: str = "")
     return action_str
 
 
+def get_action_query(action: Action, obs_nodes_info: Mapping[str, Any]) -> str:
+    """Return the words of an action to retrieve the relevant elements of the
+    next observation with: the element it acted on and the text it typed
+
+    obs_nodes_info: the nodes of the observation the action was taken on
+    """
+    words = [action["element_name"]]
+    if action["element_id"] in obs_nodes_info:
+        node_content = obs_nodes_info[action["element_id"]]["text"]
+        # without the [id] and the role, which would match every node of
+        # the same role
+        words.append(" ".join(node_content.split()[2:]))
+    if action["text"]:
+        words.append("".join(_id2key[i] for i in action["text"]))
+    return " ".join(word for word in words if word)
+
+
 @beartype
 def action2create_function(action: Action) -> str:
     match (action["action_type"]):
@@ -268,6 +297,21 @@ class ActionTypes(IntEnum):
         return f"ACTION_TYPES.{self.name}"
 
 
+# the actions that move the mouse, CSS :hover rules may then change the page
+# without any DOM mutation
+POINTER_ACTION_TYPES = frozenset(
+    [
+        ActionTypes.MOUSE_CLICK,
+        ActionTypes.MOUSE_HOVER,
+        ActionTypes.CLICK,
+        ActionTypes.TYPE,
+        ActionTypes.HOVER,
+        ActionTypes.CHECK,
+        ActionTypes.SELECT_OPTION,
+    ]
+)
+
+
 @beartype
 def is_equivalent(a: Action, b: Action) -> bool:
     """Return True if two actions are equal."""
@@ -1191,8 +1235,20 @@ def execute_action(
     return page
 
 
+def aget_element_center(
+    action: Action, obseration_processor: ObservationProcessor | None
+) -> tuple[float, float]:
+    """Locate the element of an id-based action in the last observation"""
+    if obseration_processor is None:
+        raise ValueError("Id-based actions need the observation processor")
+    return obseration_processor.get_element_center(action["element_id"])  # type: ignore[attr-defined, no-any-return]
+
+
 async def aexecute_action(
-    action: Action, page: APage, browser_ctx: ABrowserContext
+    action: Action,
+    page: APage,
+    browser_ctx: ABrowserContext,
+    obseration_processor: ObservationProcessor | None = None,
 ) -> APage:
     """Execute the async action on the ChromeDriver."""
     action_type = action["action_type"]
@@ -1217,7 +1273,12 @@ async def aexecute_action(
             # check each kind of locator in order
             # TODO[shuyanzh]: order is temp now
             if action["element_id"]:
-                raise NotImplementedError
+                element_center = aget_element_center(
+                    action, obseration_processor
+                )
+                await aexecute_mouse_click(
+                    element_center[0], element_center[1], page
+                )
             elif action["element_role"] and action["element_name"]:
                 element_role = int(action["element_role"])
                 element_name = action["element_name"]
@@ -1233,7 +1294,12 @@ async def aexecute_action(
                 raise ValueError("No proper locator found for click action")
         case ActionTypes.HOVER:
             if action["element_id"]:
-                raise NotImplementedError
+                element_center = aget_element_center(
+                    action, obseration_processor
+                )
+                await aexecute_mouse_hover(
+                    element_center[0], element_center[1], page
+                )
             elif action["element_role"] and action["element_name"]:
                 element_role = int(action["element_role"])
                 element_name = action["element_name"]
@@ -1248,7 +1314,13 @@ async def aexecute_action(
                 raise NotImplementedError("No proper locator found for hover action")
         case ActionTypes.TYPE:
             if action["element_id"]:
-                raise NotImplementedError
+                element_center = aget_element_center(
+                    action, obseration_processor
+                )
+                await aexecute_mouse_click(
+                    element_center[0], element_center[1], page
+                )
+                await aexecute_type(action["text"], page)
             elif action["element_role"] and action["element_name"]:
                 element_role = int(action["element_role"])
                 element_name = action["element_name"]
@@ -1271,6 +1343,7 @@ async def aexecute_action(
             await page.bring_to_front()
         case ActionTypes.NEW_TAB:
             page = await browser_ctx.new_page()
+            page.client = await page.context.new_cdp_session(page)  # type: ignore[attr-defined]
         case ActionTypes.GO_BACK:
             await page.go_back()
         case ActionTypes.GO_FORWARD:
@@ -0,0 +1,225 @@
+"""A content-addressed on-disk cache of the static assets of the sites
+
+The cache directory can be shared by the envs of several worker
+processes, the files are written atomically and evicted least recently
+used first once the cache grows over its size limit.
+
+    cache_dir/
+        index/<sha256 of the url>.json   status, headers and body hash
+        blobs/<sha256 of the body>       the response body
+"""
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+from urllib.parse import urlparse
+
+from playwright.sync_api import BrowserContext, Route
+
+# the bundles, styles, fonts and images that rarely change between tasks
+CACHEABLE_RESOURCE_TYPES = frozenset(["script", "stylesheet", "font", "image"])
+
+# recomputed when serving from the cache, or specific to one response
+DROPPED_HEADERS = frozenset(
+    [
+        "content-encoding",
+        "content-length",
+        "transfer-encoding",
+        "connection",
+        "set-cookie",
+        "date",
+    ]
+)
+
+
+@dataclass
+class AssetCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stored: int = 0
+    evicted: int = 0
+    bytes_served: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"hit rate {self.hit_rate:.1%} ({self.hits}/"
+            f"{self.hits + self.misses}), {self.bytes_served / 1024:.0f}KiB "
+            f"served from the cache, {self.stored} stored, "
+            f"{self.evicted} evicted"
+        )
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    """Write through a temporary file, other processes either see the whole
+    file or no file"""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AssetCache:
+    """Serve the GET requests for static assets of the given site urls from
+    cache_dir, the requests that miss are fetched and stored
+
+    Only the 200 responses without `Cache-Control: no-store` are stored.
+    A cached asset is served as is until it is evicted, so clear the cache
+    when the sites are redeployed.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | Path,
+        site_urls: Sequence[str],
+        max_bytes: int = 1 << 30,
+        resource_types: frozenset[str] = CACHEABLE_RESOURCE_TYPES,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.index_dir = self.cache_dir / "index"
+        self.blob_dir = self.cache_dir / "blobs"
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.hosts = frozenset(urlparse(url).netloc for url in site_urls)
+        self.max_bytes = max_bytes
+        self.resource_types = resource_types
+        self.stats = AssetCacheStats()
+        self.size = sum(size for _, size, _ in self.list_blobs())
+
+    def attach(self, context: BrowserContext) -> None:
+        context.route("**/*", self.handle)
+
+    def is_cacheable(self, method: str, resource_type: str, url: str) -> bool:
+        return (
+            method == "GET"
+            and resource_type in self.resource_types
+            and urlparse(url).netloc in self.hosts
+        )
+
+    def index_path(self, url: str) -> Path:
+        return (
+            self.index_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+        )
+
+    def load(self, url: str) -> tuple[dict[str, Any], bytes] | None:
+        """The cached response of the url, or None on a miss"""
+        try:
+            entry = json.loads(self.index_path(url).read_text())
+            blob_path = self.blob_dir / entry["body"]
+            body = blob_path.read_bytes()
+        except (OSError, ValueError, KeyError):
+            # not cached, evicted, or being written by another process
+            return None
+        # the modification time orders the eviction
+        try:
+            os.utime(blob_path)
+        except OSError:
+            pass
+        return entry, body
+
+    def get_size(self, url: str) -> int | None:
+        """The size of the cached body of the url, without reading it"""
+        try:
+            entry = json.loads(self.index_path(url).read_text())
+            body_hash: str = entry["body"]
+            return (self.blob_dir / body_hash).stat().st_size
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(
+        self, url: str, status: int, headers: dict[str, str], body: bytes
+    ) -> None:
+        body_hash = hashlib.sha256(body).hexdigest()
+        blob_path = self.blob_dir / body_hash
+        if not blob_path.exists():
+            write_atomic(blob_path, body)
+            self.size += len(body)
+        entry = {
+            "url": url,
+            "status": status,
+            "headers": {
+                name: value
+                for name, value in headers.items()
+                if name.lower() not in DROPPED_HEADERS
+            },
+            "body": body_hash,
+        }
+        write_atomic(self.index_path(url), json.dumps(entry).encode())
+        self.stats.stored += 1
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def list_blobs(self) -> list[tuple[float, int, Path]]:
+        """The modification time, size and path of the stored blobs"""
+        blobs = []
+        for blob_path in self.blob_dir.iterdir():
+            if blob_path.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = blob_path.stat()
+            except OSError:
+                # evicted by another process
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, blob_path))
+        return blobs
+
+    def evict(self) -> None:
+        """Delete the least recently used blobs until the cache is below
+        90% of its size limit, the index entries of the deleted blobs then
+        miss"""
+        blobs = self.list_blobs()
+        # other processes share the directory
+        self.size = sum(size for _, size, _ in blobs)
+        for _, size, blob_path in sorted(blobs):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                blob_path.unlink()
+            except OSError:
+                continue
+            self.size -= size
+            self.stats.evicted += 1
+
+    def handle(self, route: Route) -> None:
+        request = route.request
+        if not self.is_cacheable(
+            request.method, request.resource_type, request.url
+        ):
+            route.fallback()
+            return
+
+        cached = self.load(request.url)
+        if cached is not None:
+            entry, body = cached
+            self.stats.hits += 1
+            self.stats.bytes_served += len(body)
+            route.fulfill(
+                status=entry["status"], headers=entry["headers"], body=body
+            )
+            return
+
+        self.stats.misses += 1
+        response = route.fetch()
+        body = response.body()
+        cache_control = response.headers.get("cache-control", "")
+        if response.status == 200 and "no-store" not in cache_control:
+            try:
+                self.store(
+                    request.url, response.status, response.headers, body
+                )
+            except OSError:
+                # e.g. the disk is full, serve the asset without caching it
+                pass
+        route.fulfill(response=response, body=body)
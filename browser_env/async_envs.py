@@ -1,25 +1,50 @@
 import asyncio
 import json
-from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Sequence
 
-import numpy as np
-import numpy.typing as npt
 from gymnasium import Env
-from gymnasium.spaces import Box, Text
-from playwright.async_api import Page, ViewportSize, async_playwright
+from playwright.async_api import (
+    Browser,
+    BrowserContext,
+    CDPSession,
+    FloatRect,
+    Page,
+    Playwright,
+    ViewportSize,
+    async_playwright,
+)
 
-from .actions import Action, aexecute_action, get_action_space
-from .utils import DetachedPage, png_bytes_to_numpy
+from .actions import (
+    POINTER_ACTION_TYPES,
+    Action,
+    aexecute_action,
+    get_action_query,
+    get_action_space,
+)
+from .async_processors import AsyncObservationHandler
+from .context_pool import START_URL_SEPARATOR
+from .processors import (
+    DEFAULT_REDUCTION_RULES,
+    ObservationMetadata,
+    ReductionRule,
+)
+from .settle import AsyncPageSettleDetector
+from .utils import DetachedPage, Observation
 
 
-class AsyncScriptBrowserEnv(Env[npt.NDArray[np.uint8], Action]):
+class AsyncScriptBrowserEnv(Env[dict[str, Observation], Action]):
     """
     The goal of this environment is to produce a prototype of a browser environment.
     In the end, we want to support a fully configurable browser environment with wide
     range of action spaces and observation spaces, both structured and unstructured.
     But in this prototype, we just support action space specified by Playwright script,
     and observation space is the html content of the page.
+
+    The async methods can be awaited from any event loop, e.g. to multiplex
+    many episodes in one process with `asyncio.gather`. The sync methods run
+    them on a long-lived event loop of the env, which several envs can share
+    through `loop`. An env should be used from a single event loop.
     """
 
     def __init__(
@@ -28,14 +53,23 @@ class AsyncScriptBrowserEnv(Env[npt.NDArray[np.uint8], Action]):
         headless: bool = True,
         slow_mo: int = 0,
         timeout: int = 30000,
+        observation_type: str = "html",
+        current_viewport_only: bool = False,
         viewport_size: ViewportSize = {"width": 1280, "height": 720},
+        incremental_observation: bool = False,
+        max_obs_tokens: int | None = None,
+        reduction_rules: Sequence[ReductionRule] = DEFAULT_REDUCTION_RULES,
+        retrieval_top_k: int | None = None,
+        capture_screenshot: bool = True,
+        screenshot_format: str = "png",
+        screenshot_quality: int | None = None,
+        screenshot_scale: float = 1.0,
+        screenshot_clip: FloatRect | None = None,
+        sleep_after_execution: float = 0.0,
+        settle_timeout: float = 0.0,
+        settle_quiet_window: float = 0.5,
+        loop: asyncio.AbstractEventLoop | None = None,
     ):
-        self.observation_space = Box(
-            0,
-            255,
-            (viewport_size["height"], viewport_size["width"], 4),
-            np.uint8,
-        )
         # TODO: make Space[Action] = ActionSpace
         self.action_space = get_action_space()  # type: ignore[assignment]
         self.headless = headless
@@ -43,47 +77,184 @@ class AsyncScriptBrowserEnv(Env[npt.NDArray[np.uint8], Action]):
         self.reset_finished = False
         self.timeout = timeout
         self.viewport_size = viewport_size
+        self.current_viewport_only = current_viewport_only
+        self.capture_screenshot = capture_screenshot
+        self.sleep_after_execution = sleep_after_execution
+        # wait for the page to settle instead of sleeping when enabled, as
+        # in ScriptBrowserEnv
+        self.settle_detector = (
+            AsyncPageSettleDetector(
+                timeout=settle_timeout, quiet_window=settle_quiet_window
+            )
+            if settle_timeout > 0
+            else None
+        )
 
-    async def setup(self, config_file: Path | None = None) -> None:
-        self.context_manager = async_playwright()
-        self.playwright = await self.context_manager.__aenter__()
-        self.browser = await self.playwright.chromium.launch(
-            headless=self.headless, slow_mo=self.slow_mo
+        match observation_type:
+            case "html" | "accessibility_tree":
+                self.text_observation_type = observation_type
+                self.image_observation_type = ""
+                self.main_observation_type = "text"
+            case "image":
+                self.image_observation_type = observation_type
+                self.text_observation_type = ""  # type: ignore[assignment]
+                self.main_observation_type = "image"
+                self.capture_screenshot = True
+            case _:
+                raise ValueError(
+                    f"Unsupported observation type: {observation_type}"
+                )
+
+        self.observation_handler = AsyncObservationHandler(
+            self.main_observation_type,
+            self.text_observation_type,
+            self.image_observation_type,
+            self.current_viewport_only,
+            self.viewport_size,
+            incremental_observation=incremental_observation,
+            max_obs_tokens=max_obs_tokens,
+            reduction_rules=reduction_rules,
+            retrieval_top_k=retrieval_top_k,
+            screenshot_format=screenshot_format,
+            screenshot_quality=screenshot_quality,
+            screenshot_scale=screenshot_scale,
+            screenshot_clip=screenshot_clip,
         )
+        self.observation_space = (
+            self.observation_handler.get_observation_space()  # type: ignore[assignment]
+        )
+
+        # the driver and browser live across resets, only the context is new
+        self.context_manager: Any = None
+        self.playwright: Playwright | None = None
+        self.browser: Browser | None = None
+        self.context: BrowserContext | None = None
+        self.loop = loop
+        self.owns_loop = loop is None
+        # the intent of the task, to retrieve the relevant elements with
+        self.intent = ""
+
+    def run(self, coroutine: Any) -> Any:
+        """Run a coroutine of the env on its long-lived event loop"""
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
+
+    async def alaunch_browser(self) -> Browser:
+        if self.browser is not None and not self.browser.is_connected():
+            # crashed
+            self.browser = None
+        if self.playwright is None:
+            self.context_manager = async_playwright()
+            self.playwright = await self.context_manager.__aenter__()
+        if self.browser is None:
+            self.browser = await self.playwright.chromium.launch(
+                headless=self.headless, slow_mo=self.slow_mo
+            )
+        return self.browser
+
+    async def aclose_context(self) -> None:
+        if self.context is not None:
+            try:
+                await self.context.close()
+            except Exception:
+                # the browser is gone together with its contexts
+                pass
+            self.context = None
+
+    async def aattach_client(self, page: Page) -> None:
+        # talk to chrome devtools
+        client = await page.context.new_cdp_session(page)
+        if self.text_observation_type == "accessibility_tree":
+            await client.send("Accessibility.enable")
+        page.client = client  # type: ignore
+
+    def get_page_client(self, page: Page) -> CDPSession:
+        return page.client  # type: ignore
+
+    async def setup(self, config_file: Path | None = None) -> None:
+        browser = await self.alaunch_browser()
         if config_file:
             with open(config_file, "r") as f:
                 instance_config = json.load(f)
         else:
             instance_config = {}
 
+        self.intent = instance_config.get("intent", "")
+        self.observation_handler.text_processor.set_retrieval_query(
+            self.intent
+        )
         storage_state = instance_config.get("storage_state", None)
         start_url = instance_config.get("start_url", None)
         geolocation = instance_config.get("geolocation", None)
 
-        self.context = await self.browser.new_context(
+        self.context = await browser.new_context(
             viewport=self.viewport_size,
             storage_state=storage_state,
             geolocation=geolocation,
             device_scale_factor=1,
         )
-        self.page = await self.context.new_page()
-        if start_url:
-            await self.page.goto(start_url)
+        self.context.set_default_timeout(self.timeout)
+        if self.settle_detector is not None:
+            self.settle_detector.attach(self.context)
+        start_urls = start_url.split(START_URL_SEPARATOR) if start_url else []
+        await asyncio.gather(
+            *(self.context.new_page() for _ in range(max(len(start_urls), 1)))
+        )
+        # in creation order, the tabs are listed in this order
+        pages = self.context.pages
+        # the start pages load concurrently, while their CDP sessions are
+        # established
+        await asyncio.gather(
+            *(page.goto(url) for page, url in zip(pages, start_urls)),
+            *(self.aattach_client(page) for page in pages),
+        )
+        # set the first page as the current page
+        self.page = pages[0]
+        if start_urls:
+            await self.page.bring_to_front()
+
+    async def await_for_page(self) -> float:
+        """Wait for the current page after a reset or an action, returns the
+        seconds waited"""
+        if self.settle_detector is not None:
+            return await self.settle_detector.await_settle(self.page)
+        if self.sleep_after_execution > 0:
+            await asyncio.sleep(self.sleep_after_execution)
+        return self.sleep_after_execution
+
+    async def aget_obs_and_content(
+        self,
+    ) -> tuple[dict[str, Observation], str]:
+        try:
+            return await asyncio.gather(self._aget_obs(), self.page.content())
+        except Exception:
+            await self.page.wait_for_load_state("load")
+            return await asyncio.gather(self._aget_obs(), self.page.content())
+
+    async def _aget_obs(self) -> dict[str, Observation]:
+        return await self.observation_handler.aget_observation(
+            self.page,
+            self.get_page_client(self.page),
+            capture_screenshot=self.capture_screenshot,
+        )
+
+    def _get_obs_metadata(self) -> dict[str, ObservationMetadata]:
+        return self.observation_handler.get_observation_metadata()
 
     async def areset(
         self,
         *,
         seed: int | None = None,
         options: dict[str, str] | None = None,
-    ) -> tuple[npt.NDArray[np.uint8], dict[str, object]]:
+    ) -> tuple[dict[str, Observation], dict[str, Any]]:
         """
         Reset the environment.
         :param options: options for the environment. The options are:
             - storage_state: the path to the storage state file
         """
         super().reset(seed=seed, options=options)
-        if self.reset_finished:
-            await self.context_manager.__aexit__()
+        await self.aclose_context()
         if options is not None and "config_file" in options:
             config_file = Path(options["config_file"])
             if config_file.exists():
@@ -93,61 +264,92 @@ class AsyncScriptBrowserEnv(Env[npt.NDArray[np.uint8], Action]):
         else:
             await self.setup()
         self.reset_finished = True
-        content = await self.page.content()
-        screenshot = png_bytes_to_numpy(await self.page.screenshot())
-        return (
-            screenshot,
-            {"page": DetachedPage(self.page.url, content)},
-        )
+
+        settle_time = await self.await_for_page()
+        observation, content = await self.aget_obs_and_content()
+        info = {
+            "page": DetachedPage(self.page.url, content),
+            "settle_time": settle_time,
+            "fail_error": "",
+            "observation_metadata": self._get_obs_metadata(),
+        }
+        return (observation, info)
 
     def reset(
         self,
         *,
         seed: int | None = None,
         options: dict[str, str] | None = None,
-    ) -> tuple[npt.NDArray[np.uint8], dict[str, object]]:
-        return asyncio.run(self.areset(seed=seed, options=options))
+    ) -> tuple[dict[str, Observation], dict[str, Any]]:
+        return self.run(  # type: ignore[no-any-return]
+            self.areset(seed=seed, options=options)
+        )
 
     async def aclose(self) -> None:
-        if self.reset_finished:
+        await self.aclose_context()
+        if self.browser is not None:
+            try:
+                await self.browser.close()
+            except Exception:
+                pass
+            self.browser = None
+        if self.context_manager is not None:
             await self.context_manager.__aexit__()
+            self.context_manager = None
+            self.playwright = None
 
     def close(self) -> None:
-        asyncio.run(self.aclose())
+        self.run(self.aclose())
+        if self.owns_loop and self.loop is not None:
+            self.loop.close()
+            self.loop = None
 
     async def astep(
         self, action: Action
-    ) -> tuple[npt.NDArray[np.uint8], float, bool, bool, dict[str, object]]:
+    ) -> tuple[dict[str, Observation], float, bool, bool, dict[str, Any]]:
         if not self.reset_finished:
             raise RuntimeError("Call reset first before calling step.")
+        assert self.context is not None
+        text_processor = self.observation_handler.text_processor
+        text_processor.set_retrieval_query(
+            self.intent,
+            get_action_query(
+                action, text_processor.meta_data["obs_nodes_info"]
+            ),
+        )
         success = False
         fail_error = ""
         try:
-            self.page = await aexecute_action(action, self.page, self.context)
+            self.page = await aexecute_action(
+                action,
+                self.page,
+                self.context,
+                self.observation_handler.action_processor,
+            )
             success = True
+            if action["action_type"] in POINTER_ACTION_TYPES:
+                # a :hover style may have changed the page
+                text_processor.invalidate_cache()
         except Exception as e:
             fail_error = str(e)
 
-        try:
-            content = await self.page.content()
-            screenshot = png_bytes_to_numpy(await self.page.screenshot())
-        except:
-            await self.page.wait_for_load_state("load")
-            content = await self.page.content()
-            screenshot = png_bytes_to_numpy(await self.page.screenshot())
+        settle_time = await self.await_for_page()
+        observation, content = await self.aget_obs_and_content()
 
         return (
-            screenshot,
+            observation,
             float(success),
             False,
             False,
             {
                 "page": DetachedPage(self.page.url, content),
+                "settle_time": settle_time,
                 "fail_error": fail_error,
+                "observation_metadata": self._get_obs_metadata(),
             },
         )
 
     def step(
         self, action: Action
-    ) -> tuple[npt.NDArray[np.uint8], float, bool, bool, dict[str, object]]:
-        return asyncio.run(self.astep(action), debug=True)
+    ) -> tuple[dict[str, Observation], float, bool, bool, dict[str, Any]]:
+        return self.run(self.astep(action))  # type: ignore[no-any-return]
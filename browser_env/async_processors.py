@@ -0,0 +1,317 @@
+import asyncio
+import base64
+import time
+from typing import Any, Awaitable, cast
+
+from playwright.async_api import CDPSession, Page
+
+from .processors import (
+    PAGE_PROBE_JS,
+    SCROLL_OFFSET_JS,
+    ImageObservationProcessor,
+    LazyObservation,
+    ObservationHandler,
+    PageProbe,
+    TextObervationProcessor,
+    get_target_titles,
+    make_page_probe,
+)
+from .token_budget import estimate_tokens
+from .utils import (
+    AccessibilityTree,
+    BrowserInfo,
+    Observation,
+    Screenshot,
+)
+
+
+class AsyncTextObservationProcessor(TextObervationProcessor):
+    """The text processor on the async API, the CDP commands of an
+    observation are sent concurrently"""
+
+    async def aprobe_page(self, page: Page) -> PageProbe:
+        return make_page_probe(
+            await page.evaluate(PAGE_PROBE_JS, self.incremental)
+        )
+
+    async def afetch_browser_info(
+        self, page: Page, client: CDPSession, probe: PageProbe | None = None
+    ) -> BrowserInfo:
+        snapshot = client.send(
+            "DOMSnapshot.captureSnapshot",
+            {
+                "computedStyles": self.snapshot_styles,
+                "includeDOMRects": True,
+                "includePaintOrder": True,
+            },
+        )
+        if probe is None:
+            tree, probe = await asyncio.gather(
+                snapshot, self.aprobe_page(page)
+            )
+        else:
+            tree = await snapshot
+        return self.make_browser_info(
+            tree,
+            win_top_bound=probe["scroll_y"],
+            win_left_bound=probe["scroll_x"],
+            win_width=probe["win_width"],
+            win_height=probe["win_height"],
+            device_pixel_ratio=probe["device_pixel_ratio"],
+        )
+
+    @staticmethod
+    async def aget_bounding_client_rect(
+        client: CDPSession, backend_node_id: str
+    ) -> dict[str, Any]:
+        try:
+            remote_object = await client.send(
+                "DOM.resolveNode", {"backendNodeId": int(backend_node_id)}
+            )
+            remote_object_id = remote_object["object"]["objectId"]
+            response = await client.send(
+                "Runtime.callFunctionOn",
+                {
+                    "objectId": remote_object_id,
+                    "functionDeclaration": """
+                        function() {
+                            if (this.nodeType == 3) {
+                                var range = document.createRange();
+                                range.selectNode(this);
+                                var rect = range.getBoundingClientRect().toJSON();
+                                range.detach();
+                                return rect;
+                            } else {
+                                return this.getBoundingClientRect().toJSON();
+                            }
+                        }
+                    """,
+                    "returnByValue": True,
+                },
+            )
+            return response
+        except Exception:
+            return {"result": {"subtype": "error"}}
+
+    async def afetch_page_accessibility_tree(
+        self,
+        info: BrowserInfo,
+        accessibility_tree: AccessibilityTree,
+        client: CDPSession,
+        current_viewport_only: bool,
+    ) -> AccessibilityTree:
+        accessibility_tree, fallback_cursors = self.join_accessibility_bounds(
+            accessibility_tree, info
+        )
+        responses = await asyncio.gather(
+            *(
+                self.aget_bounding_client_rect(
+                    client, str(accessibility_tree[cursor]["backendDOMNodeId"])
+                )
+                for cursor in fallback_cursors
+            )
+        )
+        for cursor, response in zip(fallback_cursors, responses):
+            self.set_client_rect_bound(accessibility_tree[cursor], response)
+
+        # filter nodes that are not in the current viewport
+        if current_viewport_only:
+            accessibility_tree = self.slice_accessibility_tree(
+                accessibility_tree, info
+            )
+        return accessibility_tree
+
+    async def afetch(
+        self, page: Page, client: CDPSession, probe: PageProbe | None = None
+    ) -> tuple[BrowserInfo, AccessibilityTree | None]:
+        """Fetch the snapshot, and the accessibility tree if needed, at the
+        same time"""
+        if self.observation_type != "accessibility_tree":
+            return await self.afetch_browser_info(page, client, probe), None
+        browser_info, response = await asyncio.gather(
+            self.afetch_browser_info(page, client, probe),
+            client.send("Accessibility.getFullAXTree", {}),
+        )
+        return browser_info, response["nodes"]
+
+    async def aget_tab_titles(
+        self, page: Page, client: CDPSession, probe: PageProbe | None
+    ) -> list[str]:
+        open_tabs = page.context.pages
+        if len(open_tabs) == 1 and probe is not None:
+            return [probe["title"]]
+        try:
+            target_titles = get_target_titles(
+                await client.send("Target.getTargets")
+            )
+        except Exception:
+            target_titles = {}
+        tab_titles = []
+        for tab in open_tabs:
+            if tab is page and probe is not None:
+                tab_titles.append(probe["title"])
+                continue
+            target_id = await self.aget_target_id(tab)
+            if target_id in target_titles:
+                tab_titles.append(target_titles[target_id])
+            else:
+                tab_titles.append(await tab.title())
+        return tab_titles
+
+    @staticmethod
+    async def aget_target_id(page: Page) -> str | None:
+        if not hasattr(page, "target_id"):
+            if not hasattr(page, "client"):
+                return None
+            target_info = await page.client.send("Target.getTargetInfo")
+            page.target_id = target_info["targetInfo"]["targetId"]  # type: ignore
+        return page.target_id  # type: ignore
+
+    async def aprocess(self, page: Page, client: CDPSession) -> str:
+        start_time = time.perf_counter()
+        self.page_state = None
+        self.page_rules = self.get_page_rules(page.url)
+        try:
+            probe: PageProbe | None = await self.aprobe_page(page)
+        except Exception:
+            probe = None
+
+        # get the tab info
+        open_tabs = page.context.pages
+        try:
+            tab_title_str = self.format_tab_titles(
+                await self.aget_tab_titles(page, client, probe),
+                open_tabs.index(page),
+            )
+        except Exception:
+            tab_title_str = " | ".join(
+                [f"Tab {idx}" for idx in range(len(open_tabs))]
+            )
+
+        self.tab_title_tokens = estimate_tokens(f"{tab_title_str}\n\n")
+
+        if self.incremental and probe is not None:
+            assert probe["tracker_state"] is not None
+            cached_content = self.get_cached_content(
+                page, probe["tracker_state"]
+            )
+            if cached_content is not None:
+                self.latency.add("reused", time.perf_counter() - start_time)
+                return f"{tab_title_str}\n\n{cached_content}"
+            if self.reslices_on_scroll:
+                cached_content = self.reslice(
+                    page, probe  # type: ignore[arg-type]
+                )
+                if cached_content is not None:
+                    self.latency.add(
+                        "resliced", time.perf_counter() - start_time
+                    )
+                    return f"{tab_title_str}\n\n{cached_content}"
+
+        try:
+            browser_info, accessibility_tree = await self.afetch(
+                page, client, probe
+            )
+        except Exception:
+            await page.wait_for_load_state("load", timeout=500)
+            self.page_state = None
+            browser_info, accessibility_tree = await self.afetch(page, client)
+
+        if self.observation_type == "html":
+            dom_tree = self.fetch_page_html(
+                browser_info,
+                page,  # type: ignore[arg-type]
+                client,  # type: ignore[arg-type]
+                current_viewport_only=self.current_viewport_only,
+            )
+            if self.reslices_on_scroll:
+                self.cache_full_page(browser_info)
+            content = self.serialize_tree(browser_info, dom_tree)
+
+        elif self.observation_type == "accessibility_tree":
+            assert accessibility_tree is not None
+            accessibility_tree = await self.afetch_page_accessibility_tree(
+                browser_info,
+                accessibility_tree,
+                client,
+                current_viewport_only=self.current_viewport_only,
+            )
+            content = self.serialize_tree(browser_info, accessibility_tree)
+
+        else:
+            raise ValueError(
+                f"Invalid observatrion type: {self.observation_type}"
+            )
+
+        content = f"{tab_title_str}\n\n{content}"
+        self.latency.add("rebuilt", time.perf_counter() - start_time)
+        return content
+
+
+class AsyncImageObservationProcessor(ImageObservationProcessor):
+    async def acapture(self, page: Page, client: CDPSession) -> Screenshot:
+        """Capture the encoded screenshot without decoding it"""
+        scroll_x, scroll_y = 0.0, 0.0
+        if self.needs_clip:
+            scroll_x, scroll_y = await page.evaluate(SCROLL_OFFSET_JS)
+        params = self.make_capture_params(
+            scroll_x, scroll_y, page.viewport_size
+        )
+        try:
+            response = await client.send("Page.captureScreenshot", params)
+        except Exception:
+            await page.wait_for_event("load")
+            response = await client.send("Page.captureScreenshot", params)
+        return Screenshot(
+            base64.b64decode(response["data"]), self.screenshot_format
+        )
+
+
+class AsyncObservationHandler(ObservationHandler):
+    """The observation handler on the async API, all the modalities are
+    captured at the same time"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        image_processor = self.image_processor
+        self.text_processor = AsyncTextObservationProcessor(
+            self.text_processor.observation_type,
+            self.text_processor.current_viewport_only,
+            self.text_processor.viewport_size,
+            incremental=self.text_processor.incremental,
+            max_obs_tokens=self.text_processor.max_obs_tokens,
+            reduction_rules=self.text_processor.reduction_rules,
+            retrieval_top_k=self.text_processor.retrieval_top_k,
+        )
+        self.image_processor = AsyncImageObservationProcessor(
+            image_processor.observation_type,
+            screenshot_format=image_processor.screenshot_format,
+            screenshot_quality=image_processor.screenshot_quality,
+            screenshot_scale=image_processor.screenshot_scale,
+            screenshot_clip=image_processor.screenshot_clip,
+        )
+
+    async def aget_observation(
+        self, page: Page, client: CDPSession, capture_screenshot: bool = True
+    ) -> LazyObservation:
+        """Capture the text and the screenshot concurrently, the image array
+        is only decoded when read"""
+        assert isinstance(self.text_processor, AsyncTextObservationProcessor)
+        assert isinstance(self.image_processor, AsyncImageObservationProcessor)
+        captures: dict[str, Awaitable[Observation]] = {}
+        if self.text_processor.observation_type:
+            captures["text"] = self.text_processor.aprocess(page, client)
+        if capture_screenshot:
+            captures["screenshot"] = self.image_processor.acapture(
+                page, client
+            )
+
+        obs = LazyObservation({})
+        obs.update(
+            zip(captures.keys(), await asyncio.gather(*captures.values()))
+        )
+        if capture_screenshot:
+            obs.capture_fns = {
+                "image": lambda: cast(Screenshot, obs["screenshot"]).to_numpy()
+            }
+        return obs
@@ -0,0 +1,142 @@
+import asyncio
+from pathlib import Path
+from typing import Any, Coroutine, TypeVar
+
+from playwright.async_api import Browser, Playwright, async_playwright
+
+from .actions import Action
+from .async_envs import AsyncScriptBrowserEnv
+from .utils import Observation
+
+T = TypeVar("T")
+
+
+class BatchScriptBrowserEnv:
+    """Run several independent episodes, one BrowserContext each, inside a
+    single browser process
+
+    Each episode is served by an AsyncScriptBrowserEnv that borrows the
+    shared browser, and all of them run on one event loop. The batch methods
+    reset or step the episodes together with `asyncio.gather`, so their
+    actions, the waits for their pages and their observation captures
+    overlap instead of running one episode after another.
+    """
+
+    def __init__(self, num_envs: int, **env_kwargs: Any) -> None:
+        if num_envs <= 0:
+            raise ValueError("num_envs must be positive")
+        self.headless = env_kwargs.get("headless", True)
+        self.slow_mo = env_kwargs.get("slow_mo", 0)
+        self.loop = asyncio.new_event_loop()
+        self.envs = [
+            AsyncScriptBrowserEnv(loop=self.loop, **env_kwargs)
+            for _ in range(num_envs)
+        ]
+        self.context_manager = async_playwright()
+        self.playwright: Playwright = self.run(
+            self.context_manager.__aenter__()
+        )
+        self.browser = self.run(self.alaunch_browser())
+
+    @property
+    def num_envs(self) -> int:
+        return len(self.envs)
+
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        return self.loop.run_until_complete(coroutine)
+
+    async def alaunch_browser(self) -> Browser:
+        browser = await self.playwright.chromium.launch(
+            headless=self.headless, slow_mo=self.slow_mo
+        )
+        for env in self.envs:
+            # the envs never launch a browser on their own
+            await env.aclose_context()
+            env.playwright = self.playwright
+            env.browser = browser
+        return browser
+
+    async def areset_batch(
+        self,
+        config_files: list[Path | None],
+        indices: list[int] | None = None,
+    ) -> list[tuple[dict[str, Observation], dict[str, Any]]]:
+        if indices is None:
+            indices = list(range(self.num_envs))
+        if len(config_files) != len(indices):
+            raise ValueError(
+                f"Expected {len(indices)} config files, got {len(config_files)}"
+            )
+        if not self.browser.is_connected():
+            self.browser = await self.alaunch_browser()
+
+        return list(
+            await asyncio.gather(
+                *(
+                    self.envs[idx].areset(
+                        options={"config_file": str(config_file)}
+                        if config_file
+                        else None
+                    )
+                    for idx, config_file in zip(indices, config_files)
+                )
+            )
+        )
+
+    def reset_batch(
+        self,
+        config_files: list[Path | None],
+        indices: list[int] | None = None,
+    ) -> list[tuple[dict[str, Observation], dict[str, Any]]]:
+        """Reset the episodes at indices (all of them by default), one
+        config file each"""
+        return self.run(self.areset_batch(config_files, indices))
+
+    async def astep_batch(
+        self, actions: list[Action | None]
+    ) -> list[
+        tuple[dict[str, Observation], float, bool, bool, dict[str, Any]] | None
+    ]:
+        if len(actions) != self.num_envs:
+            raise ValueError(
+                f"Expected {self.num_envs} actions, got {len(actions)}"
+            )
+        stepped = [
+            (idx, action)
+            for idx, action in enumerate(actions)
+            if action is not None
+        ]
+        results = await asyncio.gather(
+            *(self.envs[idx].astep(action) for idx, action in stepped)
+        )
+
+        msgs: list[
+            tuple[dict[str, Observation], float, bool, bool, dict[str, Any]]
+            | None
+        ] = [None] * self.num_envs
+        for (idx, _), msg in zip(stepped, results):
+            msgs[idx] = msg
+        return msgs
+
+    def step_batch(
+        self, actions: list[Action | None]
+    ) -> list[
+        tuple[dict[str, Observation], float, bool, bool, dict[str, Any]] | None
+    ]:
+        """Step every episode with its action, None skips the episode"""
+        return self.run(self.astep_batch(actions))
+
+    async def aclose(self) -> None:
+        for env in self.envs:
+            await env.aclose_context()
+            env.browser = None
+            env.playwright = None
+        try:
+            await self.browser.close()
+        except Exception:
+            pass
+        await self.context_manager.__aexit__()
+
+    def close(self) -> None:
+        self.run(self.aclose())
+        self.loop.close()
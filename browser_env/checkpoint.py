@@ -0,0 +1,176 @@
+"""Checkpoints of the browser state in the middle of an episode
+
+A checkpoint holds the cookies and localStorage of the context, and for
+each tab its url, navigation history, sessionStorage and scroll position.
+Restoring it into a fresh context loads each tab once, so an episode can
+resume, or branch into several episodes, without replaying its actions.
+"""
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any
+
+from playwright.sync_api import BrowserContext, CDPSession, Page
+
+from .context_pool import START_URL_SEPARATOR
+
+# sessionStorage is only restored into the first document of each origin,
+# the marker keeps the later documents from overwriting it again
+SESSION_STORAGE_MARKER = "__webarena_checkpoint_restored__"
+
+RESTORE_SESSION_STORAGE_JS = """([origin, items, marker]) => {
+    if (location.origin !== origin || sessionStorage.getItem(marker)) {
+        return;
+    }
+    for (const [key, value] of Object.entries(items)) {
+        sessionStorage.setItem(key, value);
+    }
+    sessionStorage.setItem(marker, "1");
+}"""
+
+TAB_STATE_JS = """() => {
+    const items = {};
+    for (let i = 0; i < sessionStorage.length; i++) {
+        const key = sessionStorage.key(i);
+        items[key] = sessionStorage.getItem(key);
+    }
+    return [location.origin, items, window.pageXOffset, window.pageYOffset];
+}"""
+
+
+@dataclass
+class TabCheckpoint:
+    url: str
+    # the urls of the back entries, the forward entries are not kept
+    history: list[str] = field(default_factory=list)
+    origin: str = ""
+    session_storage: dict[str, str] = field(default_factory=dict)
+    scroll_x: float = 0.0
+    scroll_y: float = 0.0
+
+
+@dataclass
+class EnvCheckpoint:
+    storage_state: dict[str, Any]
+    tabs: list[TabCheckpoint]
+    current_tab: int
+    # the number of steps taken in the episode
+    step_index: int
+    geolocation: dict[str, float] | None = None
+    # the intent of the task and the query of the intent retrieval
+    intent: str = ""
+    retrieval_query: str = ""
+
+    def save(self, path: str | Path) -> None:
+        with open(path, "w") as f:
+            json.dump(asdict(self), f)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "EnvCheckpoint":
+        with open(path, "r") as f:
+            data = json.load(f)
+        data["tabs"] = [TabCheckpoint(**tab) for tab in data["tabs"]]
+        return cls(**data)
+
+    def to_instance_config(self) -> dict[str, Any]:
+        """The config of a task starting from the tabs of the checkpoint"""
+        return {
+            "storage_state": self.storage_state,
+            "start_url": START_URL_SEPARATOR.join(
+                tab.url for tab in self.tabs
+            ),
+            "geolocation": self.geolocation,
+            "intent": self.intent,
+        }
+
+
+def get_page_client(page: Page) -> CDPSession:
+    """The CDP session of the page, the popups opened by the sites get one
+    on their first checkpoint"""
+    if not hasattr(page, "client"):
+        page.client = page.context.new_cdp_session(page)  # type: ignore[attr-defined]
+    return page.client  # type: ignore[attr-defined, no-any-return]
+
+
+def capture_tab(page: Page) -> TabCheckpoint:
+    try:
+        history = get_page_client(page).send("Page.getNavigationHistory")
+        back_urls = [
+            entry["url"]
+            for entry in history["entries"][: history["currentIndex"]]
+            if entry["url"] != "about:blank"
+        ]
+    except Exception:
+        # e.g. a closing popup, its history is not kept
+        back_urls = []
+    try:
+        origin, session_storage, scroll_x, scroll_y = page.evaluate(
+            TAB_STATE_JS
+        )
+    except Exception:
+        # e.g. the storage of opaque origins is not accessible
+        origin, session_storage, scroll_x, scroll_y = "", {}, 0.0, 0.0
+    session_storage.pop(SESSION_STORAGE_MARKER, None)
+    return TabCheckpoint(
+        url=page.url,
+        history=back_urls,
+        origin=origin,
+        session_storage=session_storage,
+        scroll_x=scroll_x,
+        scroll_y=scroll_y,
+    )
+
+
+def capture_checkpoint(
+    context: BrowserContext,
+    current_page: Page,
+    step_index: int,
+    geolocation: dict[str, float] | None = None,
+    intent: str = "",
+    retrieval_query: str = "",
+) -> EnvCheckpoint:
+    pages = context.pages
+    return EnvCheckpoint(
+        storage_state=dict(context.storage_state()),
+        tabs=[capture_tab(page) for page in pages],
+        current_tab=pages.index(current_page),
+        step_index=step_index,
+        geolocation=geolocation,
+        intent=intent,
+        retrieval_query=retrieval_query,
+    )
+
+
+def restore_tabs(
+    context: BrowserContext,
+    checkpoint: EnvCheckpoint,
+    restore_history: bool = False,
+) -> None:
+    """Load the tabs of the checkpoint into the pages of a context opened
+    with its instance config
+
+    With restore_history, the back entries of each tab are navigated first,
+    only up to their committed response, so going back works as in the
+    original episode at the cost of one server round trip per entry.
+    """
+    for page, tab in zip(context.pages, checkpoint.tabs):
+        if tab.session_storage:
+            args = json.dumps(
+                [tab.origin, tab.session_storage, SESSION_STORAGE_MARKER]
+            )
+            page.add_init_script(
+                script=f"({RESTORE_SESSION_STORAGE_JS})({args})"
+            )
+        if restore_history:
+            for url in tab.history:
+                page.goto(url, wait_until="commit")
+        # the tabs load concurrently, they are waited for below
+        page.goto(tab.url, wait_until="commit")
+
+    for page, tab in zip(context.pages, checkpoint.tabs):
+        page.wait_for_load_state("load")
+        if tab.scroll_x or tab.scroll_y:
+            page.evaluate(
+                "([x, y]) => window.scrollTo(x, y)",
+                [tab.scroll_x, tab.scroll_y],
+            )
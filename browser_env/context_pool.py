@@ -0,0 +1,191 @@
+"""Browser contexts prepared ahead of the task that uses them"""
+import json
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+
+from playwright.sync_api import (
+    Browser,
+    BrowserContext,
+    Page,
+    ViewportSize,
+)
+
+from .settle import reduce_motion
+
+START_URL_SEPARATOR = " |AND| "
+
+ContextKey = tuple[str | None, str | None, str | None]
+
+
+def get_context_key(instance_config: dict[str, Any]) -> ContextKey:
+    """Tasks with the same cookies, start urls and geolocation can share a
+    prepared context"""
+    geolocation = instance_config.get("geolocation", None)
+    return (
+        instance_config.get("storage_state", None),
+        instance_config.get("start_url", None),
+        json.dumps(geolocation, sort_keys=True) if geolocation else None,
+    )
+
+
+def open_context(
+    browser: Browser,
+    instance_config: dict[str, Any],
+    viewport_size: ViewportSize,
+    enable_accessibility: bool,
+    reduced_motion: bool = False,
+    context_hooks: Sequence[Callable[[BrowserContext], None]] = (),
+    navigate: bool = False,
+) -> BrowserContext:
+    """Open a context with one page per start url, each with its CDP session
+    attached. The hooks set up the context, e.g. its routes, before any page
+    is opened.
+
+    With navigate, all the pages start loading their start urls before the
+    CDP sessions are attached, so the loads overlap each other and the
+    session setup. Wait for them with wait_for_loads.
+    """
+    context = browser.new_context(
+        viewport=viewport_size,
+        storage_state=instance_config.get("storage_state", None),
+        geolocation=instance_config.get("geolocation", None),
+        device_scale_factor=1,
+        reduced_motion="reduce" if reduced_motion else None,
+    )
+    if reduced_motion:
+        reduce_motion(context)
+    for hook in context_hooks:
+        hook(context)
+    start_urls = get_start_urls(instance_config)
+    pages = [context.new_page() for _ in range(max(len(start_urls), 1))]
+    if navigate:
+        start_navigation(pages, start_urls)
+    for page in pages:
+        client = context.new_cdp_session(page)  # talk to chrome devtools
+        if enable_accessibility:
+            client.send("Accessibility.enable")
+        page.client = client  # type: ignore # TODO[shuyanzh], fix this hackey client
+    return context
+
+
+def get_start_urls(instance_config: dict[str, Any]) -> list[str]:
+    start_url = instance_config.get("start_url", None)
+    return start_url.split(START_URL_SEPARATOR) if start_url else []
+
+
+def start_navigation(pages: list[Page], urls: list[str]) -> None:
+    """Navigate each page up to its committed response only, the rest of
+    the loads run concurrently in the browser"""
+    for page, url in zip(pages, urls):
+        page.goto(url, wait_until="commit")
+
+
+def wait_for_loads(pages: list[Page], state: str = "load") -> None:
+    """Wait for the pages together, this takes as long as the slowest"""
+    for page in pages:
+        page.wait_for_load_state(state)  # type: ignore[arg-type]
+
+
+def navigate_context(
+    context: BrowserContext,
+    instance_config: dict[str, Any],
+    wait_until: str = "load",
+) -> None:
+    """Navigate the pages of the context to their start urls"""
+    start_navigation(context.pages, get_start_urls(instance_config))
+    if wait_until != "commit":
+        wait_for_loads(context.pages, wait_until)
+
+
+@dataclass
+class PreparedContext:
+    context: BrowserContext
+    navigated: bool
+    prepared_at: float
+
+
+class ContextPool:
+    """Contexts opened ahead of time, keyed by the task setup they serve
+
+    A prepared context has its cookies loaded and its CDP sessions attached.
+    Its start urls are only navigated up to the committed response, so the
+    rest of the page load runs in the browser while the current episode
+    goes on. Note that a page navigated ahead of time may not reflect the
+    changes the current episode makes to the site.
+    """
+
+    def __init__(self, max_size: int = 2) -> None:
+        self.max_size = max_size
+        self.contexts: dict[ContextKey, list[PreparedContext]] = defaultdict(
+            list
+        )
+
+    def __len__(self) -> int:
+        return sum(len(prepared) for prepared in self.contexts.values())
+
+    def prepare(
+        self,
+        browser: Browser,
+        instance_config: dict[str, Any],
+        viewport_size: ViewportSize,
+        enable_accessibility: bool,
+        navigate: bool = True,
+        reduced_motion: bool = False,
+        context_hooks: Sequence[Callable[[BrowserContext], None]] = (),
+    ) -> None:
+        if self.max_size <= 0:
+            return
+        while len(self) >= self.max_size:
+            self.evict_oldest()
+
+        context = open_context(
+            browser,
+            instance_config,
+            viewport_size,
+            enable_accessibility,
+            reduced_motion=reduced_motion,
+            context_hooks=context_hooks,
+            navigate=navigate,
+        )
+        self.contexts[get_context_key(instance_config)].append(
+            PreparedContext(context, navigate, time.time())
+        )
+
+    def take(
+        self, browser: Browser, instance_config: dict[str, Any]
+    ) -> PreparedContext | None:
+        """Hand over a context prepared for this task in this browser"""
+        prepared_list = self.contexts.get(get_context_key(instance_config))
+        while prepared_list:
+            prepared = prepared_list.pop(0)
+            if prepared.context.browser is browser and browser.is_connected():
+                return prepared
+            close_quietly(prepared.context)
+        return None
+
+    def evict_oldest(self) -> None:
+        key, index = min(
+            (
+                (key, index)
+                for key, prepared_list in self.contexts.items()
+                for index in range(len(prepared_list))
+            ),
+            key=lambda k_i: self.contexts[k_i[0]][k_i[1]].prepared_at,
+        )
+        close_quietly(self.contexts[key].pop(index).context)
+
+    def close(self) -> None:
+        for prepared_list in self.contexts.values():
+            for prepared in prepared_list:
+                close_quietly(prepared.context)
+        self.contexts.clear()
+
+
+def close_quietly(context: BrowserContext) -> None:
+    try:
+        context.close()
+    except Exception:
+        # the browser is gone together with its contexts
+        pass
@@ -4,7 +4,7 @@ import time
 from collections import defaultdict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, Callable, Sequence, Union
 
 import numpy as np
 import numpy.typing as npt
@@ -13,19 +13,50 @@ from beartype.door import is_bearable
 from gymnasium import Env
 from gymnasium.spaces import Box, Text
 from playwright.sync_api import (
+    Browser,
+    BrowserContext,
     CDPSession,
+    FloatRect,
     Page,
     Playwright,
     ViewportSize,
     expect,
     sync_playwright,
 )
+from playwright.sync_api._context_manager import (
+    PlaywrightContextManager,
+)
 
-from .actions import Action, execute_action, get_action_space
-from .processors import ObservationHandler, ObservationMetadata
+from .actions import (
+    POINTER_ACTION_TYPES,
+    Action,
+    execute_action,
+    get_action_query,
+    get_action_space,
+)
+from .asset_cache import AssetCache
+from .checkpoint import EnvCheckpoint, capture_checkpoint, restore_tabs
+from .context_pool import (
+    ContextPool,
+    close_quietly,
+    navigate_context,
+    open_context,
+    wait_for_loads,
+)
+from .processors import (
+    DEFAULT_REDUCTION_RULES,
+    LazyObservation,
+    ObservationHandler,
+    ObservationMetadata,
+    ReductionRule,
+)
+from .routing import RoutingProfile
+from .settle import PageSettleDetector
+from .tracing import TraceRecorder
 from .utils import (
     AccessibilityTree,
     DetachedPage,
+    LazyDetachedPage,
     Observation,
     png_bytes_to_numpy,
 )
@@ -84,6 +115,24 @@ class ScriptBrowserEnv(Env[dict[str, Observation], Action]):
         viewport_size: ViewportSize = {"width": 1280, "height": 720},
         save_trace_enabled: bool = False,
         sleep_after_execution: float = 0.0,
+        incremental_observation: bool = False,
+        max_obs_tokens: int | None = None,
+        reduction_rules: Sequence[ReductionRule] = DEFAULT_REDUCTION_RULES,
+        retrieval_top_k: int | None = None,
+        screenshot_format: str = "png",
+        screenshot_quality: int | None = None,
+        screenshot_scale: float = 1.0,
+        screenshot_clip: FloatRect | None = None,
+        max_tasks_per_browser: int | None = None,
+        context_pool_size: int = 2,
+        settle_timeout: float = 0.0,
+        settle_quiet_window: float = 0.5,
+        reduced_motion: bool = False,
+        routing_profile: RoutingProfile | None = None,
+        asset_cache: AssetCache | None = None,
+        trace_mode: str | None = None,
+        trace_sample_every: int = 1,
+        trace_failures_only: bool = False,
     ):
         # TODO: make Space[Action] = ActionSpace
         self.action_space = get_action_space()  # type: ignore[assignment]
@@ -92,8 +141,49 @@ class ScriptBrowserEnv(Env[dict[str, Observation], Action]):
         self.current_viewport_only = current_viewport_only
         self.reset_finished = False
         self.viewport_size = viewport_size
+        # the driver and browser live across resets, only the context is new
+        self.context_manager: PlaywrightContextManager | None = None
+        self.playwright: Playwright | None = None
+        self.browser: Browser | None = None
+        self.context: BrowserContext | None = None
+        # restart chromium after this many tasks, None to never restart
+        self.max_tasks_per_browser = max_tasks_per_browser
+        self.num_browser_tasks = 0
+        self.context_pool = ContextPool(max_size=context_pool_size)
+        self.last_observation: LazyObservation | None = None
+        self.last_detached_page: LazyDetachedPage | None = None
+        self.instance_config: dict[str, Any] = {}
+        # the intent of the task, to retrieve the relevant elements with
+        self.intent = ""
+        # the steps taken in the current episode
+        self.num_steps = 0
         self.save_trace_enabled = save_trace_enabled
+        # save_trace_enabled alone records the full trace of every task
+        self.trace_recorder = TraceRecorder(
+            trace_mode or ("full" if save_trace_enabled else "off"),
+            sample_every=trace_sample_every,
+            failures_only=trace_failures_only,
+        )
         self.sleep_after_execution = sleep_after_execution
+        # wait for the page to settle instead of sleeping when enabled
+        self.settle_detector = (
+            PageSettleDetector(
+                timeout=settle_timeout, quiet_window=settle_quiet_window
+            )
+            if settle_timeout > 0
+            else None
+        )
+        self.reduced_motion = reduced_motion
+        # set up every new context before its pages are opened
+        self.context_hooks: list[Callable[[BrowserContext], None]] = []
+        # the last route registered handles a request first, so the blocked
+        # requests never reach the cache
+        self.asset_cache = asset_cache
+        if asset_cache is not None:
+            self.context_hooks.append(asset_cache.attach)
+        self.routing_profile = routing_profile
+        if routing_profile is not None:
+            self.context_hooks.append(routing_profile.attach)
 
         match observation_type:
             case "html" | "accessibility_tree":
@@ -115,68 +205,219 @@ class ScriptBrowserEnv(Env[dict[str, Observation], Action]):
             self.image_observation_type,
             self.current_viewport_only,
             self.viewport_size,
+            incremental_observation=incremental_observation,
+            max_obs_tokens=max_obs_tokens,
+            reduction_rules=reduction_rules,
+            retrieval_top_k=retrieval_top_k,
+            screenshot_format=screenshot_format,
+            screenshot_quality=screenshot_quality,
+            screenshot_scale=screenshot_scale,
+            screenshot_clip=screenshot_clip,
         )
 
         self.observation_space = (
             self.observation_handler.get_observation_space()
         )
 
+    def browser_needs_restart(self) -> bool:
+        """Whether the browser crashed or served max_tasks_per_browser tasks"""
+        return self.browser is not None and (
+            not self.browser.is_connected()
+            or (
+                self.max_tasks_per_browser is not None
+                and self.num_browser_tasks >= self.max_tasks_per_browser
+            )
+        )
+
+    def launch_browser(self) -> Browser:
+        """Return the running browser, relaunching it if needed"""
+        if self.browser_needs_restart():
+            self.close_browser()
+
+        if self.playwright is None:
+            self.context_manager = sync_playwright()
+            self.playwright = self.context_manager.__enter__()
+        if self.browser is None:
+            self.browser = self.playwright.chromium.launch(
+                headless=self.headless, slow_mo=self.slow_mo
+            )
+            self.num_browser_tasks = 0
+        return self.browser
+
+    def close_context(self) -> None:
+        if self.context is not None:
+            close_quietly(self.context)
+            self.context = None
+
+    def close_browser(self) -> None:
+        self.close_context()
+        self.context_pool.close()
+        if self.browser is not None:
+            try:
+                self.browser.close()
+            except Exception:
+                pass
+            self.browser = None
+
     @beartype
-    def setup(self, config_file: Path | None = None) -> None:
-        self.context_manager = sync_playwright()
-        self.playwright = self.context_manager.__enter__()
-        self.browser = self.playwright.chromium.launch(
-            headless=self.headless, slow_mo=self.slow_mo
+    def prepare(self, config_file: Path, navigate: bool = True) -> None:
+        """Open the context of an upcoming task ahead of its reset
+
+        With navigate, the start urls are loaded while the current episode
+        runs, so they may miss the changes the episode makes to the sites.
+        """
+        if self.browser is None or self.browser_needs_restart():
+            # the restart would close the context of the current episode
+            return
+        with open(config_file, "r") as f:
+            instance_config = json.load(f)
+        self.context_pool.prepare(
+            self.browser,
+            instance_config,
+            self.viewport_size,
+            self.text_observation_type == "accessibility_tree",
+            navigate=navigate,
+            reduced_motion=self.reduced_motion,
+            context_hooks=self.context_hooks,
         )
 
+    @beartype
+    def setup(self, config_file: Path | None = None) -> None:
+        browser = self.launch_browser()
+        self.num_browser_tasks += 1
+
         if config_file:
             with open(config_file, "r") as f:
                 instance_config = json.load(f)
         else:
             instance_config = {}
 
-        storage_state = instance_config.get("storage_state", None)
-        start_url = instance_config.get("start_url", None)
-        geolocation = instance_config.get("geolocation", None)
-
-        self.context = self.browser.new_context(
-            viewport=self.viewport_size,
-            storage_state=storage_state,
-            geolocation=geolocation,
-            device_scale_factor=1,
+        self.instance_config = instance_config
+        self.intent = instance_config.get("intent", "")
+        self.observation_handler.text_processor.set_retrieval_query(
+            self.intent
         )
-        if self.save_trace_enabled:
-            self.context.tracing.start(screenshots=True, snapshots=True)
-        if start_url:
-            start_urls = start_url.split(" |AND| ")
-            for url in start_urls:
-                page = self.context.new_page()
-                client = page.context.new_cdp_session(
-                    page
-                )  # talk to chrome devtools
-                if self.text_observation_type == "accessibility_tree":
-                    client.send("Accessibility.enable")
-                page.client = client  # type: ignore # TODO[shuyanzh], fix this hackey client
-                page.goto(url)
-            # set the first page as the current page
-            self.page = self.context.pages[0]
-            self.page.bring_to_front()
+        prepared = self.context_pool.take(browser, instance_config)
+        if prepared is None:
+            self.context = self.open_context(
+                browser, instance_config, navigate=True
+            )
         else:
-            self.page = self.context.new_page()
-            client = self.page.context.new_cdp_session(self.page)
-            if self.text_observation_type == "accessibility_tree":
-                client.send("Accessibility.enable")
-            self.page.client = client  # type: ignore
+            self.context = prepared.context
+            self.start_context(self.context)
+            if not prepared.navigated:
+                navigate_context(
+                    self.context, instance_config, wait_until="commit"
+                )
+        # all the start pages load together
+        wait_for_loads(self.context.pages)
+
+        # set the first page as the current page
+        self.page = self.context.pages[0]
+        if instance_config.get("start_url", None):
+            self.page.bring_to_front()
+
+    def open_context(
+        self,
+        browser: Browser,
+        instance_config: dict[str, Any],
+        navigate: bool = False,
+    ) -> BrowserContext:
+        return open_context(
+            browser,
+            instance_config,
+            self.viewport_size,
+            self.text_observation_type == "accessibility_tree",
+            reduced_motion=self.reduced_motion,
+            # watch the context before its pages start loading
+            context_hooks=[*self.context_hooks, self.start_context],
+            navigate=navigate,
+        )
+
+    def start_context(self, context: BrowserContext) -> None:
+        """Start watching the context of a new episode"""
+        if self.settle_detector is not None:
+            self.settle_detector.attach(context)
+        self.trace_recorder.start(context)
+
+    def checkpoint(self) -> EnvCheckpoint:
+        """Capture the browser state and the step index of the episode"""
+        if not self.reset_finished:
+            raise RuntimeError("Call reset first before calling checkpoint.")
+        assert self.context is not None
+        return capture_checkpoint(
+            self.context,
+            self.page,
+            self.num_steps,
+            geolocation=self.instance_config.get("geolocation", None),
+            intent=self.intent,
+            retrieval_query=(
+                self.observation_handler.text_processor.retrieval_query
+            ),
+        )
+
+    @beartype
+    def restore(
+        self, checkpoint: EnvCheckpoint, restore_history: bool = False
+    ) -> tuple[dict[str, Observation], dict[str, Any]]:
+        """Continue the episode of the checkpoint in a new context, like
+        reset. Several envs can restore the same checkpoint to branch the
+        episode."""
+        self._expire_obs(capture_main=False)
+        self.close_context()
+        browser = self.launch_browser()
+        self.num_browser_tasks += 1
+
+        self.instance_config = checkpoint.to_instance_config()
+        self.intent = checkpoint.intent
+        # the query of the step the checkpoint was captured at
+        self.observation_handler.text_processor.set_retrieval_query(
+            checkpoint.retrieval_query
+        )
+        self.context = self.open_context(browser, self.instance_config)
+        restore_tabs(self.context, checkpoint, restore_history=restore_history)
+        self.page = self.context.pages[checkpoint.current_tab]
+        self.page.bring_to_front()
+        self.num_steps = checkpoint.step_index
+        self.reset_finished = True
+
+        settle_time = self.wait_for_page()
+        return self.finish_reset(settle_time)
+
+    def wait_for_page(self) -> float:
+        """Wait for the current page after a reset or an action, returns the
+        seconds waited"""
+        if self.settle_detector is not None:
+            return self.settle_detector.wait(self.page)
+        if self.sleep_after_execution > 0:
+            time.sleep(self.sleep_after_execution)
+        return self.sleep_after_execution
 
     def get_page_client(self, page: Page) -> CDPSession:
         return page.client  # type: ignore
 
-    def _get_obs(self) -> dict[str, Observation]:
+    def _get_obs(self) -> LazyObservation:
         obs = self.observation_handler.get_observation(
             self.page, self.get_page_client(self.page)
         )
+        self.last_observation = obs
         return obs
 
+    def _expire_obs(self, capture_main: bool) -> None:
+        """Expire the lazy handles of the previous step before the page changes
+
+        The main observation is captured first when requested, since the
+        action processor resolves element ids against its metadata.
+        """
+        if self.last_observation is not None:
+            if capture_main:
+                self.last_observation.capture(self.main_observation_type)
+            self.last_observation.expire()
+            self.last_observation = None
+        if self.last_detached_page is not None:
+            self.last_detached_page.expire()
+            self.last_detached_page = None
+
     def _get_obs_metadata(self) -> dict[str, ObservationMetadata]:
         metadata = self.observation_handler.get_observation_metadata()
         return metadata
@@ -194,8 +435,15 @@ class ScriptBrowserEnv(Env[dict[str, Observation], Action]):
             - "storage_state": the storage state of the browser. It is a file path to a json file.
         """
         super().reset(seed=seed, options=options)
-        if self.reset_finished:
-            self.context_manager.__exit__()
+        self.start_reset(options)
+        settle_time = self.wait_for_page()
+        return self.finish_reset(settle_time)
+
+    def start_reset(self, options: dict[str, str] | None = None) -> None:
+        """Open the context of the new task, without waiting for its pages"""
+        self._expire_obs(capture_main=False)
+        self.close_context()
+        self.num_steps = 0
 
         if options is not None and "config_file" in options:
             config_file = Path(options["config_file"])
@@ -207,33 +455,60 @@ class ScriptBrowserEnv(Env[dict[str, Observation], Action]):
             self.setup()
         self.reset_finished = True
 
-        if self.sleep_after_execution > 0:
-            time.sleep(self.sleep_after_execution)
-
+    def finish_reset(
+        self, settle_time: float
+    ) -> tuple[dict[str, Observation], dict[str, Any]]:
         observation = self._get_obs()
         observation_metadata = self._get_obs_metadata()
         info = {
             "page": DetachedPage(self.page.url, ""),
+            "settle_time": settle_time,
             "fail_error": "",
             "observation_metadata": observation_metadata,
         }
 
         return (observation, info)
 
-    def save_trace(self, trace_path: str | Path) -> None:
-        if self.save_trace_enabled:
-            self.context.tracing.stop(path=trace_path)
+    def save_trace(
+        self, trace_path: str | Path, failed: bool | None = None
+    ) -> bool:
+        """Stop tracing the task, returns whether the trace was written to
+        trace_path, depending on the trace mode and whether the task failed"""
+        assert self.context is not None
+        return self.trace_recorder.stop(
+            self.context, self.page, trace_path, failed=failed
+        )
 
     def close(self) -> None:
-        if self.reset_finished:
+        self.close_browser()
+        if self.context_manager is not None:
             self.context_manager.__exit__()
+            self.context_manager = None
+            self.playwright = None
 
     def step(
         self, action: Action
     ) -> tuple[dict[str, Observation], float, bool, bool, dict[str, Any]]:
+        success, fail_error = self.start_step(action)
+        settle_time = self.wait_for_page()
+        return self.finish_step(success, fail_error, settle_time)
+
+    def start_step(self, action: Action) -> tuple[bool, str]:
+        """Execute the action, without waiting for the page"""
         if not self.reset_finished:
             raise RuntimeError("Call reset first before calling step.")
+        assert self.context is not None
 
+        self._expire_obs(capture_main=True)
+        self.num_steps += 1
+        self.trace_recorder.start_step()
+        text_processor = self.observation_handler.text_processor
+        text_processor.set_retrieval_query(
+            self.intent,
+            get_action_query(
+                action, text_processor.meta_data["obs_nodes_info"]
+            ),
+        )
         success = False
         fail_error = ""
         try:
@@ -244,18 +519,26 @@ class ScriptBrowserEnv(Env[dict[str, Observation], Action]):
                 self.observation_handler.action_processor,
             )
             success = True
+            if action["action_type"] in POINTER_ACTION_TYPES:
+                # a :hover style may have changed the page
+                text_processor.invalidate_cache()
         except Exception as e:
             fail_error = str(e)
+        self.trace_recorder.record_step(action, self.page, success, fail_error)
+        return success, fail_error
 
-        # hard sleep TODO[shuyanzh] suboptimal, may need to check network
-        if self.sleep_after_execution > 0:
-            time.sleep(self.sleep_after_execution)
-
+    def finish_step(
+        self, success: bool, fail_error: str, settle_time: float
+    ) -> tuple[dict[str, Observation], float, bool, bool, dict[str, Any]]:
         observation = self._get_obs()
         observation_metadata = self._get_obs_metadata()
 
+        self.last_detached_page = LazyDetachedPage(
+            self.page.url, self.page.content
+        )
         info = {
-            "page": DetachedPage(self.page.url, self.page.content()),
+            "page": self.last_detached_page,
+            "settle_time": settle_time,
             "fail_error": fail_error,
             "observation_metadata": observation_metadata,
         }
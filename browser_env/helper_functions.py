@@ -1,4 +1,5 @@
 import base64
+import copy
 import io
 import json
 import re
@@ -12,6 +13,7 @@ from browser_env import (
     Action,
     ActionTypes,
     ObservationMetadata,
+    Screenshot,
     StateInfo,
     action2str,
 )
@@ -34,6 +36,27 @@ HTML_TEMPLATE = """
 """
 
 
+def locate_mouse_action(
+    action: Action, text_meta_data: ObservationMetadata
+) -> Action:
+    """Set the element id of a mouse action to the element at its coordinates,
+    in a copy of the action"""
+    if action["action_type"] not in [
+        ActionTypes.MOUSE_CLICK,
+        ActionTypes.MOUSE_HOVER,
+    ]:
+        return action
+    spatial_index = text_meta_data["spatial_index"]
+    if spatial_index is None:
+        return action
+    element_id = spatial_index.get_element_at(*action["coords"])
+    if element_id is None:
+        return action
+    located_action = copy.copy(action)
+    located_action["element_id"] = element_id
+    return located_action
+
+
 def get_render_action(
     action: Action,
     observation_metadata: dict[str, ObservationMetadata],
@@ -43,6 +66,7 @@ def get_render_action(
     match action_set_tag:
         case "id_accessibility_tree":
             text_meta_data = observation_metadata["text"]
+            action = locate_mouse_action(action, text_meta_data)
             if action["element_id"] in text_meta_data["obs_nodes_info"]:
                 node_content = text_meta_data["obs_nodes_info"][action["element_id"]][
                     "text"
@@ -73,11 +97,16 @@ def get_action_description(
     match action_set_tag:
         case "id_accessibility_tree":
             text_meta_data = observation_metadata["text"]
+            action = locate_mouse_action(action, text_meta_data)
             if action["action_type"] in [
                 ActionTypes.CLICK,
                 ActionTypes.HOVER,
                 ActionTypes.TYPE,
-            ]:
+            ] or (
+                action["action_type"]
+                in [ActionTypes.MOUSE_CLICK, ActionTypes.MOUSE_HOVER]
+                and action["element_id"]
+            ):
                 action_name = str(action["action_type"]).split(".")[1].lower()
                 if action["element_id"] in text_meta_data["obs_nodes_info"]:
                     node_content = text_meta_data["obs_nodes_info"][
@@ -147,15 +176,19 @@ class RenderHelper(object):
         new_content += f"<div class='state_obv'><pre>{text_obs}</pre><div>\n"
 
         if render_screenshot:
-            # image observation
-            img_obs = observation["image"]
-            image = Image.fromarray(img_obs)  # type:ignore
-            byte_io = io.BytesIO()
-            image.save(byte_io, format="PNG")
-            byte_io.seek(0)
-            image_bytes = base64.b64encode(byte_io.read())
-            image_str = image_bytes.decode("utf-8")
-            new_content += f"<img src='data:image/png;base64,{image_str}' style='width:50vw; height:auto;'/>\n"
+            # image observation, embed the encoded screenshot when available
+            if "screenshot" in observation:
+                screenshot = observation["screenshot"]
+                assert isinstance(screenshot, Screenshot)
+                image_bytes, mime_type = screenshot.data, screenshot.mime_type
+            else:
+                img_obs = observation["image"]
+                image = Image.fromarray(img_obs)  # type:ignore
+                byte_io = io.BytesIO()
+                image.save(byte_io, format="PNG")
+                image_bytes, mime_type = byte_io.getvalue(), "image/png"
+            image_str = base64.b64encode(image_bytes).decode("utf-8")
+            new_content += f"<img src='data:{mime_type};base64,{image_str}' style='width:50vw; height:auto;'/>\n"
 
         # meta data
         new_content += f"<div class='prev_action' style='background-color:pink'>{meta_data['action_history'][-1]}</div>\n"
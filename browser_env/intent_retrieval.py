@@ -0,0 +1,190 @@
+"""Keep the lines of a serialized observation relevant to the task
+
+Each line of the tree is a document of a BM25 index built per observation,
+scored against the intent of the task and the previous action. The top
+scoring lines are kept with their ancestors, together with the focused
+node and all the form controls, and every run of other lines is replaced
+by a marker counting them. The index only counts the query terms, which
+takes a few milliseconds for the thousands of lines of a large page.
+"""
+import bisect
+import math
+import re
+from collections import Counter
+from itertools import accumulate
+
+from .token_budget import get_parents, join_kept_lines
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# [id] of the nodes, not matched against the numbers in the query
+ELEMENT_ID_PATTERN = re.compile(r"\[\d+\]")
+
+STOPWORDS = frozenset(
+    [
+        "a",
+        "an",
+        "and",
+        "are",
+        "at",
+        "be",
+        "by",
+        "for",
+        "from",
+        "i",
+        "in",
+        "is",
+        "it",
+        "me",
+        "my",
+        "of",
+        "on",
+        "or",
+        "that",
+        "the",
+        "this",
+        "to",
+        "what",
+        "which",
+        "with",
+    ]
+)
+
+# the accessibility roles and the html tags of the form controls, always
+# kept since the task may need to fill them
+FORM_ROLES = [
+    "button",
+    "checkbox",
+    "combobox",
+    "listbox",
+    "radio",
+    "searchbox",
+    "slider",
+    "spinbutton",
+    "switch",
+    "textbox",
+    "input",
+    "select",
+    "textarea",
+]
+
+# the lines of the form controls, each line preceded by a newline
+FORM_LINE_PATTERN = re.compile(
+    r"\n\t*\[\d+\] <?(?:" + "|".join(FORM_ROLES) + r")\b", re.IGNORECASE
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """The lowercased words of the text, without stopwords and with a
+    plural s removed"""
+    words = WORD_PATTERN.findall(ELEMENT_ID_PATTERN.sub(" ", text.lower()))
+    return [
+        word[:-1]
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss")
+        else word
+        for word in words
+        if word not in STOPWORDS
+    ]
+
+
+def get_row(line_starts: list[int], offset: int) -> int:
+    return bisect.bisect_right(line_starts, offset) - 1
+
+
+def count_query_terms(
+    content: str, query_terms: set[str], line_starts: list[int]
+) -> dict[int, Counter[str]]:
+    """The occurrences of the query terms in the lines that contain any
+
+    Each term is searched as a literal over the whole tree, and only its
+    occurrences are checked to be whole words, which is much faster than
+    tokenizing every line or a regex with a lookbehind.
+    """
+    lowered = content.lower()
+    term_freqs: dict[int, Counter[str]] = {}
+    for term in query_terms:
+        pattern = re.compile(re.escape(term) + r"s?(?![a-z0-9])")
+        for match in pattern.finditer(lowered):
+            start = match.start()
+            # not within a word, nor the [id] of a node
+            if start and (
+                lowered[start - 1].isalnum() or lowered[start - 1] == "["
+            ):
+                continue
+            row = get_row(line_starts, start)
+            term_freqs.setdefault(row, Counter())[term] += 1
+    return term_freqs
+
+
+def get_kept_rows(content: str, line_starts: list[int]) -> set[int]:
+    """The lines of the focused node and of the form controls"""
+    # with the newline prepended, a match starts at the offset of its line
+    rows = {
+        get_row(line_starts, match.start())
+        for match in FORM_LINE_PATTERN.finditer(f"\n{content}")
+    }
+    offset = content.find("focused: True")
+    while offset >= 0:
+        rows.add(get_row(line_starts, offset))
+        offset = content.find("focused: True", offset + 1)
+    return rows
+
+
+def bm25_scores(
+    term_freqs: dict[int, Counter[str]],
+    lengths: dict[int, int],
+    num_docs: int,
+    avg_length: float,
+    k1: float = 1.2,
+    b: float = 0.75,
+) -> dict[int, float]:
+    """The Okapi BM25 score of each document with an occurrence of the query
+    terms, from these occurrences and its length"""
+    doc_freqs = Counter(
+        term for freqs in term_freqs.values() for term in freqs
+    )
+    idf = {
+        term: math.log(1 + (num_docs - freq + 0.5) / (freq + 0.5))
+        for term, freq in doc_freqs.items()
+    }
+    scores = {}
+    for row, freqs in term_freqs.items():
+        norm = k1 * (1 - b + b * lengths[row] / (avg_length or 1.0))
+        scores[row] = sum(
+            idf[term] * freq * (k1 + 1) / (freq + norm)
+            for term, freq in freqs.items()
+        )
+    return scores
+
+
+def retrieve_relevant_lines(content: str, query: str, top_k: int) -> str:
+    """Keep the top_k lines of the serialized tree that best match the
+    query, with their ancestors, the focused node and the form controls"""
+    query_terms = set(tokenize(query))
+    lines = content.rstrip("\n").split("\n")
+    if not query_terms or len(lines) <= top_k:
+        return content
+    content = "\n".join(lines)
+
+    line_starts = list(
+        accumulate((len(line) + 1 for line in lines[:-1]), initial=0)
+    )
+    term_freqs = count_query_terms(content, query_terms, line_starts)
+    # the lengths in words, the [id] included, as counted by the spaces
+    scores = bm25_scores(
+        term_freqs,
+        {row: lines[row].count(" ") + 1 for row in term_freqs},
+        len(lines),
+        (content.count(" ") + len(lines)) / len(lines),
+    )
+    selected = set(sorted(scores, key=lambda row: -scores[row])[:top_k])
+    selected.update(get_kept_rows(content, line_starts))
+
+    depths = [len(line) - len(line.lstrip("\t")) for line in lines]
+    parents = get_parents(depths)
+    kept = [False] * len(lines)
+    for row in selected:
+        while row >= 0 and not kept[row]:
+            kept[row] = True
+            row = parents[row]
+    return join_kept_lines(lines, depths, kept)
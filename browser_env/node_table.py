@@ -0,0 +1,178 @@
+"""Compact storage of the node metadata of a text observation
+
+A dict per node, with its own bound list and a copy of its text, adds up
+to megabytes per observation on large pages. NodeTable keeps the same
+information in parallel arrays and one string for all the texts, and
+builds the dict of a node only when it is looked up, so it can be used
+wherever obs_nodes_info was a dict.
+"""
+from collections.abc import Iterator, Mapping
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+
+class NodeTable(Mapping[str, dict[str, Any]]):
+    """The nodes of an observation in document order, by element id
+
+    Each node maps to {"backend_id", "union_bound", "text"}, a missing
+    union_bound is stored as NaN. The bounds are kept in float64, so the
+    element centers are exact, and the backend ids of the html nodes are
+    returned as strings, as their DOM nodes hold them.
+    """
+
+    def __init__(
+        self,
+        element_ids: list[str],
+        backend_ids: list[int],
+        union_bounds: list[list[float] | None],
+        texts: list[str],
+        roles: list[str],
+        parents: list[int],
+        str_backend_ids: bool = False,
+    ) -> None:
+        self.element_ids = element_ids
+        self.str_backend_ids = str_backend_ids
+        self.backend_ids: npt.NDArray[np.int64] = np.array(
+            backend_ids, dtype=np.int64
+        )
+        self.bounds: npt.NDArray[np.float64] = np.array(
+            [
+                bound if bound is not None else [np.nan] * 4
+                for bound in union_bounds
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+        # the text of node i is text[text_offsets[i] : text_offsets[i + 1]]
+        self.text = "".join(texts)
+        self.text_offsets: npt.NDArray[np.int64] = np.zeros(
+            len(texts) + 1, dtype=np.int64
+        )
+        np.cumsum([len(text) for text in texts], out=self.text_offsets[1:])
+        # the distinct roles, or tag names for html
+        self.roles = list(dict.fromkeys(roles))
+        role_idx = {role: idx for idx, role in enumerate(self.roles)}
+        self.role_ids: npt.NDArray[np.uint16] = np.array(
+            [role_idx[role] for role in roles], dtype=np.uint16
+        )
+        # the row of the closest ancestor kept in the table, -1 for none
+        self.parents: npt.NDArray[np.int32] = np.array(parents, dtype=np.int32)
+        # the children of row i, in document order, are the rows
+        # children[child_offsets[i] : child_offsets[i + 1]]
+        child_rows = np.flatnonzero(self.parents >= 0)
+        child_parents = self.parents[child_rows]
+        self.children: npt.NDArray[np.int32] = child_rows[
+            np.argsort(child_parents, kind="stable")
+        ].astype(np.int32)
+        self.child_offsets: npt.NDArray[np.int64] = np.zeros(
+            len(element_ids) + 1, dtype=np.int64
+        )
+        np.cumsum(
+            np.bincount(child_parents, minlength=len(element_ids)),
+            out=self.child_offsets[1:],
+        )
+        self.rows: dict[str, int] | None = None
+
+    def get_row(self, element_id: str) -> int:
+        if self.rows is None:
+            # only built for the observations that are looked up
+            self.rows = {
+                element_id: row
+                for row, element_id in enumerate(self.element_ids)
+            }
+        return self.rows[element_id]
+
+    def get_text(self, row: int) -> str:
+        return self.text[self.text_offsets[row] : self.text_offsets[row + 1]]
+
+    def get_union_bound(self, row: int) -> list[float] | None:
+        bound = self.bounds[row]
+        if np.isnan(bound[0]):
+            return None
+        return [float(value) for value in bound]
+
+    def get_role(self, element_id: str) -> str:
+        return self.roles[int(self.role_ids[self.get_row(element_id)])]
+
+    def get_parent(self, element_id: str) -> str | None:
+        parent = self.parents[self.get_row(element_id)]
+        return self.element_ids[parent] if parent >= 0 else None
+
+    def get_children(self, element_id: str) -> list[str]:
+        row = self.get_row(element_id)
+        return [
+            self.element_ids[child]
+            for child in self.children[
+                self.child_offsets[row] : self.child_offsets[row + 1]
+            ]
+        ]
+
+    def __getitem__(self, element_id: str) -> dict[str, Any]:
+        row = self.get_row(element_id)
+        backend_id = int(self.backend_ids[row])
+        return {
+            "backend_id": str(backend_id)
+            if self.str_backend_ids
+            else backend_id,
+            "union_bound": self.get_union_bound(row),
+            "text": self.get_text(row),
+        }
+
+    def __contains__(self, element_id: object) -> bool:
+        try:
+            self.get_row(element_id)  # type: ignore[arg-type]
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.element_ids)
+
+    def __len__(self) -> int:
+        return len(self.element_ids)
+
+    def __repr__(self) -> str:
+        return f"NodeTable({len(self)} nodes)"
+
+
+class NodeRows:
+    """Collect the nodes of an observation while its tree is serialized"""
+
+    def __init__(self, str_backend_ids: bool = False) -> None:
+        self.str_backend_ids = str_backend_ids
+        self.element_ids: list[str] = []
+        self.backend_ids: list[int] = []
+        self.union_bounds: list[list[float] | None] = []
+        self.texts: list[str] = []
+        self.roles: list[str] = []
+        self.parents: list[int] = []
+
+    def append(
+        self,
+        element_id: str,
+        backend_id: int,
+        union_bound: list[float] | None,
+        text: str,
+        role: str,
+        parent: int,
+    ) -> int:
+        """Add a node, return its row"""
+        self.element_ids.append(element_id)
+        self.backend_ids.append(backend_id)
+        self.union_bounds.append(union_bound)
+        self.texts.append(text)
+        self.roles.append(role)
+        self.parents.append(parent)
+        return len(self.element_ids) - 1
+
+    def to_table(self) -> NodeTable:
+        return NodeTable(
+            self.element_ids,
+            self.backend_ids,
+            self.union_bounds,
+            self.texts,
+            self.roles,
+            self.parents,
+            str_backend_ids=self.str_backend_ids,
+        )
@@ -1,12 +1,29 @@
+import base64
+import copy
 import json
 import re
-from collections import defaultdict
-from typing import Any, TypedDict, Union
+import time
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from typing import (
+    Any,
+    Callable,
+    Mapping,
+    Sequence,
+    TypedDict,
+    Union,
+    cast,
+)
 
 import numpy as np
 import numpy.typing as npt
 from gymnasium import spaces
-from playwright.sync_api import CDPSession, Page, ViewportSize
+from playwright.sync_api import (
+    CDPSession,
+    FloatRect,
+    Page,
+    ViewportSize,
+)
 
 from browser_env.constants import (
     ASCII_CHARSET,
@@ -15,6 +32,14 @@ from browser_env.constants import (
     UTTERANCE_MAX_LENGTH,
 )
 
+from .intent_retrieval import retrieve_relevant_lines
+from .node_table import NodeRows, NodeTable
+from .spatial_index import SpatialIndex
+from .token_budget import (
+    OBS_ESTIMATE_MARGIN,
+    estimate_tokens,
+    fit_to_token_budget,
+)
 from .utils import (
     AccessibilityTree,
     AccessibilityTreeNode,
@@ -23,10 +48,320 @@ from .utils import (
     DOMNode,
     DOMTree,
     Observation,
-    png_bytes_to_numpy,
+    Screenshot,
 )
 
 IN_VIEWPORT_RATIO_THRESHOLD = 0.6
+SCREENSHOT_FORMATS = ("png", "jpeg", "webp")
+SCROLL_OFFSET_JS = "[window.pageXOffset, window.pageYOffset]"
+IGNORED_ACTREE_PROPERTIES_SET = frozenset(IGNORED_ACTREE_PROPERTIES)
+# roles that are not worth a line when they have no name and no properties
+EMPTY_NAME_IGNORED_ROLES = frozenset(
+    [
+        "generic",
+        "img",
+        "list",
+        "strong",
+        "paragraph",
+        "banner",
+        "navigation",
+        "Section",
+        "LabelText",
+        "Legend",
+        "listitem",
+    ]
+)
+
+
+# installed in the page by the incremental observation mode and the settle
+# detector, it counts the DOM mutations and form edits since it was installed
+# in the document. Returns [version, scrollX, scrollY, msSinceLastChange], a
+# version of -1 means the tracker was just installed, e.g. after a navigation
+DOM_CHANGE_TRACKER_JS = """() => {
+    const tracker = window.__webarenaDomTracker;
+    if (tracker !== undefined) {
+        return [
+            tracker.version,
+            window.pageXOffset,
+            window.pageYOffset,
+            performance.now() - tracker.lastChange,
+        ];
+    }
+    const newTracker = { version: 0, lastChange: performance.now() };
+    const bump = () => {
+        newTracker.version += 1;
+        newTracker.lastChange = performance.now();
+    };
+    new MutationObserver(bump).observe(document, {
+        subtree: true,
+        childList: true,
+        attributes: true,
+        characterData: true,
+    });
+    for (const type of ["input", "change", "focusin", "focusout", "toggle"]) {
+        document.addEventListener(type, bump, true);
+    }
+    window.__webarenaDomTracker = newTracker;
+    return [-1, window.pageXOffset, window.pageYOffset, 0];
+}"""
+
+# the state of the page an observation needs, in a single evaluation:
+# [scrollX, scrollY, screenWidth, screenHeight, devicePixelRatio, title,
+# the state of the DOM change tracker or null when not requested]
+PAGE_PROBE_JS = (
+    "(withTracker) => [window.pageXOffset, window.pageYOffset, "
+    "window.screen.width, window.screen.height, window.devicePixelRatio, "
+    "document.title, withTracker ? (" + DOM_CHANGE_TRACKER_JS + ")() : null]"
+)
+
+
+class PageProbe(TypedDict):
+    scroll_x: float
+    scroll_y: float
+    win_width: float
+    win_height: float
+    device_pixel_ratio: float
+    title: str
+    tracker_state: list[Any] | None
+
+
+def make_page_probe(result: list[Any]) -> PageProbe:
+    (
+        scroll_x,
+        scroll_y,
+        win_width,
+        win_height,
+        device_pixel_ratio,
+        title,
+        tracker_state,
+    ) = result
+    return {
+        "scroll_x": scroll_x,
+        "scroll_y": scroll_y,
+        "win_width": win_width,
+        "win_height": win_height,
+        "device_pixel_ratio": device_pixel_ratio,
+        "title": title,
+        "tracker_state": tracker_state,
+    }
+
+
+def get_target_titles(targets: dict[str, Any]) -> dict[str, str]:
+    """The titles of the page targets returned by Target.getTargets, by id"""
+    titles = {}
+    for target in targets["targetInfos"]:
+        # chromium reports the url as the title of untitled pages
+        title = target["title"]
+        titles[target["targetId"]] = "" if title == target["url"] else title
+    return titles
+
+
+# the Magento admin shows this notice on the tabs of its forms, it is part
+# of the name of several nodes and never useful
+MAGENTO_INVALID_TAB_NOTICE = (
+    "The information in this tab has been changed. This tab contains invalid "
+    "data. Please resolve this before saving. Loading... "
+)
+
+REDUCTION_ACTIONS = ("drop", "collapse", "summarize", "strip")
+
+
+@dataclass
+class ReductionRule:
+    """Reduce the nodes of the pages whose url matches url_pattern (all
+    pages by default) that match all the given selectors
+
+        drop       remove the node and its subtree
+        collapse   keep the node, marked as collapsed, without its subtree
+        summarize  replace the node and its subtree with the summary line
+        strip      remove the matches of name_pattern from the node name
+
+    The role is the accessibility role, or the tag name of an html node,
+    and the attributes are its serialized properties or attributes.
+    """
+
+    name: str
+    action: str
+    url_pattern: str | None = None
+    role: str | None = None
+    name_pattern: str | None = None
+    attribute_pattern: str | None = None
+    summary: str = ""
+
+    def __post_init__(self) -> None:
+        if self.action not in REDUCTION_ACTIONS:
+            raise ValueError(f"Unsupported reduction action: {self.action}")
+        if not (self.role or self.name_pattern or self.attribute_pattern):
+            raise ValueError(f"The reduction rule {self.name} selects nothing")
+        if self.action == "strip" and not self.name_pattern:
+            raise ValueError("A strip rule needs a name_pattern")
+        self.url_regex = (
+            re.compile(self.url_pattern) if self.url_pattern else None
+        )
+        self.name_regex = (
+            re.compile(self.name_pattern) if self.name_pattern else None
+        )
+        self.attribute_regex = (
+            re.compile(self.attribute_pattern)
+            if self.attribute_pattern
+            else None
+        )
+        self.role_key = self.role.lower() if self.role else None
+
+    def applies_to(self, url: str) -> bool:
+        return self.url_regex is None or bool(self.url_regex.search(url))
+
+    def matches(self, role: str, name: str, attributes: str) -> bool:
+        return (
+            (self.role_key is None or role.lower() == self.role_key)
+            and (self.name_regex is None or bool(self.name_regex.search(name)))
+            and (
+                self.attribute_regex is None
+                or bool(self.attribute_regex.search(attributes))
+            )
+        )
+
+    def strip(self, name: str) -> str:
+        assert self.name_regex is not None
+        return self.name_regex.sub("", name)
+
+
+def match_reduction_rule(
+    rules: Sequence[ReductionRule], role: str, name: str, attributes: str
+) -> ReductionRule | None:
+    for rule in rules:
+        if rule.matches(role, name, attributes):
+            return rule
+    return None
+
+
+@dataclass
+class ReductionStats:
+    """The estimated tokens each rule removed from the observations"""
+
+    tokens_saved: Counter[str] = field(default_factory=Counter)
+    reduced_nodes: Counter[str] = field(default_factory=Counter)
+
+    def add(self, rule: ReductionRule, removed: str, added: str = "") -> None:
+        self.tokens_saved[rule.name] += estimate_tokens(
+            removed
+        ) - estimate_tokens(added)
+        self.reduced_nodes[rule.name] += 1
+
+    def __str__(self) -> str:
+        saved = ", ".join(
+            f"{name}: {tokens} tokens from {self.reduced_nodes[name]} nodes"
+            for name, tokens in self.tokens_saved.most_common()
+        )
+        return f"saved {sum(self.tokens_saved.values())} tokens ({saved})"
+
+
+@dataclass
+class ObservationLatency:
+    """The time the text observations took by how they were produced:
+    reused unchanged, re-sliced after a scroll, or fetched and rebuilt"""
+
+    counts: Counter[str] = field(default_factory=Counter)
+    seconds: dict[str, float] = field(default_factory=dict)
+
+    def add(self, kind: str, seconds: float) -> None:
+        self.counts[kind] += 1
+        self.seconds[kind] = self.seconds.get(kind, 0.0) + seconds
+
+    def __str__(self) -> str:
+        return ", ".join(
+            f"{kind}: {count} in {self.seconds[kind] / count * 1000:.1f} ms "
+            "on average"
+            for kind, count in self.counts.most_common()
+        )
+
+
+def apply_reduction_rule(
+    rule: ReductionRule | None,
+    removed_by: ReductionRule | None,
+    indent: str,
+    node_str: str,
+    valid_node: bool,
+    stats: "ReductionStats",
+) -> tuple[str | None, bool]:
+    """Reduce a node in the walk of its tree, return the line to output, if
+    any, and whether the node is kept in the observation. The children of
+    a node reduced by a rule other than strip are removed_by that rule."""
+    line = f"{indent}{node_str}"
+    if removed_by is not None:
+        if valid_node:
+            stats.add(removed_by, line)
+        return None, False
+    if rule is None or rule.action == "strip":
+        return (line if valid_node else None), valid_node
+    if rule.action == "drop":
+        if valid_node:
+            stats.add(rule, line)
+        return None, False
+    if rule.action == "summarize":
+        summary_line = f"{indent}[{rule.summary}]"
+        stats.add(rule, line if valid_node else "", summary_line)
+        return summary_line, False
+    # a collapsed node is kept even without a name, to show what is hidden
+    collapsed_line = f"{line} [collapsed]"
+    stats.add(rule, line if valid_node else "", collapsed_line)
+    return collapsed_line, True
+
+
+def default_reduction_rules(
+    site_urls: Mapping[str, str] | None = None, site_chrome: bool = False
+) -> list[ReductionRule]:
+    """The Magento notice is removed from every page. With site_chrome, the
+    menus and footers repeated on every page of the sites in site_urls, by
+    site name as in env_config, are reduced too, the agent then cannot
+    navigate with the collapsed menus."""
+    rules = [
+        ReductionRule(
+            "magento_notice",
+            "strip",
+            name_pattern=re.escape(MAGENTO_INVALID_TAB_NOTICE),
+        )
+    ]
+    if not site_chrome or site_urls is None:
+        return rules
+
+    site_rules = {
+        "shopping_admin": ReductionRule(
+            "magento_admin_menu", "collapse", role="navigation"
+        ),
+        "gitlab": ReductionRule(
+            "gitlab_sidebar",
+            "collapse",
+            role="complementary",
+            name_pattern=r"^(Project|Group) navigation$",
+        ),
+        "reddit": ReductionRule(
+            "postmill_footer",
+            "summarize",
+            role="contentinfo",
+            summary="site footer",
+        ),
+        "map": ReductionRule(
+            "osm_attribution",
+            "drop",
+            role="link",
+            name_pattern=(
+                r"^(Leaflet|OpenStreetMap contributors|Make a Donation|"
+                r"Website and API terms)$"
+            ),
+        ),
+    }
+    for site, rule in site_rules.items():
+        if site_urls.get(site):
+            rules.append(
+                replace(rule, url_pattern="^" + re.escape(site_urls[site]))
+            )
+    return rules
+
+
+# the rules of the envs built without reduction_rules, pass () to keep the
+# observations as the browser renders them
+DEFAULT_REDUCTION_RULES = tuple(default_reduction_rules())
 
 
 class ObservationProcessor:
@@ -35,12 +370,16 @@ class ObservationProcessor:
 
 
 class ObservationMetadata(TypedDict):
-    obs_nodes_info: dict[str, Any]
+    # a NodeTable, or an empty dict before the first observation
+    obs_nodes_info: Mapping[str, Any]
+    # maps the coordinates of the viewport back to the obs_nodes_info ids
+    spatial_index: SpatialIndex | None
 
 
 def create_empty_metadata() -> ObservationMetadata:
     return {
         "obs_nodes_info": {},
+        "spatial_index": None,
     }
 
 
@@ -50,45 +389,171 @@ class TextObervationProcessor(ObservationProcessor):
         observation_type: str,
         current_viewport_only: bool,
         viewport_size: ViewportSize,
+        incremental: bool = False,
+        max_obs_tokens: int | None = None,
+        reduction_rules: Sequence[ReductionRule] = DEFAULT_REDUCTION_RULES,
+        retrieval_top_k: int | None = None,
     ):
         self.observation_type = observation_type
         self.current_viewport_only = current_viewport_only
         self.viewport_size = viewport_size
         self.observation_tag = "text"
+        # the lines of the tree past the budget are dropped by priority, the
+        # budget includes the titles of the tabs
+        self.max_obs_tokens = max_obs_tokens
+        self.tab_title_tokens = 0
+        self.reduction_rules = list(reduction_rules)
+        # the rules of the url of the page being processed
+        self.page_rules: list[ReductionRule] = []
+        self.reduction_stats = ReductionStats()
+        # only the lines that best match the intent of the task and the
+        # previous action are kept, with the form controls
+        self.retrieval_top_k = retrieval_top_k
+        self.retrieval_query = ""
         self.meta_data = (
             create_empty_metadata()
         )  # use the store meta data of this observation type
+        # reuse the previous observation when the page did not change at
+        # all, any DOM mutation rebuilds the whole tree, since it may move
+        # the bounds of the nodes outside of the mutated subtree.
+        # CSS-only changes (e.g. :hover menus) are not tracked, the envs
+        # call invalidate_cache after the actions that move the mouse
+        self.incremental = incremental
+        self.latency = ObservationLatency()
+        self.cached_page_state: tuple[Any, ...] | None = None
+        self.page_state: tuple[Any, ...] | None = None
+        self.cached_content = ""
+        # the snapshot and the unfiltered accessibility tree of the last
+        # fetch with the state of the page they were fetched at, a scroll
+        # only re-slices them
+        self.full_page_cache: tuple[
+            tuple[Any, ...], BrowserInfo, AccessibilityTree | None
+        ] | None = None
+
+    def invalidate_cache(self) -> None:
+        """Fetch the page again on the next observation"""
+        self.cached_page_state = None
+        self.full_page_cache = None
+
+    def get_page_rules(self, url: str) -> list[ReductionRule]:
+        return [rule for rule in self.reduction_rules if rule.applies_to(url)]
+
+    def set_retrieval_query(
+        self, intent: str, previous_action: str = ""
+    ) -> None:
+        query = f"{intent} {previous_action}".strip()
+        if self.retrieval_top_k is not None and query != self.retrieval_query:
+            # the cached observation was retrieved with the previous query
+            self.invalidate_cache()
+        self.retrieval_query = query
+
+    @property
+    def reslices_on_scroll(self) -> bool:
+        return self.incremental and self.current_viewport_only
+
+    def probe_page(self, page: Page) -> PageProbe:
+        """Read the geometry and title of the page, and the DOM change
+        tracker in the incremental mode, in a single round trip"""
+        return make_page_probe(page.evaluate(PAGE_PROBE_JS, self.incremental))
 
     def fetch_browser_info(
         self,
         page: Page,
         client: CDPSession,
+        probe: PageProbe | None = None,
     ) -> BrowserInfo:
         # extract domtree
         tree = client.send(
             "DOMSnapshot.captureSnapshot",
             {
-                "computedStyles": [],
+                "computedStyles": self.snapshot_styles,
                 "includeDOMRects": True,
                 "includePaintOrder": True,
             },
         )
 
+        # extract browser info
+        if probe is None:
+            probe = self.probe_page(page)
+        return self.make_browser_info(
+            tree,
+            win_top_bound=probe["scroll_y"],
+            win_left_bound=probe["scroll_x"],
+            win_width=probe["win_width"],
+            win_height=probe["win_height"],
+            device_pixel_ratio=probe["device_pixel_ratio"],
+        )
+
+    @property
+    def snapshot_styles(self) -> list[str]:
+        # re-slicing needs to know which nodes do not move when scrolling
+        return ["position"] if self.reslices_on_scroll else []
+
+    def make_browser_info(
+        self,
+        tree: dict[str, Any],
+        win_top_bound: float,
+        win_left_bound: float,
+        win_width: float,
+        win_height: float,
+        device_pixel_ratio: float,
+    ) -> BrowserInfo:
         # calibrate the bounds, in some cases, the bounds are scaled somehow
-        bounds = tree["documents"][0]["layout"]["bounds"]
-        b = bounds[0]
-        n = b[2] / self.viewport_size["width"]
-        bounds = [[x / n for x in bound] for bound in bounds]
-        tree["documents"][0]["layout"]["bounds"] = bounds
+        layout = tree["documents"][0]["layout"]
+        bounds = np.asarray(layout["bounds"], dtype=np.float64).reshape(-1, 4)
+        if len(bounds) and bounds[0, 2] > 0:
+            bounds /= bounds[0, 2] / self.viewport_size["width"]
+        layout["bounds"] = bounds
+        if layout.get("styles"):
+            self.mark_fixed_nodes(tree, win_left_bound, win_top_bound)
+
+        info: BrowserInfo = {
+            "DOMTree": tree,
+            "config": self.make_browser_config(
+                win_top_bound,
+                win_left_bound,
+                win_width,
+                win_height,
+                device_pixel_ratio,
+            ),
+        }
+        return info
 
-        # extract browser info
-        win_top_bound = page.evaluate("window.pageYOffset")
-        win_left_bound = page.evaluate("window.pageXOffset")
-        win_width = page.evaluate("window.screen.width")
-        win_height = page.evaluate("window.screen.height")
+    @staticmethod
+    def mark_fixed_nodes(
+        tree: dict[str, Any], scroll_x: float, scroll_y: float
+    ) -> None:
+        """Mark the nodes of the main document that are positioned relative
+        to the viewport, from the `position` computed style of the snapshot,
+        together with the scroll offsets of the snapshot"""
+        strings = tree["strings"]
+        document = tree["documents"][0]
+        layout = document["layout"]
+        parent_idx = document["nodes"]["parentIndex"]
+        fixed = [False] * len(parent_idx)
+        has_sticky = False
+        for node_idx, style in zip(layout["nodeIndex"], layout["styles"]):
+            position = strings[style[0]] if style else ""
+            fixed[node_idx] = fixed[node_idx] or position == "fixed"
+            has_sticky = has_sticky or position == "sticky"
+        # parents come before their children in the snapshot
+        for node_idx, parent in enumerate(parent_idx):
+            if parent != -1 and fixed[parent]:
+                fixed[node_idx] = True
+        document["fixed"] = np.asarray(fixed, dtype=bool)
+        document["has_sticky"] = has_sticky
+        tree["scroll_offset"] = (scroll_x, scroll_y)
+
+    @staticmethod
+    def make_browser_config(
+        win_top_bound: float,
+        win_left_bound: float,
+        win_width: float,
+        win_height: float,
+        device_pixel_ratio: float,
+    ) -> BrowserConfig:
         win_right_bound = win_left_bound + win_width
         win_lower_bound = win_top_bound + win_height
-        device_pixel_ratio = page.evaluate("window.devicePixelRatio")
         assert device_pixel_ratio == 1.0, "devicePixelRatio is not 1.0"
 
         config: BrowserConfig = {
@@ -100,11 +565,7 @@ class TextObervationProcessor(ObservationProcessor):
             "win_lower_bound": win_lower_bound,
             "device_pixel_ratio": device_pixel_ratio,
         }
-
-        # assert len(tree['documents']) == 1, "More than one document in the DOM tree"
-        info: BrowserInfo = {"DOMTree": tree, "config": config}
-
-        return info
+        return config
 
     @staticmethod
     def get_bounding_client_rect(
@@ -139,14 +600,63 @@ class TextObervationProcessor(ObservationProcessor):
         except Exception as e:
             return {"result": {"subtype": "error"}}
 
+    @staticmethod
+    def get_layout_bounds(info: BrowserInfo) -> npt.NDArray[np.float64]:
+        """Return the (N, 4) bounds of the nodes in the main document,
+        indexed like the snapshot nodes. Rows of nodes without a layout
+        object are NaN. The snapshot bounds are in document coordinates,
+        they are shifted by the scroll offsets to match
+        `getBoundingClientRect`"""
+        document = info["DOMTree"]["documents"][0]
+        num_nodes = len(document["nodes"]["backendNodeId"])
+        layout = document["layout"]
+        config = info["config"]
+
+        bounds = np.full((num_nodes, 4), np.nan, dtype=np.float64)
+        if len(layout["nodeIndex"]):
+            layout_node_idx = np.asarray(layout["nodeIndex"], dtype=np.int64)
+            layout_bounds = np.asarray(
+                layout["bounds"], dtype=np.float64
+            ).reshape(-1, 4)
+            # a node can own several layout objects, keep the first one
+            node_idx, first = np.unique(layout_node_idx, return_index=True)
+            bounds[node_idx] = layout_bounds[first]
+        fixed = document.get("fixed", None)
+        if fixed is not None and fixed.any():
+            # the fixed nodes stay where they were in the viewport
+            scroll_x, scroll_y = info["DOMTree"]["scroll_offset"]
+            bounds[fixed, 0] += config["win_left_bound"] - scroll_x
+            bounds[fixed, 1] += config["win_top_bound"] - scroll_y
+        bounds[:, 0] -= config["win_left_bound"]
+        bounds[:, 1] -= config["win_top_bound"]
+        return bounds
+
+    @staticmethod
+    def get_backend_node_bounds(info: BrowserInfo) -> dict[int, list[float]]:
+        """Map the backend node ids of the main document to their bounds"""
+        document = info["DOMTree"]["documents"][0]
+        backend_node_ids = document["nodes"]["backendNodeId"]
+        bounds = TextObervationProcessor.get_layout_bounds(info)
+        has_layout = np.flatnonzero(~np.isnan(bounds[:, 0]))
+        return {
+            backend_node_ids[idx]: bound
+            for idx, bound in zip(
+                has_layout.tolist(), bounds[has_layout].tolist()
+            )
+        }
+
     @staticmethod
     def get_element_in_viewport_ratio(
-        elem_left_bound: float,
-        elem_top_bound: float,
-        width: float,
-        height: float,
+        bounds: npt.NDArray[np.float64],
         config: BrowserConfig,
-    ) -> float:
+    ) -> npt.NDArray[np.float64]:
+        """Compute the fraction of each element's area that is inside the
+        viewport. `bounds` is an (N, 4) array of viewport-relative
+        [x, y, width, height] rows, NaN rows and empty elements get 0"""
+        elem_left_bound = bounds[:, 0]
+        elem_top_bound = bounds[:, 1]
+        width = bounds[:, 2]
+        height = bounds[:, 3]
         elem_right_bound = elem_left_bound + width
         elem_lower_bound = elem_top_bound + height
 
@@ -156,21 +666,40 @@ class TextObervationProcessor(ObservationProcessor):
         win_lower_bound = config["win_height"]
 
         # Compute the overlap in x and y axes
-        overlap_width = max(
+        overlap_width = np.clip(
+            np.minimum(elem_right_bound, win_right_bound)
+            - np.maximum(elem_left_bound, win_left_bound),
             0,
-            min(elem_right_bound, win_right_bound)
-            - max(elem_left_bound, win_left_bound),
+            None,
         )
-        overlap_height = max(
+        overlap_height = np.clip(
+            np.minimum(elem_lower_bound, win_lower_bound)
+            - np.maximum(elem_top_bound, win_top_bound),
             0,
-            min(elem_lower_bound, win_lower_bound)
-            - max(elem_top_bound, win_top_bound),
+            None,
         )
 
-        # Compute the overlap area
-        ratio = overlap_width * overlap_height / width * height
+        # Compute the overlap area relative to the element area
+        area = width * height
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(
+                area > 0, overlap_width * overlap_height / area, 0.0
+            )
         return ratio
 
+    @staticmethod
+    def get_in_viewport_mask(
+        bounds: npt.NDArray[np.float64], config: BrowserConfig
+    ) -> npt.NDArray[np.bool_]:
+        """Return which of the (N, 4) bounds are visible in the viewport,
+        nodes without bounds and invisible (empty) nodes are not"""
+        in_viewport_ratio = (
+            TextObervationProcessor.get_element_in_viewport_ratio(
+                bounds, config
+            )
+        )
+        return in_viewport_ratio >= IN_VIEWPORT_RATIO_THRESHOLD
+
     def fetch_page_html(
         self,
         info: BrowserInfo,
@@ -183,182 +712,156 @@ class TextObervationProcessor(ObservationProcessor):
         strings = tree["strings"]
         document = tree["documents"][0]
         nodes = document["nodes"]
-
-        # make a dom tree that is easier to navigate
+        num_strings = len(strings)
+
+        # keep the node columns as index arrays into the shared string table
+        node_names = np.asarray(nodes["nodeName"], dtype=np.int64)
+        node_values = np.asarray(nodes["nodeValue"], dtype=np.int64)
+        node_types = np.asarray(nodes["nodeType"], dtype=np.int64)
+        backend_node_ids = np.asarray(nodes["backendNodeId"], dtype=np.int64)
+        parent_idx = np.asarray(nodes["parentIndex"], dtype=np.int64)
+        num_nodes = len(node_names)
+        attributes = nodes["attributes"]
+
+        bounds = self.get_layout_bounds(info)
+        # the root is always inside the viewport
+        bounds[parent_idx == -1] = [0.0, 0.0, 10.0, 10.0]
+        has_bound = ~np.isnan(bounds[:, 0])
+
+        keep = np.ones(num_nodes, dtype=bool)
+        # remove the nodes that are not in the current viewport
+        if current_viewport_only:
+            keep = self.get_in_viewport_mask(bounds, info["config"])
+            keep[parent_idx == -1] = True
+
+        # attach every kept node to its closest kept ancestor, the snapshot
+        # lists the nodes in document order so parents come before children
+        kept_parent = parent_idx.tolist()
+        is_kept = keep.tolist()
+        for node_idx in range(num_nodes):
+            parent = kept_parent[node_idx]
+            if parent != -1 and not is_kept[parent]:
+                kept_parent[node_idx] = kept_parent[parent]
+
+        # materialize the strings of the surviving nodes only
         dom_tree: DOMTree = []
-        graph = defaultdict(list)
-        for node_idx in range(len(nodes["nodeName"])):
-            cur_node: DOMNode = {
-                "nodeId": "",
-                "nodeType": "",
-                "nodeName": "",
-                "nodeValue": "",
-                "attributes": "",
-                "backendNodeId": "",
-                "parentId": "",
-                "childIds": [],
-                "cursor": 0,
-                "union_bound": None,
-            }
-
-            node_type_idx = nodes["nodeType"][node_idx]
-            node_type = "generic"
-            if node_type_idx >= 0 and node_type_idx < len(strings):
-                node_type = strings[node_type_idx]
-
-            node_name = strings[nodes["nodeName"][node_idx]]
-
-            node_value_idx = nodes["nodeValue"][node_idx]
+        cursors: dict[int, int] = {}
+        for node_idx in np.flatnonzero(keep).tolist():
             node_value = ""
-            if node_value_idx >= 0 and node_value_idx < len(strings):
+            node_value_idx = node_values[node_idx]
+            if 0 <= node_value_idx < num_strings:
                 node_value = " ".join(strings[node_value_idx].split())
 
-            node_attributes = [
-                strings[i] for i in nodes["attributes"][node_idx]
-            ]
-            node_attributes_str = ""
-            for i in range(0, len(node_attributes), 2):
-                a = node_attributes[i]
-                b = node_attributes[i + 1]
-                b = " ".join(b.split())
-                node_attributes_str += f'{a}="{b}" '
-            node_attributes_str = node_attributes_str.strip()
-
-            cur_node["nodeId"] = str(node_idx)
-            cur_node["nodeType"] = node_type
-            cur_node["nodeName"] = node_name
-            cur_node["nodeValue"] = node_value
-            cur_node["attributes"] = node_attributes_str
-            cur_node["backendNodeId"] = str(nodes["backendNodeId"][node_idx])
-            cur_node["parentId"] = str(nodes["parentIndex"][node_idx])
-
-            if cur_node["parentId"] != "-1":
-                graph[cur_node["parentId"]].append(str(cur_node["nodeId"]))
-
-            # get the bound
-            if cur_node["parentId"] == "-1":
-                cur_node["union_bound"] = [0.0, 0.0, 10.0, 10.0]
-            else:
-                response = self.get_bounding_client_rect(
-                    client, cur_node["backendNodeId"]
-                )
-                if response.get("result", {}).get("subtype", "") == "error":
-                    cur_node["union_bound"] = None
-                else:
-                    x = response["result"]["value"]["x"]
-                    y = response["result"]["value"]["y"]
-                    width = response["result"]["value"]["width"]
-                    height = response["result"]["value"]["height"]
-                    cur_node["union_bound"] = [x, y, width, height]
+            node_attributes = attributes[node_idx]
+            node_attributes_str = " ".join(
+                f'{strings[node_attributes[i]]}="'
+                f'{" ".join(strings[node_attributes[i + 1]].split())}"'
+                for i in range(0, len(node_attributes), 2)
+            )
 
+            parent = kept_parent[node_idx]
+            cur_node: DOMNode = {
+                "nodeId": str(node_idx),
+                "nodeType": str(node_types[node_idx]),
+                "nodeName": strings[node_names[node_idx]],
+                "nodeValue": node_value,
+                "attributes": node_attributes_str,
+                "backendNodeId": str(backend_node_ids[node_idx]),
+                "parentId": str(parent),
+                "childIds": [],
+                "cursor": len(dom_tree),
+                "union_bound": bounds[node_idx].tolist()
+                if has_bound[node_idx]
+                else None,
+            }
+            if parent != -1:
+                dom_tree[cursors[parent]]["childIds"].append(str(node_idx))
+            cursors[node_idx] = len(dom_tree)
             dom_tree.append(cur_node)
 
-        # add parent children index to the node
-        for parent_id, child_ids in graph.items():
-            dom_tree[int(parent_id)]["childIds"] = child_ids
-
-        # remove the nodes that are not in the current viewport
-        if current_viewport_only:
-
-            def remove_node_in_graph(node: DOMNode) -> None:
-                # update the node information in the accessibility tree
-                node_id = node["nodeId"]
-                parent_id = node["parentId"]
-                child_ids = node["childIds"]
-
-                # update the children of the parent node
-                assert dom_tree[int(parent_id)]["parentId"] != "[REMOVED]"
-                # remove the nodeid from parent
-                index = dom_tree[int(parent_id)]["childIds"].index(node_id)
-                dom_tree[int(parent_id)]["childIds"].pop(index)
-
-                # Insert children_nodeids in the same location
-                for child_id in child_ids:
-                    dom_tree[int(parent_id)]["childIds"].insert(
-                        index, child_id
-                    )
-                    index += 1
-
-                # update children node's parent
-                for child_id in child_ids:
-                    dom_tree[int(child_id)]["parentId"] = parent_id
-                # mark as removed
-                dom_tree[int(node_id)]["parentId"] = "[REMOVED]"
-
-            config = info["config"]
-            for cursor, node in enumerate(dom_tree):
-                if not node["union_bound"]:
-                    remove_node_in_graph(node)
-                    continue
-
-                [x, y, width, height] = node["union_bound"]
-
-                # invisible node
-                if width == 0.0 or height == 0.0:
-                    remove_node_in_graph(node)
-                    continue
-
-                in_viewport_ratio = self.get_element_in_viewport_ratio(
-                    elem_left_bound=float(x),
-                    elem_top_bound=float(y),
-                    width=float(width),
-                    height=float(height),
-                    config=config,
-                )
-
-                if in_viewport_ratio < IN_VIEWPORT_RATIO_THRESHOLD:
-                    remove_node_in_graph(node)
-
-            dom_tree = [
-                node
-                for node in dom_tree
-                if node.get("parentId", "-1") != "[REMOVED]"
-            ]
-
         return dom_tree
 
     @staticmethod
-    def parse_html(dom_tree: DOMTree) -> tuple[str, dict[str, Any]]:
-        """Parse the html tree into a string text"""
-
-        obs_nodes_info = {}
+    def parse_html(
+        dom_tree: DOMTree,
+        rules: Sequence[ReductionRule] = (),
+        stats: ReductionStats | None = None,
+    ) -> tuple[str, NodeTable]:
+        """Parse the html tree into a string text, reduced by the rules in
+        the same walk"""
+
+        # the DOM nodes hold their backend ids as strings
+        node_rows = NodeRows(str_backend_ids=True)
+        if stats is None:
+            stats = ReductionStats()
         nodeid_to_cursor = {
             node["nodeId"]: idx for idx, node in enumerate(dom_tree)
         }
 
-        def dfs(node_cursor: int, depth: int) -> str:
-            tree_str = ""
+        # iterative dfs, the stack holds (node_cursor, depth, parent_row,
+        # the rule removing the node with its ancestor, if any)
+        lines: list[str] = []
+        stack: list[tuple[int, int, int, ReductionRule | None]] = [
+            (0, 0, -1, None)
+        ]
+        while stack:
+            node_cursor, depth, parent_row, removed_by = stack.pop()
             node = dom_tree[node_cursor]
             indent = "\t" * depth
             valid_node = True
+            row = parent_row
+            rule = None
             try:
+                node_value = node["nodeValue"]
+                if rules and removed_by is None:
+                    rule = match_reduction_rule(
+                        rules, node["nodeName"], node_value, node["attributes"]
+                    )
+                if rule is not None and rule.action == "strip":
+                    stripped_value = rule.strip(node_value)
+                    stats.add(rule, node_value, stripped_value)
+                    node_value = stripped_value
+
                 node_str = f"[{node_cursor}] <{node['nodeName']}"
                 if node["attributes"]:
                     node_str += f" {node['attributes']}"
-                node_str += f"> {node['nodeValue']}"
-                valid_node = bool(node["attributes"] or node["nodeValue"])
+                node_str += f"> {node_value}"
+                valid_node = bool(node["attributes"] or node_value)
 
+                line, valid_node = apply_reduction_rule(
+                    rule, removed_by, indent, node_str, valid_node, stats
+                )
+                if line is not None:
+                    lines.append(f"{line}\n")
                 if valid_node:
-                    obs_nodes_info[str(node_cursor)] = {
-                        "backend_id": node["backendNodeId"],
-                        "union_bound": node["union_bound"],
-                        "text": node_str,
-                    }
-                    tree_str += f"{indent}{node_str}\n"
+                    row = node_rows.append(
+                        str(node_cursor),
+                        int(node["backendNodeId"]),
+                        node["union_bound"],
+                        node_str,
+                        node["nodeName"],
+                        parent_row,
+                    )
 
             except Exception as e:
                 valid_node = False
 
-            for child_ids in node["childIds"]:
-                child_cursor = nodeid_to_cursor[child_ids]
-                child_depth = depth + 1 if valid_node else depth
-                child_str = dfs(child_cursor, child_depth)
-                tree_str += child_str
-
-            return tree_str
+            child_depth = depth + 1 if valid_node else depth
+            child_removed_by = removed_by
+            if rule is not None and rule.action != "strip":
+                child_removed_by = rule
+            for child_ids in reversed(node["childIds"]):
+                stack.append(
+                    (
+                        nodeid_to_cursor[child_ids],
+                        child_depth,
+                        row,
+                        child_removed_by,
+                    )
+                )
 
-        html = dfs(0, 0)
-        return html, obs_nodes_info
+        html = "".join(lines)
+        return html, node_rows.to_table()
 
     def fetch_page_accessibility_tree(
         self,
@@ -369,7 +872,45 @@ class TextObervationProcessor(ObservationProcessor):
         accessibility_tree: AccessibilityTree = client.send(
             "Accessibility.getFullAXTree", {}
         )["nodes"]
+        accessibility_tree, fallback_cursors = self.join_accessibility_bounds(
+            accessibility_tree, info
+        )
+        for cursor in fallback_cursors:
+            node = accessibility_tree[cursor]
+            response = self.get_bounding_client_rect(
+                client, str(node["backendDOMNodeId"])
+            )
+            self.set_client_rect_bound(node, response)
+
+        # filter nodes that are not in the current viewport
+        if current_viewport_only:
+            accessibility_tree = self.slice_accessibility_tree(
+                accessibility_tree, info
+            )
 
+        return accessibility_tree
+
+    def slice_accessibility_tree(
+        self, accessibility_tree: AccessibilityTree, info: BrowserInfo
+    ) -> AccessibilityTree:
+        """Filter the fetched tree to the viewport, the full tree is kept
+        for re-slicing when the page is only scrolled"""
+        if self.reslices_on_scroll:
+            self.cache_full_page(info, accessibility_tree)
+            # pruning rewires the children of the nodes
+            accessibility_tree = [
+                copy.copy(node) for node in accessibility_tree
+            ]
+        return self.filter_accessibility_tree(
+            accessibility_tree, info["config"]
+        )
+
+    def join_accessibility_bounds(
+        self, accessibility_tree: AccessibilityTree, info: BrowserInfo
+    ) -> tuple[AccessibilityTree, list[int]]:
+        """Deduplicate the nodes and set their bounds from the snapshot.
+        Returns the tree and the cursors of the nodes that need their bounds
+        from a per-node CDP round trip"""
         # a few nodes are repeated in the accessibility tree
         seen_ids = set()
         _accessibility_tree = []
@@ -379,121 +920,133 @@ class TextObervationProcessor(ObservationProcessor):
                 seen_ids.add(node["nodeId"])
         accessibility_tree = _accessibility_tree
 
-        nodeid_to_cursor = {}
+        # join the backend node ids against the layout of the snapshot,
+        # the per-node CDP round trips are only used as a fallback
+        backend_id_to_bound = self.get_backend_node_bounds(info)
+
+        fallback_cursors = []
         for cursor, node in enumerate(accessibility_tree):
-            nodeid_to_cursor[node["nodeId"]] = cursor
             # usually because the node is not visible etc
             if "backendDOMNodeId" not in node:
                 node["union_bound"] = None
                 continue
-            backend_node_id = str(node["backendDOMNodeId"])
+            backend_node_id = node["backendDOMNodeId"]
             if node["role"]["value"] == "RootWebArea":
                 # always inside the viewport
                 node["union_bound"] = [0.0, 0.0, 10.0, 10.0]
-            else:
-                response = self.get_bounding_client_rect(
-                    client, backend_node_id
-                )
-                if response.get("result", {}).get("subtype", "") == "error":
-                    node["union_bound"] = None
-                else:
-                    x = response["result"]["value"]["x"]
-                    y = response["result"]["value"]["y"]
-                    width = response["result"]["value"]["width"]
-                    height = response["result"]["value"]["height"]
-                    node["union_bound"] = [x, y, width, height]
-
-        # filter nodes that are not in the current viewport
-        if current_viewport_only:
-
-            def remove_node_in_graph(node: AccessibilityTreeNode) -> None:
-                # update the node information in the accessibility tree
-                nodeid = node["nodeId"]
-                node_cursor = nodeid_to_cursor[nodeid]
-                parent_nodeid = node["parentId"]
-                children_nodeids = node["childIds"]
-                parent_cursor = nodeid_to_cursor[parent_nodeid]
-                # update the children of the parent node
-                assert (
-                    accessibility_tree[parent_cursor].get("parentId", "Root")
-                    is not None
-                )
-                # remove the nodeid from parent's childIds
-                index = accessibility_tree[parent_cursor]["childIds"].index(
-                    nodeid
-                )
-                accessibility_tree[parent_cursor]["childIds"].pop(index)
-                # Insert children_nodeids in the same location
-                for child_nodeid in children_nodeids:
-                    accessibility_tree[parent_cursor]["childIds"].insert(
-                        index, child_nodeid
-                    )
-                    index += 1
-                # update children node's parent
-                for child_nodeid in children_nodeids:
-                    child_cursor = nodeid_to_cursor[child_nodeid]
-                    accessibility_tree[child_cursor][
-                        "parentId"
-                    ] = parent_nodeid
-                # mark as removed
-                accessibility_tree[node_cursor]["parentId"] = "[REMOVED]"
-
-            config = info["config"]
-            for node in accessibility_tree:
-                if not node["union_bound"]:
-                    remove_node_in_graph(node)
-                    continue
-
-                [x, y, width, height] = node["union_bound"]
-
-                # invisible node
-                if width == 0 or height == 0:
-                    remove_node_in_graph(node)
-                    continue
-
-                in_viewport_ratio = self.get_element_in_viewport_ratio(
-                    elem_left_bound=float(x),
-                    elem_top_bound=float(y),
-                    width=float(width),
-                    height=float(height),
-                    config=config,
+            elif backend_node_id in backend_id_to_bound:
+                node["union_bound"] = list(
+                    backend_id_to_bound[backend_node_id]
                 )
+            elif node.get("ignored", False):
+                # ignored nodes without a layout object are not rendered
+                node["union_bound"] = None
+            else:
+                fallback_cursors.append(cursor)
+        return accessibility_tree, fallback_cursors
 
-                if in_viewport_ratio < IN_VIEWPORT_RATIO_THRESHOLD:
-                    remove_node_in_graph(node)
-
-            accessibility_tree = [
-                node
+    @staticmethod
+    def set_client_rect_bound(
+        node: AccessibilityTreeNode, response: dict[str, Any]
+    ) -> None:
+        if response.get("result", {}).get("subtype", "") == "error":
+            node["union_bound"] = None
+        else:
+            x = response["result"]["value"]["x"]
+            y = response["result"]["value"]["y"]
+            width = response["result"]["value"]["width"]
+            height = response["result"]["value"]["height"]
+            node["union_bound"] = [x, y, width, height]
+
+    def filter_accessibility_tree(
+        self, accessibility_tree: AccessibilityTree, config: BrowserConfig
+    ) -> AccessibilityTree:
+        """Remove the nodes that are not in the current viewport"""
+        bounds = np.array(
+            [
+                node["union_bound"] or [np.nan] * 4
                 for node in accessibility_tree
-                if node.get("parentId", "Root") != "[REMOVED]"
-            ]
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+        in_viewport = self.get_in_viewport_mask(bounds, config)
+        # the root is always kept
+        in_viewport[0] = True
+        return self.prune_accessibility_tree(
+            accessibility_tree, in_viewport.tolist()
+        )
 
-        return accessibility_tree
+    @staticmethod
+    def prune_accessibility_tree(
+        accessibility_tree: AccessibilityTree, keep: list[bool]
+    ) -> AccessibilityTree:
+        """Remove the nodes that are not kept in a single traversal.
+        The children of a removed node are hoisted, in order, to the place
+        of the removed node in the child list of its closest kept ancestor"""
+        nodeid_to_cursor = {
+            node["nodeId"]: cursor
+            for cursor, node in enumerate(accessibility_tree)
+        }
+        pruned_tree: AccessibilityTree = []
+        for node, keep_node in zip(accessibility_tree, keep):
+            if not keep_node:
+                continue
+            child_ids = []
+            stack = node["childIds"][::-1]
+            while stack:
+                child_id = stack.pop()
+                child_cursor = nodeid_to_cursor.get(child_id)
+                if child_cursor is None:
+                    child_ids.append(child_id)
+                elif keep[child_cursor]:
+                    child_ids.append(child_id)
+                    accessibility_tree[child_cursor]["parentId"] = node[
+                        "nodeId"
+                    ]
+                else:
+                    stack.extend(
+                        accessibility_tree[child_cursor]["childIds"][::-1]
+                    )
+            node["childIds"] = child_ids
+            pruned_tree.append(node)
+        return pruned_tree
 
     @staticmethod
     def parse_accessibility_tree(
         accessibility_tree: AccessibilityTree,
-    ) -> tuple[str, dict[str, Any]]:
-        """Parse the accessibility tree into a string text"""
+        rules: Sequence[ReductionRule] = (),
+        stats: ReductionStats | None = None,
+    ) -> tuple[str, NodeTable]:
+        """Parse the accessibility tree into a string text, reduced by the
+        rules in the same walk"""
         node_id_to_idx = {}
         for idx, node in enumerate(accessibility_tree):
             node_id_to_idx[node["nodeId"]] = idx
 
-        obs_nodes_info = {}
-
-        def dfs(idx: int, obs_node_id: str, depth: int) -> str:
-            tree_str = ""
+        node_rows = NodeRows()
+        if stats is None:
+            stats = ReductionStats()
+
+        # iterative dfs, the stack holds (idx, obs_node_id, depth, parent_row,
+        # the rule removing the node with its ancestor, if any)
+        lines: list[str] = []
+        stack: list[tuple[int, str, int, int, ReductionRule | None]] = [
+            (0, accessibility_tree[0]["nodeId"], 0, -1, None)
+        ]
+        while stack:
+            idx, obs_node_id, depth, parent_row, removed_by = stack.pop()
             node = accessibility_tree[idx]
             indent = "\t" * depth
             valid_node = True
+            row = parent_row
+            rule = None
             try:
                 role = node["role"]["value"]
                 name = node["name"]["value"]
-                node_str = f"[{obs_node_id}] {role} {repr(name)}"
                 properties = []
                 for property in node.get("properties", []):
                     try:
-                        if property["name"] in IGNORED_ACTREE_PROPERTIES:
+                        if property["name"] in IGNORED_ACTREE_PROPERTIES_SET:
                             continue
                         properties.append(
                             f'{property["name"]}: {property["value"]["value"]}'
@@ -501,6 +1054,15 @@ class TextObervationProcessor(ObservationProcessor):
                     except KeyError:
                         pass
 
+                if rules and removed_by is None:
+                    rule = match_reduction_rule(
+                        rules, role, name, " ".join(properties)
+                    )
+                original_name = name
+                if rule is not None and rule.action == "strip":
+                    name = rule.strip(name)
+
+                node_str = f"[{obs_node_id}] {role} {repr(name)}"
                 if properties:
                     node_str += " " + " ".join(properties)
 
@@ -511,51 +1073,59 @@ class TextObervationProcessor(ObservationProcessor):
                 # empty generic node
                 if not name.strip():
                     if not properties:
-                        if role in [
-                            "generic",
-                            "img",
-                            "list",
-                            "strong",
-                            "paragraph",
-                            "banner",
-                            "navigation",
-                            "Section",
-                            "LabelText",
-                            "Legend",
-                            "listitem",
-                        ]:
+                        if role in EMPTY_NAME_IGNORED_ROLES:
                             valid_node = False
-                    elif role in ["listitem"]:
+                    elif role == "listitem":
                         valid_node = False
 
+                if rule is not None and rule.action == "strip":
+                    if not name and original_name:
+                        # nothing is left of the name
+                        valid_node = False
+                    stats.add(
+                        rule,
+                        f"{indent}[{obs_node_id}] {role} {repr(original_name)}",
+                        f"{indent}{node_str}" if valid_node else "",
+                    )
+
+                line, valid_node = apply_reduction_rule(
+                    rule, removed_by, indent, node_str, valid_node, stats
+                )
+                if line is not None:
+                    lines.append(line)
                 if valid_node:
-                    tree_str += f"{indent}{node_str}"
-                    obs_nodes_info[obs_node_id] = {
-                        "backend_id": node["backendDOMNodeId"],
-                        "union_bound": node["union_bound"],
-                        "text": node_str,
-                    }
+                    row = node_rows.append(
+                        obs_node_id,
+                        node["backendDOMNodeId"],
+                        node["union_bound"],
+                        node_str,
+                        role,
+                        parent_row,
+                    )
 
             except Exception as e:
                 valid_node = False
 
-            for _, child_node_id in enumerate(node["childIds"]):
+            # mark this to save some tokens
+            child_depth = depth + 1 if valid_node else depth
+            child_removed_by = removed_by
+            if rule is not None and rule.action != "strip":
+                child_removed_by = rule
+            for child_node_id in reversed(node["childIds"]):
                 if child_node_id not in node_id_to_idx:
                     continue
-                # mark this to save some tokens
-                child_depth = depth + 1 if valid_node else depth
-                child_str = dfs(
-                    node_id_to_idx[child_node_id], child_node_id, child_depth
+                stack.append(
+                    (
+                        node_id_to_idx[child_node_id],
+                        child_node_id,
+                        child_depth,
+                        row,
+                        child_removed_by,
+                    )
                 )
-                if child_str.strip():
-                    if tree_str.strip():
-                        tree_str += "\n"
-                    tree_str += child_str
 
-            return tree_str
-
-        tree_str = dfs(0, accessibility_tree[0]["nodeId"], 0)
-        return tree_str, obs_nodes_info
+        tree_str = "\n".join(lines)
+        return tree_str, node_rows.to_table()
 
     @staticmethod
     def clean_accesibility_tree(tree_str: str) -> str:
@@ -581,28 +1151,51 @@ class TextObervationProcessor(ObservationProcessor):
         return "\n".join(clean_lines)
 
     def process(self, page: Page, client: CDPSession) -> str:
+        start_time = time.perf_counter()
+        self.page_state = None
+        self.page_rules = self.get_page_rules(page.url)
+        try:
+            probe: PageProbe | None = self.probe_page(page)
+        except Exception:
+            # navigating, the page is probed again with the snapshot
+            probe = None
+
         # get the tab info
         open_tabs = page.context.pages
         try:
-            tab_titles = [tab.title() for tab in open_tabs]
-            current_tab_idx = open_tabs.index(page)
-            for idx in range(len(open_tabs)):
-                if idx == current_tab_idx:
-                    tab_titles[
-                        idx
-                    ] = f"Tab {idx} (current): {open_tabs[idx].title()}"
-                else:
-                    tab_titles[idx] = f"Tab {idx}: {open_tabs[idx].title()}"
-            tab_title_str = " | ".join(tab_titles)
+            tab_title_str = self.format_tab_titles(
+                self.get_tab_titles(page, client, probe),
+                open_tabs.index(page),
+            )
         except Exception:
             tab_title_str = " | ".join(
-                ["Tab {idx}" for idx in range(len(open_tabs))]
+                [f"Tab {idx}" for idx in range(len(open_tabs))]
             )
 
+        self.tab_title_tokens = estimate_tokens(f"{tab_title_str}\n\n")
+
+        if self.incremental and probe is not None:
+            assert probe["tracker_state"] is not None
+            cached_content = self.get_cached_content(
+                page, probe["tracker_state"]
+            )
+            if cached_content is not None:
+                self.latency.add("reused", time.perf_counter() - start_time)
+                return f"{tab_title_str}\n\n{cached_content}"
+            if self.reslices_on_scroll:
+                cached_content = self.reslice(page, probe)
+                if cached_content is not None:
+                    self.latency.add(
+                        "resliced", time.perf_counter() - start_time
+                    )
+                    return f"{tab_title_str}\n\n{cached_content}"
+
         try:
-            browser_info = self.fetch_browser_info(page, client)
+            browser_info = self.fetch_browser_info(page, client, probe)
         except Exception:
             page.wait_for_load_state("load", timeout=500)
+            # the cached state is stale after a navigation
+            self.page_state = None
             browser_info = self.fetch_browser_info(page, client)
 
         if self.observation_type == "html":
@@ -612,9 +1205,9 @@ class TextObervationProcessor(ObservationProcessor):
                 client,
                 current_viewport_only=self.current_viewport_only,
             )
-            content, obs_nodes_info = self.parse_html(dom_tree)
-            self.obs_nodes_info = obs_nodes_info
-            self.meta_data["obs_nodes_info"] = obs_nodes_info
+            if self.reslices_on_scroll:
+                self.cache_full_page(browser_info)
+            content = self.serialize_tree(browser_info, dom_tree)
 
         elif self.observation_type == "accessibility_tree":
             accessibility_tree = self.fetch_page_accessibility_tree(
@@ -622,20 +1215,183 @@ class TextObervationProcessor(ObservationProcessor):
                 client,
                 current_viewport_only=self.current_viewport_only,
             )
-            content, obs_nodes_info = self.parse_accessibility_tree(
-                accessibility_tree
-            )
-            content = self.clean_accesibility_tree(content)
-            self.obs_nodes_info = obs_nodes_info
-            self.meta_data["obs_nodes_info"] = obs_nodes_info
+            content = self.serialize_tree(browser_info, accessibility_tree)
 
         else:
             raise ValueError(
                 f"Invalid observatrion type: {self.observation_type}"
             )
 
-        self.browser_config = browser_info["config"]
         content = f"{tab_title_str}\n\n{content}"
+        self.latency.add("rebuilt", time.perf_counter() - start_time)
+        return content
+
+    def get_tab_titles(
+        self, page: Page, client: CDPSession, probe: PageProbe | None
+    ) -> list[str]:
+        """The titles of the open tabs, the current one comes from the probe
+        and all the others from a single Target.getTargets"""
+        open_tabs = page.context.pages
+        if len(open_tabs) == 1 and probe is not None:
+            return [probe["title"]]
+        try:
+            target_titles = get_target_titles(client.send("Target.getTargets"))
+        except Exception:
+            # the titles are then read one tab at a time
+            target_titles = {}
+        tab_titles = []
+        for tab in open_tabs:
+            if tab is page and probe is not None:
+                tab_titles.append(probe["title"])
+                continue
+            target_id = self.get_target_id(tab)
+            if target_id in target_titles:
+                tab_titles.append(target_titles[target_id])
+            else:
+                tab_titles.append(tab.title())
+        return tab_titles
+
+    @staticmethod
+    def get_target_id(page: Page) -> str | None:
+        """The CDP target id of the page, from its session when it has one"""
+        if not hasattr(page, "target_id"):
+            if not hasattr(page, "client"):
+                return None
+            target_info = page.client.send("Target.getTargetInfo")
+            page.target_id = target_info["targetInfo"]["targetId"]  # type: ignore
+        return page.target_id  # type: ignore
+
+    @staticmethod
+    def format_tab_titles(tab_titles: list[str], current_tab_idx: int) -> str:
+        tab_titles = list(tab_titles)
+        for idx in range(len(tab_titles)):
+            if idx == current_tab_idx:
+                tab_titles[idx] = f"Tab {idx} (current): {tab_titles[idx]}"
+            else:
+                tab_titles[idx] = f"Tab {idx}: {tab_titles[idx]}"
+        return " | ".join(tab_titles)
+
+    def cache_full_page(
+        self,
+        info: BrowserInfo,
+        accessibility_tree: AccessibilityTree | None = None,
+    ) -> None:
+        if self.page_state is None:
+            self.full_page_cache = None
+        else:
+            self.full_page_cache = (
+                self.page_state[:3],
+                info,
+                accessibility_tree,
+            )
+
+    def reslice(self, page: Page, probe: PageProbe) -> str | None:
+        """Serialize the cached full page at the scroll offsets of the probe
+        without any CDP command, None unless the page is unchanged but for
+        its scroll offsets since the cached fetch"""
+        if (
+            self.full_page_cache is None
+            or self.page_state is None
+            or probe["tracker_state"] is None
+            or probe["tracker_state"][0] < 0
+        ):
+            return None
+        page_key, cached_info, cached_tree = self.full_page_cache
+        document = cached_info["DOMTree"]["documents"][0]
+        if page_key != self.page_state[:3] or document.get("has_sticky"):
+            return None
+
+        info: BrowserInfo = {
+            "DOMTree": cached_info["DOMTree"],
+            "config": self.make_browser_config(
+                probe["scroll_y"],
+                probe["scroll_x"],
+                probe["win_width"],
+                probe["win_height"],
+                probe["device_pixel_ratio"],
+            ),
+        }
+        if self.observation_type == "html":
+            dom_tree = self.fetch_page_html(
+                info,
+                page,
+                None,  # type: ignore[arg-type]
+                current_viewport_only=True,
+            )
+            return self.serialize_tree(info, dom_tree)
+
+        assert cached_tree is not None
+        accessibility_tree, fallback_cursors = self.join_accessibility_bounds(
+            [copy.copy(node) for node in cached_tree], info
+        )
+        # the bounds from the per-node fallback are shifted by the scroll
+        delta_x = info["config"]["win_left_bound"] - (
+            cached_info["config"]["win_left_bound"]
+        )
+        delta_y = info["config"]["win_top_bound"] - (
+            cached_info["config"]["win_top_bound"]
+        )
+        for cursor in fallback_cursors:
+            bound = cached_tree[cursor]["union_bound"]
+            accessibility_tree[cursor]["union_bound"] = (
+                [bound[0] - delta_x, bound[1] - delta_y, bound[2], bound[3]]
+                if bound is not None
+                else None
+            )
+        accessibility_tree = self.filter_accessibility_tree(
+            accessibility_tree, info["config"]
+        )
+        return self.serialize_tree(info, accessibility_tree)
+
+    def get_cached_content(
+        self, page: Any, tracker_state: list[Any]
+    ) -> str | None:
+        """Record the state of the page from the DOM change tracker, return
+        the previous content if the page did not change since"""
+        version, scroll_x, scroll_y, _ = tracker_state
+        # a fresh tracker starts counting from 0 with this fetch
+        self.page_state = (page, page.url, max(version, 0), scroll_x, scroll_y)
+        if version >= 0 and self.page_state == self.cached_page_state:
+            return self.cached_content
+        return None
+
+    def serialize_tree(
+        self, browser_info: BrowserInfo, tree: DOMTree | AccessibilityTree
+    ) -> str:
+        """Serialize the fetched tree and record its metadata"""
+        if self.observation_type == "html":
+            content, obs_nodes_info = self.parse_html(
+                tree,  # type: ignore[arg-type]
+                self.page_rules,
+                self.reduction_stats,
+            )
+        else:
+            content, obs_nodes_info = self.parse_accessibility_tree(
+                tree,  # type: ignore[arg-type]
+                self.page_rules,
+                self.reduction_stats,
+            )
+            content = self.clean_accesibility_tree(content)
+        if self.retrieval_top_k is not None:
+            content = retrieve_relevant_lines(
+                content, self.retrieval_query, self.retrieval_top_k
+            )
+        if self.max_obs_tokens is not None:
+            # within the margin the prompt constructors do not tokenize
+            budget = int(self.max_obs_tokens * OBS_ESTIMATE_MARGIN)
+            content = fit_to_token_budget(
+                content, budget - self.tab_title_tokens
+            )
+        self.obs_nodes_info = obs_nodes_info
+        self.meta_data["obs_nodes_info"] = obs_nodes_info
+        self.meta_data["spatial_index"] = SpatialIndex(
+            obs_nodes_info, self.viewport_size
+        )
+
+        self.browser_config = browser_info["config"]
+        if self.incremental:
+            self.cached_page_state = self.page_state
+            self.cached_content = content
         return content
 
     def get_element_center(self, element_id: str) -> tuple[float, float]:
@@ -649,20 +1405,131 @@ class TextObervationProcessor(ObservationProcessor):
             center_y / self.viewport_size["height"],
         )
 
+    def get_element_at(self, x: float, y: float) -> str | None:
+        """The id of the innermost element at the relative coordinates of a
+        mouse action, None when there is none"""
+        spatial_index = self.meta_data["spatial_index"]
+        if spatial_index is None:
+            return None
+        return spatial_index.get_element_at(x, y)
+
 
 class ImageObservationProcessor(ObservationProcessor):
-    def __init__(self, observation_type: str):
+    def __init__(
+        self,
+        observation_type: str,
+        screenshot_format: str = "png",
+        screenshot_quality: int | None = None,
+        screenshot_scale: float = 1.0,
+        screenshot_clip: FloatRect | None = None,
+    ):
+        if screenshot_format not in SCREENSHOT_FORMATS:
+            raise ValueError(
+                f"Unsupported screenshot format: {screenshot_format}"
+            )
         self.observation_type = observation_type
         self.observation_tag = "image"
         self.meta_data = create_empty_metadata()
+        self.screenshot_format = screenshot_format
+        self.screenshot_quality = screenshot_quality
+        self.screenshot_scale = screenshot_scale
+        # in viewport coordinates
+        self.screenshot_clip = screenshot_clip
 
-    def process(self, page: Page, client: CDPSession) -> npt.NDArray[np.uint8]:
+    @property
+    def needs_clip(self) -> bool:
+        return self.screenshot_clip is not None or self.screenshot_scale != 1.0
+
+    def get_capture_params(self, page: Page) -> dict[str, Any]:
+        scroll_x, scroll_y = 0.0, 0.0
+        if self.needs_clip:
+            scroll_x, scroll_y = page.evaluate(SCROLL_OFFSET_JS)
+        return self.make_capture_params(scroll_x, scroll_y, page.viewport_size)
+
+    def make_capture_params(
+        self,
+        scroll_x: float,
+        scroll_y: float,
+        viewport_size: ViewportSize | None,
+    ) -> dict[str, Any]:
+        params: dict[str, Any] = {"format": self.screenshot_format}
+        if self.screenshot_format != "png" and self.screenshot_quality:
+            params["quality"] = self.screenshot_quality
+        if self.needs_clip:
+            # the clip is in document coordinates
+            clip = self.screenshot_clip or {
+                "x": 0.0,
+                "y": 0.0,
+                "width": viewport_size["width"],  # type: ignore
+                "height": viewport_size["height"],  # type: ignore
+            }
+            params["clip"] = {
+                "x": clip["x"] + scroll_x,
+                "y": clip["y"] + scroll_y,
+                "width": clip["width"],
+                "height": clip["height"],
+                "scale": self.screenshot_scale,
+            }
+        return params
+
+    def capture(self, page: Page, client: CDPSession) -> Screenshot:
+        """Capture the encoded screenshot without decoding it"""
         try:
-            screenshot = png_bytes_to_numpy(page.screenshot())
+            response = client.send(
+                "Page.captureScreenshot", self.get_capture_params(page)
+            )
         except:
             page.wait_for_event("load")
-            screenshot = png_bytes_to_numpy(page.screenshot())
-        return screenshot
+            response = client.send(
+                "Page.captureScreenshot", self.get_capture_params(page)
+            )
+        return Screenshot(
+            base64.b64decode(response["data"]), self.screenshot_format
+        )
+
+    def process(self, page: Page, client: CDPSession) -> npt.NDArray[np.uint8]:
+        return self.capture(page, client).to_numpy()
+
+
+class LazyObservation(dict[str, Observation]):
+    """Observation whose modalities are only captured when first read
+
+    Each modality is captured from the live page on first access and kept
+    afterwards. Once the page has moved on (next step or reset), the handle
+    expires and modalities that were never read can no longer be captured.
+    """
+
+    def __init__(
+        self, capture_fns: dict[str, Callable[[], Observation]]
+    ) -> None:
+        super().__init__()
+        self.capture_fns = capture_fns
+        self.expired = False
+
+    def __missing__(self, key: str) -> Observation:
+        if key not in self.capture_fns:
+            raise KeyError(key)
+        if self.expired:
+            raise RuntimeError(
+                f"The {key} observation was not read before the page changed"
+            )
+        value = self.capture_fns[key]()
+        self[key] = value
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.capture_fns or super().__contains__(key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def capture(self, key: str) -> None:
+        """Capture the modality now if it has not been read yet"""
+        if not self.expired:
+            self[key]
+
+    def expire(self) -> None:
+        self.expired = True
 
 
 class ObservationHandler:
@@ -675,13 +1542,31 @@ class ObservationHandler:
         image_observation_type: str,
         current_viewport_only: bool,
         viewport_size: ViewportSize,
+        incremental_observation: bool = False,
+        max_obs_tokens: int | None = None,
+        reduction_rules: Sequence[ReductionRule] = DEFAULT_REDUCTION_RULES,
+        retrieval_top_k: int | None = None,
+        screenshot_format: str = "png",
+        screenshot_quality: int | None = None,
+        screenshot_scale: float = 1.0,
+        screenshot_clip: FloatRect | None = None,
     ) -> None:
         self.main_observation_type = main_observation_type
         self.text_processor = TextObervationProcessor(
-            text_observation_type, current_viewport_only, viewport_size
+            text_observation_type,
+            current_viewport_only,
+            viewport_size,
+            incremental=incremental_observation,
+            max_obs_tokens=max_obs_tokens,
+            reduction_rules=reduction_rules,
+            retrieval_top_k=retrieval_top_k,
         )
         self.image_processor = ImageObservationProcessor(
-            image_observation_type
+            image_observation_type,
+            screenshot_format=screenshot_format,
+            screenshot_quality=screenshot_quality,
+            screenshot_scale=screenshot_scale,
+            screenshot_clip=screenshot_clip,
         )
         self.viewport_size = viewport_size
 
@@ -692,17 +1577,17 @@ class ObservationHandler:
             charset=ASCII_CHARSET + FREQ_UNICODE_CHARSET,
         )
 
+        clip = self.image_processor.screenshot_clip or self.viewport_size
+        scale = self.image_processor.screenshot_scale
+        image_shape = (
+            round(clip["height"] * scale),
+            round(clip["width"] * scale),
+            3,
+        )
         image_space = spaces.Box(
             # Each position stores the RGB values. Note the swapped axes (height first).
-            np.zeros(
-                (self.viewport_size["height"], self.viewport_size["width"], 3),
-                dtype=np.uint8,
-            ),
-            np.ones(
-                (self.viewport_size["height"], self.viewport_size["width"], 3),
-                dtype=np.uint8,
-            )
-            * 255.0,
+            np.zeros(image_shape, dtype=np.uint8),
+            np.ones(image_shape, dtype=np.uint8) * 255.0,
             dtype=np.uint8,
         )
 
@@ -710,10 +1595,19 @@ class ObservationHandler:
 
     def get_observation(
         self, page: Page, client: CDPSession
-    ) -> dict[str, Observation]:
-        text_obs = self.text_processor.process(page, client)
-        image_obs = self.image_processor.process(page, client)
-        return {"text": text_obs, "image": image_obs}
+    ) -> LazyObservation:
+        """Return a handle that captures each modality on first read
+
+        The encoded screenshot is kept under "screenshot" and only decoded
+        into the "image" array when that is read.
+        """
+        obs = LazyObservation({})
+        obs.capture_fns = {
+            "text": lambda: self.text_processor.process(page, client),
+            "screenshot": lambda: self.image_processor.capture(page, client),
+            "image": lambda: cast(Screenshot, obs["screenshot"]).to_numpy(),
+        }
+        return obs
 
     def get_observation_metadata(self) -> dict[str, ObservationMetadata]:
         return {
@@ -0,0 +1,164 @@
+"""Block the requests a run does not need, e.g. images for text observations
+
+The rules are applied with `context.route`, note that Chromium disables its
+HTTP cache for a context with routes.
+"""
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from urllib.parse import urlparse
+
+from playwright.sync_api import BrowserContext, Request, Route
+
+from .asset_cache import AssetCache
+
+# what the pages and the evaluators are built from, a resource type rule
+# never blocks them and a url rule only blocks them from third-party hosts
+PROTECTED_RESOURCE_TYPES = frozenset(
+    [
+        "document",
+        "script",
+        "xhr",
+        "fetch",
+        "stylesheet",
+        "websocket",
+        "eventsource",
+    ]
+)
+
+# third-party analytics, none of them is reachable in WebArena
+TRACKER_URL_PATTERN = (
+    r"^https?://([^/]*\.)?("
+    r"google-analytics\.com|googletagmanager\.com|doubleclick\.net|"
+    r"googlesyndication\.com|facebook\.net|hotjar\.com|newrelic\.com|"
+    r"nr-data\.net|segment\.io|mixpanel\.com|matomo\.cloud"
+    r")/"
+)
+
+
+@dataclass
+class RoutingRule:
+    """Block the requests of the given resource types, or with urls matching
+    url_pattern, issued by pages whose url matches site_pattern (all pages
+    by default)"""
+
+    name: str
+    resource_types: frozenset[str] = frozenset()
+    url_pattern: str | None = None
+    site_pattern: str | None = None
+
+    def __post_init__(self) -> None:
+        self.url_regex = (
+            re.compile(self.url_pattern) if self.url_pattern else None
+        )
+        self.site_regex = (
+            re.compile(self.site_pattern) if self.site_pattern else None
+        )
+
+    def matches(self, request: Request, site_url: str) -> bool:
+        if self.site_regex is not None and not self.site_regex.search(
+            site_url
+        ):
+            return False
+        resource_type = request.resource_type
+        if (
+            resource_type in self.resource_types
+            and resource_type not in PROTECTED_RESOURCE_TYPES
+        ):
+            return True
+        if self.url_regex is not None and self.url_regex.search(request.url):
+            return (
+                resource_type not in PROTECTED_RESOURCE_TYPES
+                or urlparse(request.url).netloc != urlparse(site_url).netloc
+            )
+        return False
+
+
+def default_routing_rules(observation_type: str) -> list[RoutingRule]:
+    """Rules that do not change what the evaluators inspect. For text
+    observations the images are blocked too, the images without explicit
+    dimensions then lay out differently, which may change the elements
+    kept by the viewport filtering."""
+    rules = [RoutingRule("trackers", url_pattern=TRACKER_URL_PATTERN)]
+    if observation_type in ["accessibility_tree", "html"]:
+        # product images, map tiles, videos and web fonts
+        rules.append(
+            RoutingRule(
+                "media", resource_types=frozenset(["image", "media", "font"])
+            )
+        )
+    return rules
+
+
+@dataclass
+class RoutingStats:
+    """The blocked requests are aborted before they are sent, their bytes
+    are only known for the urls in the asset cache, e.g. stored by an
+    earlier run without blocking. Without any, only the requests are
+    reported."""
+
+    allowed_requests: int = 0
+    blocked_requests: Counter[str] = field(default_factory=Counter)
+    blocked_by_rule: Counter[str] = field(default_factory=Counter)
+    blocked_bytes: int = 0
+    sized_requests: int = 0
+
+    def __str__(self) -> str:
+        num_blocked = sum(self.blocked_requests.values())
+        total = self.allowed_requests + num_blocked
+        blocked = ", ".join(
+            f"{resource_type}: {count}"
+            for resource_type, count in self.blocked_requests.most_common()
+        )
+        if not self.sized_requests:
+            return (
+                f"blocked {num_blocked}/{total} requests ({blocked}), "
+                "the size of none is known"
+            )
+        return (
+            f"blocked {num_blocked}/{total} requests ({blocked}), "
+            f"{self.blocked_bytes / 1024:.0f}KiB avoided for the "
+            f"{self.sized_requests}/{num_blocked} of known size"
+        )
+
+
+class RoutingProfile:
+    """Abort the requests matching any of the rules in the contexts it is
+    attached to, the others continue to the next route handler"""
+
+    def __init__(
+        self, rules: list[RoutingRule], asset_cache: AssetCache | None = None
+    ) -> None:
+        self.rules = rules
+        # the sizes of the blocked requests are looked up in the cache
+        self.asset_cache = asset_cache
+        self.stats = RoutingStats()
+
+    def attach(self, context: BrowserContext) -> None:
+        context.route("**/*", self.handle)
+
+    def get_blocking_rule(self, request: Request) -> RoutingRule | None:
+        try:
+            site_url = request.frame.url
+        except Exception:
+            # e.g. service worker requests are not issued by a frame
+            site_url = request.url
+        for rule in self.rules:
+            if rule.matches(request, site_url):
+                return rule
+        return None
+
+    def handle(self, route: Route) -> None:
+        rule = self.get_blocking_rule(route.request)
+        if rule is None:
+            self.stats.allowed_requests += 1
+            route.fallback()
+        else:
+            self.stats.blocked_requests[route.request.resource_type] += 1
+            self.stats.blocked_by_rule[rule.name] += 1
+            if self.asset_cache is not None:
+                size = self.asset_cache.get_size(route.request.url)
+                if size is not None:
+                    self.stats.blocked_bytes += size
+                    self.stats.sized_requests += 1
+            route.abort("blockedbyclient")
@@ -0,0 +1,174 @@
+"""Wait for a page to settle after an action instead of a fixed sleep"""
+import asyncio
+import time
+
+from playwright.async_api import BrowserContext as ABrowserContext
+from playwright.async_api import Page as APage
+from playwright.async_api import Request as ARequest
+from playwright.async_api import TimeoutError as APlaywrightTimeoutError
+from playwright.sync_api import BrowserContext, Page, Request
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+from .processors import DOM_CHANGE_TRACKER_JS
+
+# long-lived connections that never finish
+IGNORED_RESOURCE_TYPES = frozenset(["websocket", "eventsource"])
+
+# disables the css animations and transitions once the document is created
+REDUCED_MOTION_JS = """(() => {
+    const css = `*, *::before, *::after {
+        animation-duration: 0s !important;
+        animation-delay: 0s !important;
+        transition-duration: 0s !important;
+        transition-delay: 0s !important;
+        scroll-behavior: auto !important;
+    }`;
+    const inject = () => {
+        const style = document.createElement("style");
+        style.textContent = css;
+        (document.head || document.documentElement).appendChild(style);
+    };
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", inject);
+    } else {
+        inject();
+    }
+})();"""
+
+
+def reduce_motion(context: BrowserContext) -> None:
+    """Disable the animations of all documents created from now on, the
+    prefers-reduced-motion media is set when creating the context"""
+    context.add_init_script(REDUCED_MOTION_JS)
+
+
+class PageSettleDetector:
+    """A page is settled once it reached the load state and both the network
+    and the DOM have been quiet for quiet_window seconds, or after timeout
+    seconds at most"""
+
+    def __init__(
+        self,
+        timeout: float = 10.0,
+        quiet_window: float = 0.5,
+        poll_interval: float = 0.05,
+        max_inflight_requests: int = 0,
+    ) -> None:
+        self.timeout = timeout
+        self.quiet_window = quiet_window
+        self.poll_interval = poll_interval
+        self.max_inflight_requests = max_inflight_requests
+        self.inflight_requests: set[Request | ARequest] = set()
+        self.last_network_activity = time.perf_counter()
+        # the waits that hit the timeout, e.g. on pages that keep polling
+        self.num_waits = 0
+        self.num_timeouts = 0
+
+    def attach(self, context: BrowserContext | ABrowserContext) -> None:
+        """Track the requests of the context, sync or async, replaces the
+        previous one"""
+        self.inflight_requests.clear()
+        self.last_network_activity = time.perf_counter()
+        context.on("request", self.on_request_start)
+        context.on("requestfinished", self.on_request_end)
+        context.on("requestfailed", self.on_request_end)
+
+    def on_request_start(self, request: Request | ARequest) -> None:
+        if request.resource_type not in IGNORED_RESOURCE_TYPES:
+            self.inflight_requests.add(request)
+            self.last_network_activity = time.perf_counter()
+
+    def on_request_end(self, request: Request | ARequest) -> None:
+        if request in self.inflight_requests:
+            self.inflight_requests.discard(request)
+            self.last_network_activity = time.perf_counter()
+
+    def is_network_quiet(self) -> bool:
+        return (
+            len(self.inflight_requests) <= self.max_inflight_requests
+            and time.perf_counter() - self.last_network_activity
+            >= self.quiet_window
+        )
+
+    def is_dom_quiet(self, page: Page) -> bool:
+        try:
+            version, _, _, quiet_ms = page.evaluate(DOM_CHANGE_TRACKER_JS)
+        except Exception:
+            # navigating, the new document is not quiet yet
+            return False
+        return bool(version >= 0 and quiet_ms >= self.quiet_window * 1000)
+
+    def wait(self, page: Page) -> float:
+        """Block until the page settled, returns the seconds waited"""
+        return wait_for_settle([(self, page)])[0]
+
+
+def wait_for_settle(
+    targets: list[tuple[PageSettleDetector, Page]]
+) -> list[float]:
+    """Wait for several pages at once, each with the detector of its context.
+    Their loads run concurrently in the browser, so this takes about as long
+    as the slowest page. Returns the seconds waited for each page."""
+    start = time.perf_counter()
+    settle_times = [0.0] * len(targets)
+    for detector, page in targets:
+        remaining = start + detector.timeout - time.perf_counter()
+        if remaining > 0:
+            try:
+                page.wait_for_load_state("load", timeout=remaining * 1000)
+            except PlaywrightTimeoutError:
+                pass
+
+    pending = list(range(len(targets)))
+    while pending:
+        still_pending = []
+        for idx in pending:
+            detector, page = targets[idx]
+            elapsed = time.perf_counter() - start
+            if detector.is_network_quiet() and detector.is_dom_quiet(page):
+                settle_times[idx] = elapsed
+                detector.num_waits += 1
+            elif elapsed >= detector.timeout:
+                settle_times[idx] = elapsed
+                detector.num_waits += 1
+                detector.num_timeouts += 1
+            else:
+                still_pending.append(idx)
+        pending = still_pending
+        if pending:
+            # also lets playwright dispatch the request events
+            detector, page = targets[pending[0]]
+            page.wait_for_timeout(detector.poll_interval * 1000)
+    return settle_times
+
+
+class AsyncPageSettleDetector(PageSettleDetector):
+    """PageSettleDetector on the async API"""
+
+    async def ais_dom_quiet(self, page: APage) -> bool:
+        try:
+            version, _, _, quiet_ms = await page.evaluate(
+                DOM_CHANGE_TRACKER_JS
+            )
+        except Exception:
+            # navigating, the new document is not quiet yet
+            return False
+        return bool(version >= 0 and quiet_ms >= self.quiet_window * 1000)
+
+    async def await_settle(self, page: APage) -> float:
+        """Wait until the page settled, returns the seconds waited"""
+        start = time.perf_counter()
+        try:
+            await page.wait_for_load_state("load", timeout=self.timeout * 1000)
+        except APlaywrightTimeoutError:
+            pass
+        while True:
+            elapsed = time.perf_counter() - start
+            if self.is_network_quiet() and await self.ais_dom_quiet(page):
+                self.num_waits += 1
+                return elapsed
+            if elapsed >= self.timeout:
+                self.num_waits += 1
+                self.num_timeouts += 1
+                return elapsed
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,179 @@
+"""A uniform grid over the bounds of the observed elements
+
+Maps a point or a rectangle of the viewport back to the ids of the
+elements of the text observation, e.g. to describe a coordinate action by
+the element it lands on, without any CDP command.
+
+The grid is stored as two arrays: the elements of each cell are
+cell_items[cell_starts[cell] : cell_starts[cell + 1]], with the cells in
+row-major order. The elements covering too many cells, e.g. the root of
+the page, are kept apart and checked on every query.
+"""
+from typing import Any, Mapping
+
+import numpy as np
+import numpy.typing as npt
+from playwright.sync_api import ViewportSize
+
+from .node_table import NodeTable
+
+
+class SpatialIndex:
+    """Index of the union_bound of each node in obs_nodes_info, in the
+    viewport coordinates of the observation
+
+    The grid is only built on the first query.
+    """
+
+    def __init__(
+        self,
+        obs_nodes_info: Mapping[str, Any],
+        viewport_size: ViewportSize,
+        cell_size: float = 64.0,
+        max_cells: int = 64,
+    ) -> None:
+        self.obs_nodes_info = obs_nodes_info
+        self.viewport_size = viewport_size
+        self.cell_size = cell_size
+        # the elements over more cells than this are checked on every query
+        self.max_cells = max_cells
+        self.built = False
+        self.element_ids: list[str] = []
+        # x0, y0, x1, y1 of each element
+        self.bounds: npt.NDArray[np.float64] = np.zeros((0, 4))
+        self.origin = (0.0, 0.0)
+        self.num_cols = 0
+        self.num_rows = 0
+        self.cell_starts: npt.NDArray[np.int64] = np.zeros(1, np.int64)
+        self.cell_items: npt.NDArray[np.int64] = np.zeros(0, np.int64)
+        self.large_items: npt.NDArray[np.int64] = np.zeros(0, np.int64)
+
+    def __eq__(self, other: object) -> bool:
+        return (
+            isinstance(other, SpatialIndex)
+            and self.obs_nodes_info == other.obs_nodes_info
+            and self.viewport_size == other.viewport_size
+        )
+
+    def build(self) -> None:
+        self.built = True
+        if isinstance(self.obs_nodes_info, NodeTable):
+            rows = self.obs_nodes_info.bounds
+            valid = np.flatnonzero((rows[:, 2] > 0) & (rows[:, 3] > 0))
+            rows = rows[valid]
+            self.element_ids = [
+                self.obs_nodes_info.element_ids[row] for row in valid
+            ]
+        else:
+            self.element_ids = []
+            bounds = []
+            for element_id, node_info in self.obs_nodes_info.items():
+                bound = node_info.get("union_bound")
+                if bound is None or bound[2] <= 0 or bound[3] <= 0:
+                    continue
+                self.element_ids.append(element_id)
+                bounds.append(bound)
+            rows = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        if not len(rows):
+            return
+        x, y, width, height = rows.T
+        self.bounds = np.stack([x, y, x + width, y + height], axis=1)
+        self.origin = (float(x.min()), float(y.min()))
+
+        col0, row0, col1, row1 = self.get_cells(self.bounds)
+        self.num_cols = int(col1.max()) + 1
+        self.num_rows = int(row1.max()) + 1
+        num_cols = col1 - col0 + 1
+        num_cells = num_cols * (row1 - row0 + 1)
+        large = num_cells > self.max_cells
+        self.large_items = np.flatnonzero(large)
+
+        # one (cell, element) pair for each cell an element covers
+        small_items = np.flatnonzero(~large)
+        counts = num_cells[small_items]
+        pair_items = np.repeat(small_items, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        pair_cols = col0[pair_items] + offsets % num_cols[pair_items]
+        pair_rows = row0[pair_items] + offsets // num_cols[pair_items]
+        pair_cells = pair_rows * self.num_cols + pair_cols
+        # the elements of a cell stay in document order
+        order = np.argsort(pair_cells, kind="stable")
+        self.cell_items = pair_items[order]
+        self.cell_starts = np.zeros(
+            self.num_cols * self.num_rows + 1, dtype=np.int64
+        )
+        np.cumsum(
+            np.bincount(pair_cells, minlength=self.num_cols * self.num_rows),
+            out=self.cell_starts[1:],
+        )
+
+    def get_cells(
+        self, bounds: npt.NDArray[np.float64]
+    ) -> tuple[npt.NDArray[np.int64], ...]:
+        """The first and last column and row covered by each bound"""
+        cells = np.floor(
+            (bounds - np.array(self.origin * 2)) / self.cell_size
+        ).astype(np.int64)
+        return tuple(np.maximum(cells, 0).T)
+
+    def get_candidates(
+        self, x0: float, y0: float, x1: float, y1: float
+    ) -> npt.NDArray[np.int64]:
+        if not self.built:
+            self.build()
+        col0, row0, col1, row1 = (
+            int(cell[0])
+            for cell in self.get_cells(np.array([[x0, y0, x1, y1]]))
+        )
+        col1 = min(col1, self.num_cols - 1)
+        row1 = min(row1, self.num_rows - 1)
+        candidates = [self.large_items]
+        if col0 <= col1 and row0 <= row1:
+            for row in range(row0, row1 + 1):
+                start = self.cell_starts[row * self.num_cols + col0]
+                end = self.cell_starts[row * self.num_cols + col1 + 1]
+                candidates.append(self.cell_items[start:end])
+        return np.unique(np.concatenate(candidates))
+
+    def query_rect(
+        self, x: float, y: float, width: float, height: float
+    ) -> list[str]:
+        """The ids of the elements intersecting the rectangle, in document
+        order"""
+        candidates = self.get_candidates(x, y, x + width, y + height)
+        bounds = self.bounds[candidates]
+        hits = candidates[
+            (bounds[:, 0] <= x + width)
+            & (bounds[:, 2] >= x)
+            & (bounds[:, 1] <= y + height)
+            & (bounds[:, 3] >= y)
+        ]
+        return [self.element_ids[item] for item in hits]
+
+    def query_point(self, x: float, y: float) -> list[str]:
+        """The ids of the elements containing the point, the innermost
+        first"""
+        candidates = self.get_candidates(x, y, x, y)
+        bounds = self.bounds[candidates]
+        hits = candidates[
+            (bounds[:, 0] <= x)
+            & (bounds[:, 2] >= x)
+            & (bounds[:, 1] <= y)
+            & (bounds[:, 3] >= y)
+        ]
+        # the smallest element, the last in document order on a tie
+        bounds = self.bounds[hits]
+        areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+        return [
+            self.element_ids[item] for item in hits[np.lexsort((-hits, areas))]
+        ]
+
+    def get_element_at(self, x: float, y: float) -> str | None:
+        """The id of the innermost element at the coordinates of a mouse
+        action, relative to the viewport size"""
+        element_ids = self.query_point(
+            x * self.viewport_size["width"], y * self.viewport_size["height"]
+        )
+        return element_ids[0] if element_ids else None
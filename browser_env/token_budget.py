@@ -0,0 +1,215 @@
+"""Fit a serialized observation into a token budget
+
+Truncating the tokenized observation cuts the tree at an arbitrary node.
+Instead, the lines of the tree are kept by priority, each together with its
+ancestors: the focused node first, then the interactive nodes, then the
+rest of the text in document order. The items of a long list of similar
+siblings past its first few come last. Every run of dropped lines is
+replaced by a marker, so the agent knows that the page has more content.
+"""
+import re
+
+# a cheap, conservative estimate of the tokenizers of the agents: one token
+# per digit as for Llama, and per byte of the non-ASCII characters, which
+# may fall back to bytes. Most words are a single token, but a rare long
+# word may take more, so this is not a strict upper bound.
+TOKEN_PATTERN = re.compile(r"\d|[A-Za-z]{1,8}|\s+|\S")
+
+# the observations are fitted into this fraction of the token limit, which
+# leaves room for the words the estimate undercounts. The prompt
+# constructors do not tokenize the observations estimated within it.
+OBS_ESTIMATE_MARGIN = 0.8
+
+# the accessibility roles and the html tags the actions can interact with
+INTERACTIVE_ROLES = frozenset(
+    [
+        "button",
+        "checkbox",
+        "combobox",
+        "link",
+        "listbox",
+        "menuitem",
+        "menuitemcheckbox",
+        "menuitemradio",
+        "option",
+        "radio",
+        "searchbox",
+        "slider",
+        "spinbutton",
+        "switch",
+        "tab",
+        "textbox",
+        "treeitem",
+        "a",
+        "input",
+        "select",
+        "textarea",
+    ]
+)
+
+# [id] role 'name' for the accessibility tree, [id] <tag attrs> for html
+LINE_ROLE_PATTERN = re.compile(r"\[\d+\] <?(\w+)")
+
+FOCUSED_PRIORITY = 0
+INTERACTIVE_PRIORITY = 1
+TEXT_PRIORITY = 2
+REPEATED_PRIORITY = 3
+
+
+def estimate_tokens(text: str) -> int:
+    # the extra bytes of the non-ASCII characters
+    return len(TOKEN_PATTERN.findall(text)) + len(text.encode()) - len(text)
+
+
+def elided_marker(indent: str, num_lines: int) -> str:
+    lines = "line" if num_lines == 1 else "lines"
+    return f"{indent}[... {num_lines} {lines} elided]"
+
+
+def get_line_role(line: str) -> str:
+    match = LINE_ROLE_PATTERN.match(line.lstrip("\t"))
+    return match.group(1).lower() if match else ""
+
+
+def get_parents(depths: list[int]) -> list[int]:
+    """The index of the parent line of each line, -1 for the top level"""
+    parents = []
+    stack: list[int] = []
+    for idx, depth in enumerate(depths):
+        while stack and depths[stack[-1]] >= depth:
+            stack.pop()
+        parents.append(stack[-1] if stack else -1)
+        stack.append(idx)
+    return parents
+
+
+def get_priorities(
+    lines: list[str],
+    depths: list[int],
+    parents: list[int],
+    min_repeats: int,
+    keep_repeats: int,
+) -> list[int]:
+    roles = [get_line_role(line) for line in lines]
+    priorities = [
+        FOCUSED_PRIORITY
+        if "focused: True" in line
+        else INTERACTIVE_PRIORITY
+        if role in INTERACTIVE_ROLES
+        else TEXT_PRIORITY
+        for line, role in zip(lines, roles)
+    ]
+
+    # the end of the subtree of each line
+    ends = list(range(1, len(lines) + 1))
+    for idx in reversed(range(len(lines))):
+        if parents[idx] >= 0:
+            ends[parents[idx]] = max(ends[parents[idx]], ends[idx])
+
+    # the siblings with the same roles in the first lines of their subtree
+    # are the items of a repetitive list
+    children: dict[int, list[int]] = {}
+    for idx, parent in enumerate(parents):
+        children.setdefault(parent, []).append(idx)
+    for siblings in children.values():
+        signatures = [
+            tuple(
+                (depths[cursor] - depths[idx], roles[cursor])
+                for cursor in range(idx, min(ends[idx], idx + 6))
+            )
+            for idx in siblings
+        ]
+        start = 0
+        for end in range(1, len(siblings) + 1):
+            if end < len(siblings) and signatures[end] == signatures[start]:
+                continue
+            if end - start >= min_repeats:
+                for idx in siblings[start + keep_repeats : end]:
+                    for cursor in range(idx, ends[idx]):
+                        if priorities[cursor] != FOCUSED_PRIORITY:
+                            priorities[cursor] = REPEATED_PRIORITY
+            start = end
+    return priorities
+
+
+def select_lines(
+    tokens: list[int],
+    parents: list[int],
+    priorities: list[int],
+    budget: int,
+) -> list[bool]:
+    """Keep the lines by priority then document order while they fit, a line
+    is only kept with all its ancestors"""
+    kept = [False] * len(tokens)
+    used = 0
+    for idx in sorted(range(len(tokens)), key=lambda idx: priorities[idx]):
+        if kept[idx]:
+            continue
+        path = []
+        cursor = idx
+        while cursor >= 0 and not kept[cursor]:
+            path.append(cursor)
+            cursor = parents[cursor]
+        cost = sum(tokens[cursor] for cursor in path)
+        if used + cost > budget:
+            continue
+        used += cost
+        for cursor in path:
+            kept[cursor] = True
+    return kept
+
+
+def join_kept_lines(
+    lines: list[str], depths: list[int], kept: list[bool]
+) -> str:
+    output: list[str] = []
+    num_elided = 0
+    for idx, line in enumerate(lines):
+        if kept[idx]:
+            if num_elided:
+                output.append(
+                    elided_marker("\t" * depths[idx - num_elided], num_elided)
+                )
+                num_elided = 0
+            output.append(line)
+        else:
+            num_elided += 1
+    if num_elided:
+        output.append(
+            elided_marker("\t" * depths[len(lines) - num_elided], num_elided)
+        )
+    return "\n".join(output)
+
+
+def fit_to_token_budget(
+    content: str,
+    budget: int,
+    min_repeats: int = 8,
+    keep_repeats: int = 3,
+) -> str:
+    """Drop the lines of the serialized tree that do not fit in budget
+    tokens, as counted by estimate_tokens
+
+    Lists of at least min_repeats similar items keep their first
+    keep_repeats items ahead of the text of the page.
+    """
+    lines = content.rstrip("\n").split("\n")
+    # each line is followed by a newline
+    tokens = [estimate_tokens(line) + 1 for line in lines]
+    if sum(tokens) <= budget:
+        return content
+
+    depths = [len(line) - len(line.lstrip("\t")) for line in lines]
+    parents = get_parents(depths)
+    priorities = get_priorities(
+        lines, depths, parents, min_repeats, keep_repeats
+    )
+    # the markers take tokens too, leave room for them until the lines fit
+    selection_budget = budget
+    while True:
+        kept = select_lines(tokens, parents, priorities, selection_budget)
+        fitted = join_kept_lines(lines, depths, kept)
+        overflow = estimate_tokens(fitted) - budget
+        if overflow <= 0 or not any(kept):
+            return fitted
+        selection_budget -= overflow
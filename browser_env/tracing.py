@@ -0,0 +1,158 @@
+"""Tracing modes of the env, from the full Playwright trace to none
+
+    off      nothing is recorded
+    full     a Playwright trace with screenshots and DOM snapshots per task
+    sampled  the Playwright trace of every sample_every-th task only
+    light    a log of the actions, with the DOM of the page when they fail
+
+With failures_only, the sampled and light traces are only kept for the
+tasks that failed or errored.
+
+The recorder measures the time it spends starting, recording and saving
+the traces. For full and sampled traces, this misses the screenshots and
+snapshots Playwright takes during the actions themselves.
+"""
+import json
+import time
+import zipfile
+from pathlib import Path
+from typing import Any
+
+from playwright.sync_api import BrowserContext, Page
+
+from .actions import Action, ActionTypes
+
+TRACE_MODES = ["off", "full", "sampled", "light"]
+
+
+class TraceRecorder:
+    def __init__(
+        self,
+        mode: str = "off",
+        sample_every: int = 1,
+        failures_only: bool = False,
+    ) -> None:
+        if mode not in TRACE_MODES:
+            raise ValueError(f"Unsupported trace mode: {mode}")
+        if sample_every <= 0:
+            raise ValueError("sample_every must be positive")
+        self.mode = mode
+        self.sample_every = sample_every
+        self.failures_only = failures_only
+        self.num_tasks = 0
+        # whether a task is started and not stopped yet
+        self.started = False
+        # whether a Playwright trace of the current task is running
+        self.recording = False
+        self.steps: list[dict[str, Any]] = []
+        self.snapshots: dict[str, str] = {}
+        self.step_start = 0.0
+        # over all the tasks, the seconds spent on the traces and the steps
+        self.trace_time = 0.0
+        self.num_steps = 0
+
+    def __str__(self) -> str:
+        per_step = self.trace_time / max(self.num_steps, 1) * 1000
+        return (
+            f"{self.mode}: {per_step:.1f} ms per step over {self.num_steps} "
+            f"steps, {self.trace_time:.2f}s in total"
+        )
+
+    def start(self, context: BrowserContext) -> None:
+        """Start recording the task of a new context"""
+        start_time = time.perf_counter()
+        self.num_tasks += 1
+        self.started = True
+        self.steps = []
+        self.snapshots = {}
+        self.recording = self.mode == "full" or (
+            self.mode == "sampled"
+            and (self.num_tasks - 1) % self.sample_every == 0
+        )
+        if self.recording:
+            context.tracing.start(screenshots=True, snapshots=True)
+        self.trace_time += time.perf_counter() - start_time
+
+    def start_step(self) -> None:
+        self.num_steps += 1
+        self.step_start = time.perf_counter()
+
+    def record_step(
+        self, action: Action, page: Page, success: bool, fail_error: str
+    ) -> None:
+        """Log the executed action, light mode only"""
+        if self.mode != "light":
+            return
+        start_time = time.perf_counter()
+        step = {
+            "action_type": str(ActionTypes(action["action_type"])),
+            "element_id": action["element_id"],
+            "url": page.url,
+            "success": success,
+            "fail_error": fail_error,
+            "execution_time": start_time - self.step_start,
+            "raw_prediction": action["raw_prediction"],
+        }
+        if not success:
+            snapshot_name = f"step_{len(self.steps)}.html"
+            self.snapshot(page, snapshot_name)
+            step["snapshot"] = snapshot_name
+        trace_time = time.perf_counter() - start_time
+        step["trace_time"] = trace_time
+        self.trace_time += trace_time
+        self.steps.append(step)
+
+    def snapshot(self, page: Page, name: str) -> None:
+        try:
+            self.snapshots[name] = page.content()
+        except Exception:
+            # the page is navigating or closed
+            pass
+
+    def stop(
+        self,
+        context: BrowserContext,
+        page: Page,
+        trace_path: str | Path,
+        failed: bool | None = None,
+    ) -> bool:
+        """Stop recording the task, the trace is written to trace_path if it
+        is kept. failed is None when the outcome of the task is unknown."""
+        start_time = time.perf_counter()
+        try:
+            return self.save(context, page, trace_path, failed)
+        finally:
+            self.trace_time += time.perf_counter() - start_time
+
+    def save(
+        self,
+        context: BrowserContext,
+        page: Page,
+        trace_path: str | Path,
+        failed: bool | None,
+    ) -> bool:
+        if not self.started:
+            # already stopped, e.g. the task failed before its reset
+            return False
+        self.started = False
+        keep = self.mode == "full" or not (
+            self.failures_only and failed is False
+        )
+        if self.recording:
+            self.recording = False
+            if keep:
+                context.tracing.stop(path=trace_path)
+                return True
+            # discard the trace
+            context.tracing.stop()
+            return False
+
+        if self.mode != "light" or not keep:
+            return False
+        if failed is not False:
+            self.snapshot(page, "final.html")
+        with zipfile.ZipFile(trace_path, "w", zipfile.ZIP_DEFLATED) as f:
+            f.writestr("actions.json", json.dumps(self.steps, indent=2))
+            for name, content in self.snapshots.items():
+                f.writestr(name, content)
+        return True
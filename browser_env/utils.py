@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from io import BytesIO
-from typing import Any, Dict, TypedDict, Union
+from typing import Any, Callable, Dict, TypedDict, Union
 
 import numpy as np
 import numpy.typing as npt
@@ -13,8 +13,35 @@ class DetachedPage:
     content: str  # html
 
 
+class LazyDetachedPage(DetachedPage):
+    """DetachedPage whose html content is only fetched when first read"""
+
+    def __init__(self, url: str, get_content: Callable[[], str]) -> None:
+        self.url = url
+        self.get_content = get_content
+        self._content: str | None = None
+        self.expired = False
+
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            if self.expired:
+                raise RuntimeError(
+                    "The page content was not read before the page changed"
+                )
+            self._content = self.get_content()
+        return self._content
+
+    @content.setter
+    def content(self, value: str) -> None:
+        self._content = value
+
+    def expire(self) -> None:
+        self.expired = True
+
+
 def png_bytes_to_numpy(png: bytes) -> npt.NDArray[np.uint8]:
-    """Convert png bytes to numpy array
+    """Convert png bytes to numpy array, also works for jpeg and webp
 
     Example:
 
@@ -24,6 +51,21 @@ def png_bytes_to_numpy(png: bytes) -> npt.NDArray[np.uint8]:
     return np.array(Image.open(BytesIO(png)))
 
 
+@dataclass
+class Screenshot:
+    """Encoded screenshot as captured by the browser"""
+
+    data: bytes
+    format: str  # png, jpeg, webp
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.format}"
+
+    def to_numpy(self) -> npt.NDArray[np.uint8]:
+        return png_bytes_to_numpy(self.data)
+
+
 class AccessibilityTreeNode(TypedDict):
     nodeId: str
     ignored: bool
@@ -33,7 +75,7 @@ class AccessibilityTreeNode(TypedDict):
     properties: list[dict[str, Any]]
     childIds: list[str]
     parentId: str
-    backendDOMNodeId: str
+    backendDOMNodeId: int
     frameId: str
     bound: list[float] | None
     union_bound: list[float] | None
@@ -72,7 +114,7 @@ AccessibilityTree = list[AccessibilityTreeNode]
 DOMTree = list[DOMNode]
 
 
-Observation = str | npt.NDArray[np.uint8]
+Observation = str | npt.NDArray[np.uint8] | Screenshot
 
 
 class StateInfo(TypedDict):
@@ -39,10 +39,6 @@ def generate_from_huggingface_completion(
     max_new_tokens: int,
     stop_sequences: list[str] | None = None,
 ) -> str:
-    prompt = prompt.replace(
-        "The information in this tab has been changed. This tab contains invalid data. Please resolve this before saving. Loading... ",
-        "",
-    )
     output = llm.create_completion(
         prompt=prompt,
         temperature=temperature,
@@ -62,12 +58,6 @@ def generate_from_huggingface_chat_completion(
     max_new_tokens: int,
     stop_sequences: list[str] | None = None,
 ) -> str:
-    for message in prompt:
-        message["content"] = message["content"].replace(
-            "The information in this tab has been changed. This tab contains invalid data. Please resolve this before saving. Loading... ",
-            "",
-        )
-
     client = Client(
         model_endpoint,
         timeout=60,
@@ -9,6 +9,7 @@ import random
 import subprocess
 import tempfile
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
 import openai
@@ -24,13 +25,24 @@ from agent.prompts import *
 from browser_env import (
     Action,
     ActionTypes,
+    AssetCache,
+    RoutingProfile,
     ScriptBrowserEnv,
     StateInfo,
     Trajectory,
     create_stop_action,
+    default_reduction_rules,
+    default_routing_rules,
 )
 from browser_env.actions import is_equivalent
 from browser_env.auto_login import get_site_comb_from_filepath
+from browser_env.env_config import (
+    GITLAB,
+    MAP,
+    REDDIT,
+    SHOPPING_ADMIN,
+    URL_MAPPINGS,
+)
 from browser_env.helper_functions import (
     RenderHelper,
     get_action_description,
@@ -85,8 +97,120 @@ def config() -> argparse.Namespace:
     )
     parser.add_argument("--viewport_width", type=int, default=1280)
     parser.add_argument("--viewport_height", type=int, default=720)
-    parser.add_argument("--save_trace_enabled", action="store_true")
+    parser.add_argument(
+        "--save_trace_enabled",
+        action="store_true",
+        help="Save the full Playwright trace of every task, same as "
+        "--trace_mode full",
+    )
+    parser.add_argument(
+        "--trace_mode",
+        choices=["off", "full", "sampled", "light"],
+        default="light",
+        help="full and sampled record Playwright traces, light only logs "
+        "the actions with the DOM of the page when they fail. Defaults to "
+        "light, the full trace of every task was recorded before",
+    )
+    parser.add_argument(
+        "--trace_sample_every",
+        type=int,
+        default=10,
+        help="Record the trace of every N-th task with --trace_mode sampled",
+    )
+    parser.add_argument(
+        "--trace_failures_only",
+        action="store_true",
+        help="Only keep the sampled and light traces of failed tasks",
+    )
+    parser.add_argument(
+        "--render_screenshot",
+        action="store_true",
+        help="Render the screenshot of each step, only captured when set",
+    )
+    parser.add_argument(
+        "--settle_timeout",
+        type=float,
+        default=2.0,
+        help="Wait at most this many seconds for the page to settle after "
+        "each action, 0 to use --sleep_after_execution instead",
+    )
+    parser.add_argument(
+        "--settle_quiet_window",
+        type=float,
+        default=0.5,
+        help="Seconds without network activity and DOM mutations for the "
+        "page to be settled",
+    )
+    parser.add_argument(
+        "--reduced_motion",
+        action="store_true",
+        help="Disable the css animations and transitions of the pages",
+    )
+    parser.add_argument(
+        "--block_resources",
+        action="store_true",
+        help="Block the trackers, and the images, media and fonts for text "
+        "observations, the documents and scripts are never blocked",
+    )
+    parser.add_argument(
+        "--reduce_site_chrome",
+        action="store_true",
+        help="Collapse the menus and drop the footers repeated on every page "
+        "of the sites from the text observations",
+    )
+    parser.add_argument(
+        "--asset_cache_dir",
+        type=str,
+        default="",
+        help="Serve the static assets of the sites from this directory, "
+        "shared by all the workers, disabled by default",
+    )
+    parser.add_argument(
+        "--asset_cache_size_mb",
+        type=int,
+        default=1024,
+        help="Evict the least recently used assets beyond this size",
+    )
+    parser.add_argument(
+        "--max_tasks_per_browser",
+        type=int,
+        default=None,
+        help="Restart the browser after this many tasks, never by default",
+    )
+    parser.add_argument(
+        "--prepare_next_context",
+        action="store_true",
+        help="Renew the next task's cookies in a background thread during "
+        "the current episode, then open its context and start loading its "
+        "pages between two steps, which blocks until their first response. "
+        "The prepared pages may miss changes made by the episode",
+    )
+    parser.add_argument(
+        "--screenshot_format",
+        choices=["png", "jpeg", "webp"],
+        default="png",
+        help="Encoding of the screenshots captured by the browser",
+    )
+    parser.add_argument(
+        "--screenshot_quality",
+        type=int,
+        default=None,
+        help="Compression quality [0-100] for jpeg and webp screenshots",
+    )
+    parser.add_argument(
+        "--screenshot_scale",
+        type=float,
+        default=1.0,
+        help="Downscale factor applied to the screenshots",
+    )
     parser.add_argument("--sleep_after_execution", type=float, default=0.0)
+    parser.add_argument(
+        "--incremental_observation",
+        action="store_true",
+        help="Reuse the previous observation when the DOM did not change, "
+        "any change rebuilds the whole tree. CSS-only changes are only seen "
+        "after actions moving the mouse",
+    )
 
     parser.add_argument("--max_steps", type=int, default=30)
 
@@ -148,9 +272,15 @@ def config() -> argparse.Namespace:
     parser.add_argument(
         "--max_obs_length",
         type=int,
-        help="when not zero, will truncate the observation to this length before feeding to the model",
+        help="when not zero, the env fits the observation into this many tokens before feeding it to the model",
         default=1920,
     )
+    parser.add_argument(
+        "--retrieval_top_k",
+        type=int,
+        help="when set, only the elements that best match the intent and the previous action are kept in the observation, with the form controls",
+        default=None,
+    )
     parser.add_argument(
         "--model_endpoint",
         help="huggingface model endpoint",
@@ -223,6 +353,35 @@ def early_stop(
     return False, ""
 
 
+def renew_cookie(config_file: str) -> str:
+    """Log in again and return a config file with the renewed cookies"""
+    with open(config_file) as f:
+        _c = json.load(f)
+    if not _c["storage_state"]:
+        return config_file
+    cookie_file_name = os.path.basename(_c["storage_state"])
+    comb = get_site_comb_from_filepath(cookie_file_name)
+    temp_dir = tempfile.mkdtemp()
+    # subprocess to renew the cookie
+    subprocess.run(
+        [
+            "python",
+            "browser_env/auto_login.py",
+            "--auth_folder",
+            temp_dir,
+            "--site_list",
+            *comb,
+        ]
+    )
+    _c["storage_state"] = f"{temp_dir}/{cookie_file_name}"
+    assert os.path.exists(_c["storage_state"])
+    # update the config file
+    config_file = f"{temp_dir}/{os.path.basename(config_file)}"
+    with open(config_file, "w") as f:
+        json.dump(_c, f)
+    return config_file
+
+
 def test(
     args: argparse.Namespace,
     agent: Agent | PromptAgent | TeacherForcingAgent,
@@ -236,6 +395,23 @@ def test(
         "repeating_action": args.repeating_action_failure_th,
     }
 
+    asset_cache = (
+        AssetCache(
+            args.asset_cache_dir,
+            list(URL_MAPPINGS.keys()),
+            max_bytes=args.asset_cache_size_mb << 20,
+        )
+        if args.asset_cache_dir
+        else None
+    )
+    routing_profile = (
+        RoutingProfile(
+            default_routing_rules(args.observation_type),
+            asset_cache=asset_cache,
+        )
+        if args.block_resources
+        else None
+    )
     env = ScriptBrowserEnv(
         headless=not args.render,
         slow_mo=args.slow_mo,
@@ -246,10 +422,39 @@ def test(
             "height": args.viewport_height,
         },
         save_trace_enabled=args.save_trace_enabled,
+        trace_mode="full" if args.save_trace_enabled else args.trace_mode,
+        trace_sample_every=args.trace_sample_every,
+        trace_failures_only=args.trace_failures_only,
         sleep_after_execution=args.sleep_after_execution,
+        incremental_observation=args.incremental_observation,
+        max_obs_tokens=args.max_obs_length or None,
+        reduction_rules=default_reduction_rules(
+            {
+                "reddit": REDDIT,
+                "shopping_admin": SHOPPING_ADMIN,
+                "gitlab": GITLAB,
+                "map": MAP,
+            },
+            site_chrome=args.reduce_site_chrome,
+        ),
+        retrieval_top_k=args.retrieval_top_k,
+        screenshot_format=args.screenshot_format,
+        screenshot_quality=args.screenshot_quality,
+        screenshot_scale=args.screenshot_scale,
+        max_tasks_per_browser=args.max_tasks_per_browser,
+        context_pool_size=1 if args.prepare_next_context else 0,
+        settle_timeout=args.settle_timeout,
+        settle_quiet_window=args.settle_quiet_window,
+        reduced_motion=args.reduced_motion,
+        routing_profile=routing_profile,
+        asset_cache=asset_cache,
     )
 
-    for config_file in config_file_list:
+    # the cookies of the next task, renewed while the current one runs
+    cookie_renewer = ThreadPoolExecutor(max_workers=1)
+    renewed_config_files: dict[str, Future[str]] = {}
+    reset_times: list[float] = []
+    for idx, config_file in enumerate(config_file_list):
         try:
             render_helper = RenderHelper(
                 config_file, args.result_dir, args.action_set_tag
@@ -260,28 +465,13 @@ def test(
                 _c = json.load(f)
                 intent = _c["intent"]
                 task_id = _c["task_id"]
-                # automatically login
-                if _c["storage_state"]:
-                    cookie_file_name = os.path.basename(_c["storage_state"])
-                    comb = get_site_comb_from_filepath(cookie_file_name)
-                    temp_dir = tempfile.mkdtemp()
-                    # subprocess to renew the cookie
-                    subprocess.run(
-                        [
-                            "python",
-                            "browser_env/auto_login.py",
-                            "--auth_folder",
-                            temp_dir,
-                            "--site_list",
-                            *comb,
-                        ]
-                    )
-                    _c["storage_state"] = f"{temp_dir}/{cookie_file_name}"
-                    assert os.path.exists(_c["storage_state"])
-                    # update the config file
-                    config_file = f"{temp_dir}/{os.path.basename(config_file)}"
-                    with open(config_file, "w") as f:
-                        json.dump(_c, f)
+            # automatically login, the next config may be renewed already
+            reset_start = time.perf_counter()
+            renewal = renewed_config_files.pop(config_file, None)
+            if renewal is None or renewal.exception() is not None:
+                config_file = renew_cookie(config_file)
+            else:
+                config_file = renewal.result()
 
             logger.info(f"[Config file]: {config_file}")
             logger.info(f"[Intent]: {intent}")
@@ -289,12 +479,17 @@ def test(
             agent.reset(config_file)
             trajectory: Trajectory = []
             obs, info = env.reset(options={"config_file": config_file})
-            obs["text"] = obs["text"].replace(
-                "The information in this tab has been changed. This tab contains invalid data. Please resolve this before saving. Loading... ",
-                "",
-            )
             state_info: StateInfo = {"observation": obs, "info": info}
             trajectory.append(state_info)
+            reset_times.append(time.perf_counter() - reset_start)
+            logger.info(f"[Reset] {reset_times[-1]:.2f}s")
+
+            next_renewal: Future[str] | None = None
+            if args.prepare_next_context and idx + 1 < len(config_file_list):
+                next_renewal = cookie_renewer.submit(
+                    renew_cookie, config_file_list[idx + 1]
+                )
+                renewed_config_files[config_file_list[idx + 1]] = next_renewal
 
             meta_data = {"action_history": ["None"]}
             while True:
@@ -343,13 +538,17 @@ def test(
                     break
 
                 obs, _, terminated, _, info = env.step(action)
-                obs["text"] = obs["text"].replace(
-                    "The information in this tab has been changed. This tab contains invalid data. Please resolve this before saving. Loading... ",
-                    "",
-                )
                 state_info = {"observation": obs, "info": info}
                 trajectory.append(state_info)
 
+                if next_renewal is not None and next_renewal.done():
+                    # the next start pages load while this episode runs
+                    try:
+                        env.prepare(Path(next_renewal.result()))
+                    except Exception as e:
+                        logger.info(f"[Prepare Error] {repr(e)}")
+                    next_renewal = None
+
                 if terminated:
                     # add a action place holder
                     trajectory.append(create_stop_action(""))
@@ -370,8 +569,10 @@ def test(
             else:
                 logger.info(f"[Result] (FAIL) {config_file}")
 
-            if args.save_trace_enabled:
-                env.save_trace(Path(args.result_dir) / "traces" / f"{task_id}.zip")
+            env.save_trace(
+                Path(args.result_dir) / "traces" / f"{task_id}.zip",
+                failed=score != 1,
+            )
 
         except openai.error.OpenAIError as e:
             logger.info(f"[OpenAI Error] {repr(e)}")
@@ -385,9 +586,40 @@ def test(
                 f.write(f"[Unhandled Error] {repr(e)}\n")
                 f.write(traceback.format_exc())  # write stack trace to file
 
+            try:
+                env.save_trace(
+                    Path(args.result_dir) / "traces" / f"{task_id}.zip",
+                    failed=True,
+                )
+            except Exception as e:
+                logger.info(f"[Trace Error] {repr(e)}")
+
         render_helper.close()
 
     env.close()
+    cookie_renewer.shutdown()
+    if reset_times:
+        logger.info(
+            f"[Reset] {sum(reset_times) / len(reset_times):.2f}s on average "
+            "from the start of a task to its first observation"
+        )
+    if env.trace_recorder.mode != "off":
+        logger.info(f"[Tracing] {env.trace_recorder}")
+    if env.routing_profile is not None:
+        logger.info(f"[Routing] {env.routing_profile.stats}")
+    if env.asset_cache is not None:
+        logger.info(f"[Asset cache] {env.asset_cache.stats}")
+    if env.settle_detector is not None:
+        logger.info(
+            f"[Settle] {env.settle_detector.num_timeouts}/"
+            f"{env.settle_detector.num_waits} waits hit the "
+            f"{env.settle_detector.timeout}s timeout before the page settled"
+        )
+    text_processor = env.observation_handler.text_processor
+    if text_processor.incremental:
+        logger.info(f"[Observation latency] {text_processor.latency}")
+    if text_processor.reduction_rules:
+        logger.info(f"[Reduction] {text_processor.reduction_stats}")
     logger.info(f"Average score: {sum(scores) / len(scores)}")
 
 
@@ -435,7 +667,6 @@ def dump_config(args: argparse.Namespace) -> None:
 
 if __name__ == "__main__":
     args = config()
-    args.sleep_after_execution = 2.0
     prepare(args)
 
     test_file_list = []
@@ -451,8 +682,6 @@ if __name__ == "__main__":
     else:
         print(f"Total {len(test_file_list)} tasks left")
         args.render = False
-        args.render_screenshot = True
-        args.save_trace_enabled = True
 
         args.current_viewport_only = True
         dump_config(args)
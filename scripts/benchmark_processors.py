@@ -0,0 +1,395 @@
+"""Benchmark the observation processing on recorded or synthetic trees.
+
+Trees are recorded as the json dump of the `nodes` returned by
+`Accessibility.getFullAXTree`, with the `union_bound` of every node filled
+in (e.g. by `TextObervationProcessor.fetch_page_accessibility_tree`).
+Without recorded trees, wide synthetic trees resembling product grids and
+order tables are generated.
+
+The `observation` benchmark runs a sequence of id-based actions in a live
+browser and reports the per-step observation latency of each mode.
+
+The `reset` benchmark reports the reset-to-first-observation latency of a
+sequence of tasks when relaunching the browser for every task, when reusing
+it, and when the context of the next task is prepared during the episode.
+
+The `routing` benchmark resets each task with and without the default
+routing rules, and reports the requests and bytes transferred and whether
+the text observations are the same.
+
+The `tracing` benchmark runs a sequence of id-based actions in each trace
+mode and reports the per-step latency and the size of the saved trace.
+"""
+import argparse
+import copy
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from playwright.sync_api import BrowserContext, Request
+
+from browser_env import (
+    RoutingProfile,
+    ScriptBrowserEnv,
+    create_id_based_action,
+    default_routing_rules,
+)
+from browser_env.processors import TextObervationProcessor
+from browser_env.utils import AccessibilityTree, AccessibilityTreeNode
+
+
+def legacy_prune(
+    accessibility_tree: AccessibilityTree, keep: list[bool]
+) -> AccessibilityTree:
+    """The per-node list surgery that prune_accessibility_tree replaced"""
+    nodeid_to_cursor = {
+        node["nodeId"]: cursor
+        for cursor, node in enumerate(accessibility_tree)
+    }
+
+    def remove_node_in_graph(node: AccessibilityTreeNode) -> None:
+        nodeid = node["nodeId"]
+        node_cursor = nodeid_to_cursor[nodeid]
+        parent_nodeid = node["parentId"]
+        children_nodeids = node["childIds"]
+        parent_cursor = nodeid_to_cursor[parent_nodeid]
+        index = accessibility_tree[parent_cursor]["childIds"].index(nodeid)
+        accessibility_tree[parent_cursor]["childIds"].pop(index)
+        for child_nodeid in children_nodeids:
+            accessibility_tree[parent_cursor]["childIds"].insert(
+                index, child_nodeid
+            )
+            index += 1
+        for child_nodeid in children_nodeids:
+            child_cursor = nodeid_to_cursor[child_nodeid]
+            accessibility_tree[child_cursor]["parentId"] = parent_nodeid
+        accessibility_tree[node_cursor]["parentId"] = "[REMOVED]"
+
+    for node, keep_node in zip(accessibility_tree, keep):
+        if not keep_node:
+            remove_node_in_graph(node)
+    return [
+        node
+        for node in accessibility_tree
+        if node.get("parentId", "Root") != "[REMOVED]"
+    ]
+
+
+def synthetic_tree(num_nodes: int, width: int) -> AccessibilityTree:
+    """A root with `width` wide lists, each item wrapping a link"""
+    tree: list[dict[str, Any]] = [
+        {"nodeId": "0", "role": {"value": "RootWebArea"}, "childIds": []}
+    ]
+    while len(tree) < num_nodes:
+        list_id = str(len(tree))
+        tree[0]["childIds"].append(list_id)
+        tree.append(
+            {
+                "nodeId": list_id,
+                "parentId": "0",
+                "role": {"value": "list"},
+                "childIds": [],
+            }
+        )
+        for _ in range(width):
+            item_id, link_id = str(len(tree)), str(len(tree) + 1)
+            tree[int(list_id)]["childIds"].append(item_id)
+            tree.append(
+                {
+                    "nodeId": item_id,
+                    "parentId": list_id,
+                    "role": {"value": "listitem"},
+                    "childIds": [link_id],
+                }
+            )
+            tree.append(
+                {
+                    "nodeId": link_id,
+                    "parentId": item_id,
+                    "role": {"value": "link"},
+                    "childIds": [],
+                }
+            )
+    return tree  # type: ignore[return-value]
+
+
+def timeit(
+    prune: Callable[[AccessibilityTree, list[bool]], AccessibilityTree],
+    tree: AccessibilityTree,
+    keep: list[bool],
+    repeat: int,
+) -> tuple[float, AccessibilityTree]:
+    best = float("inf")
+    for _ in range(repeat):
+        _tree = copy.deepcopy(tree)
+        start = time.perf_counter()
+        pruned = prune(_tree, keep)
+        best = min(best, time.perf_counter() - start)
+    return best, pruned
+
+
+def benchmark_prune(args: argparse.Namespace) -> None:
+    trees: list[tuple[str, AccessibilityTree]] = []
+    for tree_file in args.tree_files:
+        with open(tree_file, "r") as f:
+            tree = json.load(f)
+        trees.append((tree_file, tree.get("nodes", tree)))
+    if not trees:
+        for num_nodes in [10_000, 25_000, 50_000]:
+            trees.append(
+                (
+                    f"synthetic-{num_nodes}",
+                    synthetic_tree(num_nodes, args.width),
+                )
+            )
+
+    rng = random.Random(0)
+    for name, tree in trees:
+        # keep the root and a random subset, like a viewport filter on
+        # a long page where most nodes are below the fold
+        keep = [
+            idx == 0 or rng.random() < args.keep_ratio
+            for idx in range(len(tree))
+        ]
+        legacy_time, legacy = timeit(legacy_prune, tree, keep, args.repeat)
+        new_time, pruned = timeit(
+            TextObervationProcessor.prune_accessibility_tree,
+            tree,
+            keep,
+            args.repeat,
+        )
+        assert [n["childIds"] for n in legacy] == [
+            n["childIds"] for n in pruned
+        ]
+        print(
+            f"{name}: {len(tree)} nodes, legacy {legacy_time * 1000:.1f}ms, "
+            f"single pass {new_time * 1000:.1f}ms"
+        )
+
+
+def benchmark_observation(args: argparse.Namespace) -> None:
+    if args.action_file:
+        with open(args.action_file, "r") as f:
+            action_strs = [line.strip() for line in f if line.strip()]
+    else:
+        action_strs = [
+            "scroll [down]",
+            "press [Shift]",
+            "scroll [down]",
+            "scroll [up]",
+            "press [Shift]",
+        ]
+
+    for incremental in [False, True]:
+        env = ScriptBrowserEnv(
+            observation_type="accessibility_tree",
+            current_viewport_only=args.current_viewport_only,
+            incremental_observation=incremental,
+        )
+        timings: list[float] = []
+        get_obs = env._get_obs
+
+        def timed_get_obs() -> Any:
+            start = time.perf_counter()
+            obs = get_obs()
+            obs["text"]
+            timings.append(time.perf_counter() - start)
+            return obs
+
+        env._get_obs = timed_get_obs  # type: ignore[method-assign]
+        options = {"config_file": args.config_file}
+        env.reset(options=options if args.config_file else None)
+        for action_str in action_strs:
+            env.step(create_id_based_action(action_str))
+        env.close()
+
+        steps = " ".join(f"{t * 1000:.0f}" for t in timings)
+        print(
+            f"incremental={incremental}: per-step latency (ms) {steps}, "
+            f"mean {sum(timings) / len(timings) * 1000:.1f}ms"
+        )
+
+
+def benchmark_reset(args: argparse.Namespace) -> None:
+    modes = {
+        "relaunch": dict(max_tasks_per_browser=1, context_pool_size=0),
+        "persistent": dict(context_pool_size=0),
+        "prepared": dict(context_pool_size=1),
+    }
+    for mode, kwargs in modes.items():
+        env = ScriptBrowserEnv(
+            observation_type="accessibility_tree",
+            current_viewport_only=True,
+            **kwargs,  # type: ignore[arg-type]
+        )
+        timings: list[float] = []
+        for idx, config_file in enumerate(args.config_files):
+            start = time.perf_counter()
+            obs, _ = env.reset(options={"config_file": config_file})
+            obs["text"]
+            timings.append(time.perf_counter() - start)
+            if mode == "prepared" and idx + 1 < len(args.config_files):
+                env.prepare(Path(args.config_files[idx + 1]))
+            # the episode the next reset overlaps with
+            time.sleep(args.episode_time)
+        env.close()
+
+        resets = " ".join(f"{t * 1000:.0f}" for t in timings)
+        print(
+            f"{mode}: reset-to-observation latency (ms) {resets}, "
+            f"mean {sum(timings) / len(timings) * 1000:.1f}ms"
+        )
+
+
+def benchmark_routing(args: argparse.Namespace) -> None:
+    observations: dict[str, list[str]] = {}
+    for mode in ["none", "blocked"]:
+        routing_profile = (
+            RoutingProfile(default_routing_rules(args.observation_type))
+            if mode == "blocked"
+            else None
+        )
+        env = ScriptBrowserEnv(
+            observation_type=args.observation_type,
+            current_viewport_only=True,
+            routing_profile=routing_profile,
+        )
+        transferred = {"requests": 0, "bytes": 0}
+
+        def on_request_finished(request: Request) -> None:
+            sizes = request.sizes()
+            transferred["requests"] += 1
+            transferred["bytes"] += (
+                sizes["responseHeadersSize"] + sizes["responseBodySize"]
+            )
+
+        def count_transferred(context: BrowserContext) -> None:
+            context.on("requestfinished", on_request_finished)
+
+        env.context_hooks.append(count_transferred)
+        observations[mode] = []
+        start = time.perf_counter()
+        for config_file in args.config_files:
+            obs, _ = env.reset(options={"config_file": config_file})
+            observations[mode].append(str(obs["text"]))
+        elapsed = time.perf_counter() - start
+        env.close()
+
+        print(
+            f"{mode}: {transferred['requests']} requests, "
+            f"{transferred['bytes'] / 1024:.0f}KiB transferred, "
+            f"{elapsed / len(args.config_files) * 1000:.0f}ms per reset"
+        )
+        if routing_profile is not None:
+            print(f"{mode}: {routing_profile.stats}")
+
+    num_same = sum(
+        none == blocked
+        for none, blocked in zip(observations["none"], observations["blocked"])
+    )
+    print(f"same text observation: {num_same}/{len(args.config_files)}")
+
+
+def benchmark_tracing(args: argparse.Namespace) -> None:
+    with open(args.action_file) as f:
+        action_strs = [line.strip() for line in f if line.strip()]
+    with tempfile.TemporaryDirectory() as trace_dir:
+        for mode in ["off", "light", "full"]:
+            env = ScriptBrowserEnv(
+                observation_type="accessibility_tree",
+                current_viewport_only=True,
+                trace_mode=mode,
+            )
+            env.reset(
+                options={"config_file": args.config_file}
+                if args.config_file
+                else None
+            )
+            timings = []
+            for action_str in action_strs:
+                start = time.perf_counter()
+                obs, _, _, _, _ = env.step(create_id_based_action(action_str))
+                obs["text"]
+                timings.append(time.perf_counter() - start)
+            trace_path = Path(trace_dir) / f"{mode}.zip"
+            # the light trace only snapshots the DOM of failed tasks
+            env.save_trace(trace_path, failed=True)
+            env.close()
+
+            trace_size = (
+                trace_path.stat().st_size if trace_path.exists() else 0
+            )
+            print(
+                f"{mode}: mean step latency "
+                f"{sum(timings) / len(timings) * 1000:.1f}ms, "
+                f"trace {trace_size / 1024:.0f}KiB"
+            )
+
+
+def config() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    prune_parser = subparsers.add_parser(
+        "prune", help="subtree pruning of the viewport filter"
+    )
+    prune_parser.add_argument("tree_files", nargs="*", default=[])
+    prune_parser.add_argument("--keep_ratio", type=float, default=0.1)
+    prune_parser.add_argument("--width", type=int, default=2000)
+    prune_parser.add_argument("--repeat", type=int, default=3)
+    prune_parser.set_defaults(func=benchmark_prune)
+
+    observation_parser = subparsers.add_parser(
+        "observation", help="per-step observation latency in a browser"
+    )
+    observation_parser.add_argument("--config_file", type=str, default="")
+    observation_parser.add_argument(
+        "--action_file",
+        type=str,
+        default="",
+        help="id-based actions to execute, one per line",
+    )
+    observation_parser.add_argument(
+        "--current_viewport_only", action="store_true"
+    )
+    observation_parser.set_defaults(func=benchmark_observation)
+
+    reset_parser = subparsers.add_parser(
+        "reset", help="reset-to-first-observation latency in a browser"
+    )
+    reset_parser.add_argument("config_files", nargs="+")
+    reset_parser.add_argument(
+        "--episode_time",
+        type=float,
+        default=5.0,
+        help="seconds spent in each episode before the next reset",
+    )
+    reset_parser.set_defaults(func=benchmark_reset)
+
+    routing_parser = subparsers.add_parser(
+        "routing", help="requests and bytes avoided by the routing rules"
+    )
+    routing_parser.add_argument("config_files", nargs="+")
+    routing_parser.add_argument(
+        "--observation_type",
+        choices=["accessibility_tree", "html"],
+        default="accessibility_tree",
+    )
+    routing_parser.set_defaults(func=benchmark_routing)
+
+    tracing_parser = subparsers.add_parser(
+        "tracing", help="per-step cost of the trace modes in a browser"
+    )
+    tracing_parser.add_argument("action_file", type=str)
+    tracing_parser.add_argument("--config_file", type=str, default="")
+    tracing_parser.set_defaults(func=benchmark_tracing)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = config()
+    args.func(args)
@@ -0,0 +1,142 @@
+from pathlib import Path
+from typing import Any, cast
+
+from playwright.sync_api import Route
+
+from browser_env.asset_cache import AssetCache
+from browser_env.routing import RoutingProfile, default_routing_rules
+
+SITE_URL = "http://localhost:7770"
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, status: int = 200) -> None:
+        self.status = status
+        self.headers = {
+            "content-type": "application/javascript",
+            "content-encoding": "gzip",
+        }
+        self._body = body
+
+    def body(self) -> bytes:
+        return self._body
+
+
+class FakeRequest:
+    def __init__(self, url: str, resource_type: str = "script") -> None:
+        self.url = url
+        self.resource_type = resource_type
+        self.method = "GET"
+
+
+class FakeRoute:
+    """Records how the request was handled, fetch serves the body"""
+
+    def __init__(self, request: FakeRequest, body: bytes = b"") -> None:
+        self.request = request
+        self.response = FakeResponse(body)
+        self.fetched = False
+        self.fell_back = False
+        self.aborted = False
+        self.fulfilled: dict[str, Any] = {}
+
+    def fetch(self) -> FakeResponse:
+        self.fetched = True
+        return self.response
+
+    def fallback(self) -> None:
+        self.fell_back = True
+
+    def fulfill(self, **kwargs: Any) -> None:
+        self.fulfilled = kwargs
+
+    def abort(self, error_code: str) -> None:
+        self.aborted = True
+
+
+def handle(cache: AssetCache, route: FakeRoute) -> FakeRoute:
+    cache.handle(cast(Route, route))
+    return route
+
+
+def test_asset_cache_serves_stored_assets(tmp_path: Path) -> None:
+    url = f"{SITE_URL}/static/bundle.js"
+    cache = AssetCache(tmp_path, [SITE_URL])
+    route = handle(cache, FakeRoute(FakeRequest(url), b"console.log(1)"))
+    assert route.fetched
+    assert cache.stats.misses == 1 and cache.stats.stored == 1
+
+    # another env, e.g. in another worker, shares the directory
+    other_cache = AssetCache(tmp_path, [SITE_URL])
+    route = handle(other_cache, FakeRoute(FakeRequest(url)))
+    assert not route.fetched
+    assert route.fulfilled["body"] == b"console.log(1)"
+    assert route.fulfilled["status"] == 200
+    # the body is stored decoded
+    assert "content-encoding" not in route.fulfilled["headers"]
+    assert other_cache.stats.hits == 1
+    assert other_cache.stats.hit_rate == 1.0
+
+
+def test_asset_cache_skips_other_requests(tmp_path: Path) -> None:
+    cache = AssetCache(tmp_path, [SITE_URL])
+    for request in [
+        FakeRequest(f"{SITE_URL}/checkout", resource_type="document"),
+        FakeRequest(f"{SITE_URL}/rest/cart", resource_type="xhr"),
+        FakeRequest("http://example.com/bundle.js"),
+    ]:
+        assert handle(cache, FakeRoute(request)).fell_back
+    assert cache.stats.hits == cache.stats.misses == 0
+
+
+def test_asset_cache_evicts_least_recently_used(tmp_path: Path) -> None:
+    cache = AssetCache(tmp_path, [SITE_URL], max_bytes=250)
+    for name in ["a", "b"]:
+        handle(
+            cache,
+            FakeRoute(
+                FakeRequest(f"{SITE_URL}/{name}.js"), name.encode() * 100
+            ),
+        )
+    # a is used again, so b is the least recently used
+    handle(cache, FakeRoute(FakeRequest(f"{SITE_URL}/a.js")))
+    handle(cache, FakeRoute(FakeRequest(f"{SITE_URL}/c.js"), b"c" * 100))
+    assert cache.stats.evicted == 1
+    assert cache.size <= 250
+    assert not handle(
+        cache, FakeRoute(FakeRequest(f"{SITE_URL}/a.js"))
+    ).fetched
+    assert handle(cache, FakeRoute(FakeRequest(f"{SITE_URL}/b.js"))).fetched
+
+
+def test_routing_counts_the_blocked_bytes_in_the_cache(
+    tmp_path: Path,
+) -> None:
+    cache = AssetCache(tmp_path, [SITE_URL])
+    logo_url = f"{SITE_URL}/logo.png"
+    handle(cache, FakeRoute(FakeRequest(logo_url, "image"), b"x" * 2048))
+    assert cache.get_size(logo_url) == 2048
+
+    profile = RoutingProfile(
+        default_routing_rules("accessibility_tree"), asset_cache=cache
+    )
+    for url in [logo_url, f"{SITE_URL}/banner.png"]:
+        route = FakeRoute(FakeRequest(url, "image"))
+        profile.handle(cast(Route, route))
+        assert route.aborted
+    assert profile.stats.blocked_requests["image"] == 2
+    # the banner was never stored, its size is unknown
+    assert profile.stats.blocked_bytes == 2048
+    assert profile.stats.sized_requests == 1
+    assert "2KiB avoided" in str(profile.stats)
+
+
+def test_routing_without_cache_reports_requests_only() -> None:
+    profile = RoutingProfile(default_routing_rules("accessibility_tree"))
+    route = FakeRoute(FakeRequest(f"{SITE_URL}/logo.png", "image"))
+    profile.handle(cast(Route, route))
+    assert route.aborted
+    assert str(profile.stats) == (
+        "blocked 1/1 requests (image: 1), "
+        "the size of none is known"
+    )
@@ -0,0 +1,835 @@
+import asyncio
+import base64
+import copy
+import io
+from typing import Any, cast
+
+import numpy as np
+import pytest
+from PIL import Image
+from playwright.sync_api import CDPSession, Page, ViewportSize
+
+from browser_env.actions import create_id_based_action, get_action_query
+from browser_env.async_processors import AsyncObservationHandler
+from browser_env.intent_retrieval import retrieve_relevant_lines
+from browser_env.node_table import NodeTable
+from browser_env.processors import (
+    DOM_CHANGE_TRACKER_JS,
+    PAGE_PROBE_JS,
+    ImageObservationProcessor,
+    ObservationHandler,
+    ReductionRule,
+    ReductionStats,
+    TextObervationProcessor,
+)
+from browser_env.spatial_index import SpatialIndex
+from browser_env.token_budget import (
+    OBS_ESTIMATE_MARGIN,
+    estimate_tokens,
+    fit_to_token_budget,
+)
+from browser_env.utils import BrowserConfig, BrowserInfo, Screenshot
+
+VIEWPORT: ViewportSize = {"width": 1280, "height": 720}
+
+STRINGS = [
+    "#document",  # 0
+    "HTML",  # 1
+    "BODY",  # 2
+    "BUTTON",  # 3
+    "#text",  # 4
+    "Submit",  # 5
+    "A",  # 6
+    "href",  # 7
+    "/far",  # 8
+    "Far away",  # 9
+    "DIV",  # 10
+    "class",  # 11
+    "hidden  menu",  # 12
+]
+
+SNAPSHOT: dict[str, Any] = {
+    "strings": STRINGS,
+    "documents": [
+        {
+            "scrollOffsetX": 0,
+            "scrollOffsetY": 0,
+            "nodes": {
+                "parentIndex": [-1, 0, 1, 2, 3, 2, 5, 2],
+                "nodeType": [9, 1, 1, 1, 3, 1, 3, 1],
+                "nodeName": [0, 1, 2, 3, 4, 6, 4, 10],
+                "nodeValue": [-1, -1, -1, -1, 5, -1, 9, -1],
+                "backendNodeId": [1, 2, 3, 4, 5, 6, 7, 8],
+                "attributes": [[], [], [], [], [], [7, 8], [], [11, 12]],
+            },
+            "layout": {
+                "nodeIndex": [0, 1, 2, 3, 4, 5, 6],
+                "bounds": [
+                    [0, 0, 1280, 3000],
+                    [0, 0, 1280, 3000],
+                    [8, 8, 1264, 2984],
+                    [8, 8, 100, 30],
+                    [12, 12, 60, 20],
+                    [8, 2000, 100, 20],
+                    [8, 2000, 80, 20],
+                ],
+            },
+        }
+    ],
+}
+
+AX_TREE: list[dict[str, Any]] = [
+    {
+        "nodeId": "1",
+        "ignored": False,
+        "role": {"value": "RootWebArea"},
+        "name": {"value": "Test page"},
+        "childIds": ["2"],
+        "backendDOMNodeId": 1,
+    },
+    {
+        "nodeId": "2",
+        "ignored": False,
+        "role": {"value": "generic"},
+        "name": {"value": ""},
+        "parentId": "1",
+        "childIds": ["3", "5", "7"],
+        "backendDOMNodeId": 3,
+    },
+    {
+        "nodeId": "3",
+        "ignored": False,
+        "role": {"value": "button"},
+        "name": {"value": "Submit"},
+        "properties": [
+            {"name": "focusable", "value": {"value": True}},
+            {"name": "focused", "value": {"value": True}},
+        ],
+        "parentId": "2",
+        "childIds": ["4"],
+        "backendDOMNodeId": 4,
+    },
+    {
+        "nodeId": "4",
+        "ignored": False,
+        "role": {"value": "StaticText"},
+        "name": {"value": "Submit"},
+        "parentId": "3",
+        "childIds": [],
+        "backendDOMNodeId": 5,
+    },
+    {
+        "nodeId": "5",
+        "ignored": False,
+        "role": {"value": "link"},
+        "name": {"value": "Far away"},
+        "parentId": "2",
+        "childIds": ["6"],
+        "backendDOMNodeId": 6,
+    },
+    {
+        "nodeId": "6",
+        "ignored": False,
+        "role": {"value": "StaticText"},
+        "name": {"value": "Far away"},
+        "parentId": "5",
+        "childIds": [],
+        "backendDOMNodeId": 7,
+    },
+    {
+        "nodeId": "7",
+        "ignored": False,
+        "role": {"value": "menu"},
+        "name": {"value": "Hidden menu"},
+        "parentId": "2",
+        "childIds": [],
+        "backendDOMNodeId": 8,
+    },
+]
+
+
+class FakeCDPSession:
+    """Answer the CDP commands used by the text processor from canned data"""
+
+    def __init__(self, target_id: str = "") -> None:
+        self.calls: list[str] = []
+        self.params: list[Any] = []
+        self.target_id = target_id
+        self.snapshot = SNAPSHOT
+        # answered to Target.getTargets
+        self.targets: list[dict[str, str]] = []
+
+    def send(self, method: str, params: Any = None) -> dict[str, Any]:
+        self.calls.append(method)
+        self.params.append(params)
+        if method == "Page.captureScreenshot":
+            image = Image.new("RGB", (4, 2), (255, 0, 0))
+            byte_io = io.BytesIO()
+            image.save(byte_io, format=params["format"].upper())
+            return {"data": base64.b64encode(byte_io.getvalue()).decode()}
+        if method == "Target.getTargets":
+            return {"targetInfos": self.targets}
+        if method == "Target.getTargetInfo":
+            return {"targetInfo": {"targetId": self.target_id}}
+        if method == "Accessibility.getFullAXTree":
+            return {"nodes": copy.deepcopy(AX_TREE)}
+        if method == "DOMSnapshot.captureSnapshot":
+            return copy.deepcopy(self.snapshot)
+        if method == "DOM.resolveNode":
+            return {"object": {"objectId": "obj"}}
+        if method == "Runtime.callFunctionOn":
+            return {
+                "result": {
+                    "value": {"x": 0.0, "y": 0.0, "width": 0.0, "height": 0.0}
+                }
+            }
+        raise ValueError(f"Unexpected CDP command {method}")
+
+
+class FakeContext:
+    def __init__(self) -> None:
+        self.pages: list[FakePage] = []
+
+
+class FakePage:
+    """Answer the page evaluations used by the text processor"""
+
+    def __init__(self, context: FakeContext | None = None) -> None:
+        self.url = "http://example.com/"
+        self.viewport_size = VIEWPORT
+        self.context = context or FakeContext()
+        self.context.pages.append(self)
+        self.scroll_y = 0.0
+        # version of the DOM change tracker, None when not installed
+        self.dom_version: int | None = None
+        self.num_evaluations = 0
+
+    def title(self) -> str:
+        return "Test page"
+
+    def evaluate(self, expression: str, arg: Any = None) -> Any:
+        self.num_evaluations += 1
+        if expression == PAGE_PROBE_JS:
+            return [
+                0.0,
+                self.scroll_y,
+                VIEWPORT["width"],
+                VIEWPORT["height"],
+                1.0,
+                self.title(),
+                self.evaluate(DOM_CHANGE_TRACKER_JS) if arg else None,
+            ]
+        if expression == DOM_CHANGE_TRACKER_JS:
+            if self.dom_version is None:
+                self.dom_version = 0
+                return [-1, 0.0, self.scroll_y, 0.0]
+            return [self.dom_version, 0.0, self.scroll_y, 1000.0]
+        if expression == "[window.pageXOffset, window.pageYOffset]":
+            return [0.0, self.scroll_y]
+        return {
+            "window.pageXOffset": 0.0,
+            "window.pageYOffset": self.scroll_y,
+            "window.screen.width": VIEWPORT["width"],
+            "window.screen.height": VIEWPORT["height"],
+            "window.devicePixelRatio": 1.0,
+        }[expression]
+
+    def wait_for_load_state(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def screenshot(self) -> bytes:
+        raise AssertionError("No screenshot should be taken")
+
+
+class AsyncFakeCDPSession:
+    def __init__(self) -> None:
+        self.session = FakeCDPSession()
+
+    async def send(self, method: str, params: Any = None) -> dict[str, Any]:
+        await asyncio.sleep(0)
+        return self.session.send(method, params)
+
+
+class AsyncFakeContext:
+    def __init__(self) -> None:
+        self.pages: list[AsyncFakePage] = []
+
+
+class AsyncFakePage:
+    def __init__(self) -> None:
+        self.page = FakePage()
+        self.url = self.page.url
+        self.viewport_size = self.page.viewport_size
+        self.context = AsyncFakeContext()
+        self.context.pages.append(self)
+
+    async def title(self) -> str:
+        return self.page.title()
+
+    async def evaluate(self, expression: str, arg: Any = None) -> Any:
+        await asyncio.sleep(0)
+        return self.page.evaluate(expression, arg)
+
+
+def make_browser_info(scroll_y: float = 0.0) -> BrowserInfo:
+    config: BrowserConfig = {
+        "win_top_bound": scroll_y,
+        "win_left_bound": 0.0,
+        "win_width": VIEWPORT["width"],
+        "win_height": VIEWPORT["height"],
+        "win_right_bound": VIEWPORT["width"],
+        "win_lower_bound": scroll_y + VIEWPORT["height"],
+        "device_pixel_ratio": 1.0,
+    }
+    return {"DOMTree": copy.deepcopy(SNAPSHOT), "config": config}
+
+
+def make_processor(
+    observation_type: str = "accessibility_tree",
+    current_viewport_only: bool = False,
+) -> TextObervationProcessor:
+    return TextObervationProcessor(
+        observation_type, current_viewport_only, VIEWPORT
+    )
+
+
+def test_accessibility_tree_bounds_from_snapshot() -> None:
+    processor = make_processor()
+    client = FakeCDPSession()
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(),
+        cast(CDPSession, client),
+        current_viewport_only=False,
+    )
+    bounds = {node["nodeId"]: node["union_bound"] for node in tree}
+    assert bounds["3"] == [8, 8, 100, 30]
+    assert bounds["5"] == [8, 2000, 100, 20]
+    # only the node without a layout entry falls back to a JS call
+    assert client.calls.count("DOM.resolveNode") == 1
+    assert client.calls.count("Runtime.callFunctionOn") == 1
+
+
+def test_accessibility_tree_bounds_are_viewport_relative() -> None:
+    processor = make_processor()
+    client = FakeCDPSession()
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(scroll_y=1900),
+        cast(CDPSession, client),
+        current_viewport_only=False,
+    )
+    bounds = {node["nodeId"]: node["union_bound"] for node in tree}
+    assert bounds["5"] == [8, 100, 100, 20]
+
+
+def test_html_tree_from_snapshot() -> None:
+    processor = make_processor("html")
+    client = FakeCDPSession()
+    dom_tree = processor.fetch_page_html(
+        make_browser_info(),
+        cast(Page, None),
+        cast(CDPSession, client),
+        current_viewport_only=False,
+    )
+    # no per-node CDP round trips in the html mode
+    assert client.calls == []
+    content, obs_nodes_info = processor.parse_html(dom_tree)
+    assert content == (
+        "[4] <#text> Submit\n"
+        '[5] <A href="/far"> \n'
+        "\t[6] <#text> Far away\n"
+        '[7] <DIV class="hidden menu"> \n'
+    )
+    assert obs_nodes_info["5"]["union_bound"] == [8.0, 2000.0, 100.0, 20.0]
+    assert obs_nodes_info["7"]["union_bound"] is None
+
+
+def test_html_tree_current_viewport() -> None:
+    processor = make_processor("html", current_viewport_only=True)
+    dom_tree = processor.fetch_page_html(
+        make_browser_info(),
+        cast(Page, None),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=True,
+    )
+    content, _ = processor.parse_html(dom_tree)
+    # <html> and <body> are mostly below the fold
+    assert content == "[2] <#text> Submit\n"
+    # the kept nodes are re-attached to their closest kept ancestor
+    assert [node["nodeName"] for node in dom_tree] == [
+        "#document",
+        "BUTTON",
+        "#text",
+    ]
+    assert dom_tree[0]["childIds"] == ["3"]
+    assert dom_tree[1]["parentId"] == "0"
+
+
+def test_element_in_viewport_ratio() -> None:
+    bounds = np.array(
+        [
+            [0, 0, 100, 100],  # fully visible
+            [0, 620, 100, 200],  # half visible
+            [0, 800, 100, 100],  # below the viewport
+            [10, 10, 0, 50],  # empty
+            [np.nan] * 4,  # no layout
+        ],
+        dtype=np.float64,
+    )
+    config = make_browser_info()["config"]
+    ratio = TextObervationProcessor.get_element_in_viewport_ratio(
+        bounds, config
+    )
+    assert np.allclose(ratio, [1.0, 0.5, 0.0, 0.0, 0.0])
+    mask = TextObervationProcessor.get_in_viewport_mask(bounds, config)
+    assert mask.tolist() == [True, False, False, False, False]
+
+
+def test_accessibility_tree_current_viewport() -> None:
+    processor = make_processor(current_viewport_only=True)
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=True,
+    )
+    assert [node["nodeId"] for node in tree] == ["1", "3", "4"]
+    assert tree[0]["childIds"] == ["3"]
+    assert tree[1]["parentId"] == "1"
+
+
+def test_parse_accessibility_tree() -> None:
+    processor = make_processor()
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=False,
+    )
+    content, obs_nodes_info = processor.parse_accessibility_tree(tree)
+    assert content == (
+        "[1] RootWebArea 'Test page'\n"
+        "\t[3] button 'Submit' focused: True\n"
+        "\t\t[4] StaticText 'Submit'\n"
+        "\t[5] link 'Far away'\n"
+        "\t\t[6] StaticText 'Far away'\n"
+        "\t[7] menu 'Hidden menu'"
+    )
+    # the empty generic node is skipped
+    assert "2" not in obs_nodes_info
+    assert obs_nodes_info["3"]["text"] == "[3] button 'Submit' focused: True"
+
+
+def test_node_table_keeps_the_tree() -> None:
+    processor = make_processor()
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=False,
+    )
+    tree[-1]["union_bound"] = None
+    _, obs_nodes_info = processor.parse_accessibility_tree(tree)
+    assert isinstance(obs_nodes_info, NodeTable)
+    assert list(obs_nodes_info) == ["1", "3", "4", "5", "6", "7"]
+    assert obs_nodes_info["5"] == {
+        "backend_id": 6,
+        "union_bound": [8.0, 2000.0, 100.0, 20.0],
+        "text": "[5] link 'Far away'",
+    }
+    assert obs_nodes_info["7"]["union_bound"] is None
+    assert obs_nodes_info.get_role("5") == "link"
+    assert obs_nodes_info.get_parent("4") == "3"
+    # the parent of the skipped generic node
+    assert obs_nodes_info.get_parent("3") == "1"
+    assert obs_nodes_info.get_parent("1") is None
+    assert obs_nodes_info.get_children("1") == ["3", "5", "7"]
+    assert obs_nodes_info.get_children("3") == ["4"]
+    assert obs_nodes_info.get_children("7") == []
+
+    # the html nodes keep their backend ids as strings
+    dom_tree = processor.fetch_page_html(
+        make_browser_info(),
+        cast(Page, FakePage()),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=False,
+    )
+    _, html_nodes_info = processor.parse_html(dom_tree)
+    assert len(html_nodes_info) > 0
+    assert all(
+        isinstance(node_info["backend_id"], str)
+        for node_info in html_nodes_info.values()
+    )
+
+
+def test_reduction_rules() -> None:
+    processor = make_processor()
+    # the Magento notice is stripped by default
+    assert [rule.name for rule in processor.reduction_rules] == [
+        "magento_notice"
+    ]
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=False,
+    )
+    processor.reduction_rules = [
+        ReductionRule("submit", "collapse", role="button"),
+        ReductionRule("far", "strip", name_pattern="^Far "),
+        ReductionRule("menu", "summarize", role="menu", summary="menu"),
+        ReductionRule(
+            "other_site", "drop", url_pattern="^http://other", role="link"
+        ),
+    ]
+    rules = processor.get_page_rules("http://localhost/page")
+    assert [rule.name for rule in rules] == ["submit", "far", "menu"]
+    stats = ReductionStats()
+    content, obs_nodes_info = processor.parse_accessibility_tree(
+        tree, rules, stats
+    )
+    assert content == (
+        "[1] RootWebArea 'Test page'\n"
+        "\t[3] button 'Submit' focused: True [collapsed]\n"
+        "\t[5] link 'away'\n"
+        "\t\t[6] StaticText 'away'\n"
+        "\t[menu]"
+    )
+    assert list(obs_nodes_info) == ["1", "3", "5", "6"]
+    assert stats.reduced_nodes == {"submit": 2, "far": 2, "menu": 1}
+    assert stats.tokens_saved["menu"] > 0
+
+
+def test_parse_deep_accessibility_tree() -> None:
+    depth = 5000
+    tree: list[dict[str, Any]] = [
+        {
+            "nodeId": str(idx),
+            "role": {"value": "group"},
+            "name": {"value": f"level {idx}"},
+            "childIds": [str(idx + 1)] if idx + 1 < depth else [],
+            "backendDOMNodeId": idx,
+            "union_bound": None,
+        }
+        for idx in range(depth)
+    ]
+    content, obs_nodes_info = TextObervationProcessor.parse_accessibility_tree(
+        tree  # type: ignore[arg-type]
+    )
+    assert len(obs_nodes_info) == depth
+    assert content.split("\n")[-1] == "\t" * (depth - 1) + (
+        f"[{depth - 1}] group 'level {depth - 1}'"
+    )
+
+
+def test_token_estimate_counts_digits_and_bytes() -> None:
+    # one token per digit as for Llama, and per byte of non-ASCII text
+    assert estimate_tokens("Order #000000187") == 12
+    assert estimate_tokens("café") == 3
+
+
+def test_token_budget_keeps_interactive_nodes() -> None:
+    lines = ["[1] RootWebArea 'Shop'", "\t[2] list ''"]
+    for idx in range(3, 63, 2):
+        lines.append(f"\t\t[{idx}] listitem ''")
+        lines.append(f"\t\t\t[{idx + 1}] link 'Product {idx}'")
+    lines.append("\t[70] StaticText '" + "Lorem ipsum " * 50 + "'")
+    lines.append("\t[71] button 'Add to Cart'")
+    lines.append("\t[72] textbox 'Search' focused: True")
+    content = "\n".join(lines)
+    assert fit_to_token_budget(content, 2000) == content
+
+    fitted = fit_to_token_budget(content, 150)
+    assert estimate_tokens(fitted) <= 150
+    assert fitted.split("\n") == [
+        "[1] RootWebArea 'Shop'",
+        "\t[2] list ''",
+        "\t\t[3] listitem ''",
+        "\t\t\t[4] link 'Product 3'",
+        "\t\t[5] listitem ''",
+        "\t\t\t[6] link 'Product 5'",
+        "\t\t[7] listitem ''",
+        "\t\t\t[8] link 'Product 7'",
+        # the rest of the list fills the budget left after the long text
+        "\t\t[9] listitem ''",
+        "\t\t\t[10] link 'Product 9'",
+        "\t\t[... 53 lines elided]",
+        "\t[71] button 'Add to Cart'",
+        "\t[72] textbox 'Search' focused: True",
+    ]
+
+
+def test_processor_fits_within_estimate_margin() -> None:
+    processor = make_processor()
+    processor.max_obs_tokens = 60
+    tree = processor.fetch_page_accessibility_tree(
+        make_browser_info(),
+        cast(CDPSession, FakeCDPSession()),
+        current_viewport_only=False,
+    )
+    content = processor.serialize_tree(make_browser_info(), tree)
+    # the prompt constructors do not tokenize the fitted observation again
+    assert estimate_tokens(content) <= 60 * OBS_ESTIMATE_MARGIN
+    assert "[3] button 'Submit' focused: True" in content
+
+
+def test_retrieval_keeps_relevant_nodes() -> None:
+    lines = ["[1] RootWebArea 'Dashboard'", "\t[2] navigation 'Menu'"]
+    lines += [f"\t\t[{idx}] link 'Report {idx}'" for idx in range(3, 40)]
+    lines += [
+        "\t\t[40] link 'Orders'",
+        "\t[41] main ''",
+        "\t\t[42] searchbox 'Search by keyword'",
+        "\t\t[43] StaticText 'Total 2022 orders'",
+    ]
+    content = "\n".join(lines)
+    assert retrieve_relevant_lines(
+        content, "How many orders were placed in 2022?", top_k=5
+    ) == (
+        "[1] RootWebArea 'Dashboard'\n"
+        "\t[2] navigation 'Menu'\n"
+        "\t\t[... 37 lines elided]\n"
+        "\t\t[40] link 'Orders'\n"
+        "\t[41] main ''\n"
+        "\t\t[42] searchbox 'Search by keyword'\n"
+        "\t\t[43] StaticText 'Total 2022 orders'"
+    )
+    # nothing to match, e.g. before the intent is known
+    assert retrieve_relevant_lines(content, "", top_k=5) == content
+
+    action = create_id_based_action("click [40]")
+    obs_nodes_info = {"40": {"text": "[40] link 'Orders'"}}
+    assert get_action_query(action, obs_nodes_info) == "'Orders'"
+    processor = make_processor()
+    processor.retrieval_top_k = 5
+    processor.cached_page_state = ("page",)
+    processor.set_retrieval_query("Show the orders")
+    assert processor.retrieval_query == "Show the orders"
+    # the cached observation was retrieved for another query
+    assert processor.cached_page_state is None
+
+
+def test_spatial_index_queries() -> None:
+    obs_nodes_info: dict[str, Any] = {
+        "1": {"union_bound": [0, 0, 1280, 3000]},
+        "2": {"union_bound": [10, 10, 300, 40]},
+        "3": {"union_bound": [20, 15, 50, 20]},
+        "4": {"union_bound": [500, 600, 100, 20]},
+        "5": {"union_bound": None},
+        "6": {"union_bound": [-50, -20, 30, 30]},
+    }
+    index = SpatialIndex(obs_nodes_info, VIEWPORT)
+    # the innermost element first
+    assert index.query_point(30, 20) == ["3", "2", "1"]
+    assert index.query_point(200, 20) == ["2", "1"]
+    assert index.query_point(-40, -10) == ["6"]
+    assert index.query_point(5000, 5000) == []
+    # in document order
+    assert index.query_rect(0, 0, 600, 700) == ["1", "2", "3", "4"]
+    assert index.query_rect(400, 500, 150, 150) == ["1", "4"]
+    assert index.get_element_at(550 / 1280, 610 / 720) == "4"
+
+
+def test_element_at_mouse_coordinates() -> None:
+    processor = make_processor()
+    processor.process(
+        cast(Page, FakePage()), cast(CDPSession, FakeCDPSession())
+    )
+    # the text of the submit button
+    assert processor.get_element_at(30 / 1280, 20 / 720) == "4"
+    assert processor.get_element_at(100 / 1280, 30 / 720) == "3"
+    assert processor.get_element_at(1200 / 1280, 700 / 720) is None
+
+
+def test_incremental_observation_reuses_unchanged_page() -> None:
+    processor = TextObervationProcessor(
+        "accessibility_tree", False, VIEWPORT, incremental=True
+    )
+    page, client = FakePage(), FakeCDPSession()
+    first = processor.process(cast(Page, page), cast(CDPSession, client))
+    num_calls = len(client.calls)
+
+    # nothing changed in the page
+    assert processor.process(cast(Page, page), cast(CDPSession, client)) == (
+        first
+    )
+    assert len(client.calls) == num_calls
+
+    # a DOM mutation invalidates the cached observation
+    assert page.dom_version is not None
+    page.dom_version += 1
+    processor.process(cast(Page, page), cast(CDPSession, client))
+    assert len(client.calls) > num_calls
+    num_calls = len(client.calls)
+
+    # so does scrolling
+    page.scroll_y = 100.0
+    processor.process(cast(Page, page), cast(CDPSession, client))
+    assert len(client.calls) > num_calls
+    num_calls = len(client.calls)
+
+    # and a hover, whose :hover styles are not DOM mutations
+    processor.invalidate_cache()
+    processor.process(cast(Page, page), cast(CDPSession, client))
+    assert len(client.calls) > num_calls
+    assert processor.latency.counts == {"rebuilt": 4, "reused": 1}
+
+
+@pytest.mark.parametrize("observation_type", ["accessibility_tree", "html"])
+def test_scroll_reslices_the_cached_page(observation_type: str) -> None:
+    processor = TextObervationProcessor(
+        observation_type, True, VIEWPORT, incremental=True
+    )
+    page, client = FakePage(), FakeCDPSession()
+    first = processor.process(cast(Page, page), cast(CDPSession, client))
+    assert "Far away" not in first
+    num_calls = len(client.calls)
+
+    # only scrolled, no CDP command
+    page.scroll_y = 1900.0
+    content = processor.process(cast(Page, page), cast(CDPSession, client))
+    assert len(client.calls) == num_calls
+    # the same as fetching the page at this scroll offset
+    fetched = TextObervationProcessor(
+        observation_type, True, VIEWPORT
+    ).process(cast(Page, page), cast(CDPSession, FakeCDPSession()))
+    assert content == fetched
+    assert "Far away" in content
+
+    # a DOM mutation needs a fetch
+    assert page.dom_version is not None
+    page.dom_version += 1
+    processor.process(cast(Page, page), cast(CDPSession, client))
+    assert len(client.calls) > num_calls
+
+
+def test_reslice_keeps_fixed_nodes_in_the_viewport() -> None:
+    snapshot = copy.deepcopy(SNAPSHOT)
+    snapshot["strings"] = STRINGS + ["static", "fixed"]
+    # the button is fixed, like a page header
+    snapshot["documents"][0]["layout"]["styles"] = [
+        [13],
+        [13],
+        [13],
+        [14],
+        [13],
+        [13],
+        [13],
+    ]
+    processor = TextObervationProcessor(
+        "accessibility_tree", True, VIEWPORT, incremental=True
+    )
+    page, client = FakePage(), FakeCDPSession()
+    client.snapshot = snapshot
+    processor.process(cast(Page, page), cast(CDPSession, client))
+    assert client.params[0]["computedStyles"] == ["position"]
+
+    page.scroll_y = 1900.0
+    content = processor.process(cast(Page, page), cast(CDPSession, client))
+    assert "button 'Submit'" in content
+    assert "link 'Far away'" in content
+    # the button did not move, the link scrolled into the viewport
+    assert processor.obs_nodes_info["3"]["union_bound"] == [8, 8, 100, 30]
+    assert processor.obs_nodes_info["5"]["union_bound"] == [8, 100, 100, 20]
+
+
+def test_observation_probes_the_page_once() -> None:
+    context = FakeContext()
+    page, other_tab = FakePage(context), FakePage(context)
+    other_tab.client = FakeCDPSession(target_id="other")  # type: ignore
+    client = FakeCDPSession()
+    client.targets = [
+        {
+            "targetId": "other",
+            "type": "page",
+            "title": "Other page",
+            "url": "http://example.com/other",
+        }
+    ]
+    content = make_processor().process(
+        cast(Page, page), cast(CDPSession, client)
+    )
+    assert content.startswith(
+        "Tab 0 (current): Test page | Tab 1: Other page\n\n"
+    )
+    # the geometry and the title in one evaluation, the other titles in
+    # one CDP command
+    assert page.num_evaluations == 1
+    assert other_tab.num_evaluations == 0
+    assert client.calls.count("Target.getTargets") == 1
+
+
+def test_observation_modalities_are_captured_lazily() -> None:
+    handler = ObservationHandler(
+        "text", "accessibility_tree", "", False, VIEWPORT
+    )
+    page, client = FakePage(), FakeCDPSession()
+    obs = handler.get_observation(cast(Page, page), cast(CDPSession, client))
+    assert client.calls == []
+    assert "text" in obs and "image" in obs
+
+    text = obs["text"]
+    assert isinstance(text, str) and "button 'Submit'" in text
+    num_calls = len(client.calls)
+    assert obs.get("text") == text
+    assert len(client.calls) == num_calls
+
+    # the screenshot is never taken, and can't be once the page moved on
+    obs.expire()
+    with pytest.raises(RuntimeError):
+        obs["image"]
+    assert obs["text"] == text
+
+
+def test_screenshot_is_kept_encoded() -> None:
+    processor = ImageObservationProcessor(
+        "image", screenshot_format="jpeg", screenshot_quality=50
+    )
+    page, client = FakePage(), FakeCDPSession()
+    screenshot = processor.capture(cast(Page, page), cast(CDPSession, client))
+    assert client.params[-1] == {"format": "jpeg", "quality": 50}
+    assert screenshot.format == "jpeg"
+    assert screenshot.data.startswith(b"\xff\xd8")
+    assert screenshot.to_numpy().shape == (2, 4, 3)
+
+
+def test_screenshot_downscale_clips_the_viewport() -> None:
+    handler = ObservationHandler(
+        "image", "", "image", False, VIEWPORT, screenshot_scale=0.5
+    )
+    assert handler.get_observation_space()["image"].shape == (360, 640, 3)
+    page, client = FakePage(), FakeCDPSession()
+    page.scroll_y = 100.0
+    obs = handler.get_observation(cast(Page, page), cast(CDPSession, client))
+    assert isinstance(obs["screenshot"], Screenshot)
+    assert client.params[-1]["clip"] == {
+        "x": 0.0,
+        "y": 100.0,
+        "width": VIEWPORT["width"],
+        "height": VIEWPORT["height"],
+        "scale": 0.5,
+    }
+    # the array is decoded from the kept screenshot
+    image = obs["image"]
+    assert isinstance(image, np.ndarray)
+    assert client.calls == ["Page.captureScreenshot"]
+
+
+@pytest.mark.parametrize("observation_type", ["accessibility_tree", "html"])
+def test_async_observation_matches_sync(observation_type: str) -> None:
+    handler = ObservationHandler("text", observation_type, "", True, VIEWPORT)
+    obs = handler.get_observation(
+        cast(Page, FakePage()), cast(CDPSession, FakeCDPSession())
+    )
+
+    async_handler = AsyncObservationHandler(
+        "text", observation_type, "", True, VIEWPORT
+    )
+    async_obs = asyncio.run(
+        async_handler.aget_observation(
+            AsyncFakePage(),  # type: ignore[arg-type]
+            AsyncFakeCDPSession(),  # type: ignore[arg-type]
+        )
+    )
+    assert async_obs["text"] == obs["text"]
+    assert isinstance(async_obs["screenshot"], Screenshot)
+    assert async_obs["image"].shape == (2, 4, 3)  # type: ignore[union-attr]
+    assert (
+        async_handler.get_observation_metadata()["text"]
+        == handler.get_observation_metadata()["text"]
+    )
@@ -2,6 +2,8 @@ import asyncio
 import collections
 import json
 import tempfile
+import zipfile
+from pathlib import Path
 from typing import Callable, Dict, Optional, Tuple, Type, Union, cast
 
 import pytest
@@ -11,13 +13,18 @@ from playwright.sync_api import Page
 from browser_env import (
     Action,
     AsyncScriptBrowserEnv,
+    BatchScriptBrowserEnv,
     DetachedPage,
+    EnvCheckpoint,
+    RoutingProfile,
     ScriptBrowserEnv,
     create_focus_and_click_action,
+    create_go_back_action,
     create_goto_url_action,
     create_keyboard_type_action,
     create_playwright_action,
     create_scroll_action,
+    default_routing_rules,
 )
 from browser_env.actions import create_id_based_action
 from browser_env.env_config import (
@@ -51,12 +58,190 @@ def test_script_browser_env(script_browser_env: ScriptBrowserEnv) -> None:
     assert info["page"].url == "https://www.rfc-editor.org/rfc/rfc2606.html"
 
 
+def test_browser_is_reused_across_resets() -> None:
+    env = ScriptBrowserEnv(max_tasks_per_browser=2)
+    env.reset()
+    browser, context = env.browser, env.context
+    env.reset()
+    assert env.browser is browser
+    assert env.context is not context
+    # restarted after serving max_tasks_per_browser tasks
+    env.reset()
+    assert env.browser is not browser
+    assert env.browser is not None and env.browser.is_connected()
+    env.close()
+    assert env.browser is None
+
+
+def test_reset_takes_prepared_context() -> None:
+    env = ScriptBrowserEnv(context_pool_size=1)
+    env.reset()
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".json") as f:
+        json.dump(
+            {"storage_state": None, "start_url": "http://www.example.com"}, f
+        )
+        f.flush()
+        env.prepare(Path(f.name))
+        assert len(env.context_pool) == 1
+        env.reset(options={"config_file": f.name})
+    assert len(env.context_pool) == 0
+    assert env.page.url == "http://www.example.com/"
+    assert env.page.evaluate("document.readyState") == "complete"
+    env.close()
+
+
+def test_step_waits_for_page_to_settle() -> None:
+    env = ScriptBrowserEnv(
+        settle_timeout=5.0, settle_quiet_window=0.2, reduced_motion=True
+    )
+    _, info = env.reset()
+    assert 0 <= info["settle_time"] <= 5.0
+    _, _, _, _, info = env.step(
+        create_goto_url_action("http://www.example.com")
+    )
+    # the page was quiet for the window before returning
+    assert 0.2 <= info["settle_time"] <= 5.0
+    assert env.settle_detector is not None
+    assert env.settle_detector.is_dom_quiet(env.page)
+    env.close()
+
+
+def test_routing_profile_blocks_images() -> None:
+    routing_profile = RoutingProfile(
+        default_routing_rules("accessibility_tree")
+    )
+    env = ScriptBrowserEnv(
+        observation_type="accessibility_tree",
+        routing_profile=routing_profile,
+    )
+    env.reset()
+    env.page.set_content(
+        '<img src="http://www.example.com/logo.png" alt="logo">'
+        '<a href="http://www.example.com">link</a>'
+    )
+    env.page.wait_for_load_state("load")
+    assert routing_profile.stats.blocked_requests["image"] == 1
+    assert routing_profile.stats.blocked_by_rule["media"] == 1
+    # the document is never blocked
+    _, _, _, _, info = env.step(
+        create_goto_url_action("http://www.example.com")
+    )
+    assert "example.com" in info["page"].url
+    assert "Example Domain" in info["page"].content
+    env.close()
+
+
+def test_light_trace_snapshots_failed_steps(tmp_path: Path) -> None:
+    env = ScriptBrowserEnv(
+        observation_type="accessibility_tree",
+        trace_mode="light",
+        trace_failures_only=True,
+    )
+    env.reset()
+    env.step(create_goto_url_action("http://www.example.com"))
+    # no element has this id
+    _, success, _, _, _ = env.step(create_id_based_action("click [10000]"))
+    assert not success
+    assert not env.save_trace(tmp_path / "passed.zip", failed=False)
+
+    env.reset()
+    env.step(create_id_based_action("click [10000]"))
+    assert env.save_trace(tmp_path / "failed.zip", failed=True)
+    with zipfile.ZipFile(tmp_path / "failed.zip") as f:
+        steps = json.loads(f.read("actions.json"))
+        assert len(steps) == 1 and not steps[0]["success"]
+        assert steps[0]["snapshot"] in f.namelist()
+        assert steps[0]["trace_time"] > 0
+        assert "final.html" in f.namelist()
+    assert env.trace_recorder.num_steps == 3
+    assert env.trace_recorder.trace_time > 0
+    env.close()
+
+
+def test_checkpoint_restores_tabs(tmp_path: Path) -> None:
+    env = ScriptBrowserEnv(observation_type="accessibility_tree")
+    env.reset()
+    # as read from the config file of a task
+    env.intent = "Find the reserved domain names"
+    env.step(create_goto_url_action("http://www.example.com"))
+    env.step(
+        create_goto_url_action("https://www.rfc-editor.org/rfc/rfc2606.html")
+    )
+    env.page.evaluate("sessionStorage.setItem('draft', 'hello')")
+    env.step(create_scroll_action("down"))
+    checkpoint = env.checkpoint()
+    assert checkpoint.step_index == 3
+    assert "example.com" in checkpoint.tabs[0].history[-1]
+    checkpoint.save(tmp_path / "checkpoint.json")
+
+    # branch the episode in another env
+    branch = ScriptBrowserEnv(observation_type="accessibility_tree")
+    obs, info = branch.restore(
+        EnvCheckpoint.load(tmp_path / "checkpoint.json"),
+        restore_history=True,
+    )
+    assert "rfc2606" in info["page"].url
+    assert "RFC 2606" in obs["text"]
+    assert branch.num_steps == 3
+    assert branch.intent == env.intent
+    assert branch.observation_handler.text_processor.retrieval_query == (
+        env.observation_handler.text_processor.retrieval_query
+    )
+    assert branch.page.evaluate("sessionStorage.getItem('draft')") == "hello"
+    assert branch.page.evaluate("window.pageYOffset") > 0
+    _, _, _, _, info = branch.step(create_go_back_action())
+    assert "example.com" in info["page"].url
+    branch.close()
+    env.close()
+
+
+def test_checkpoint_captures_popups() -> None:
+    env = ScriptBrowserEnv(observation_type="accessibility_tree")
+    env.reset()
+    env.step(create_goto_url_action("http://www.example.com"))
+    assert env.context is not None
+    # opened by the site, without the CDP session of the env
+    with env.context.expect_page() as popup_info:
+        env.page.evaluate("window.open('http://www.example.com/')")
+    popup_info.value.wait_for_load_state()
+    checkpoint = env.checkpoint()
+    assert len(checkpoint.tabs) == 2
+    assert "example.com" in checkpoint.tabs[1].url
+    env.close()
+
+
+def test_batch_script_browser_env() -> None:
+    env = BatchScriptBrowserEnv(2, observation_type="accessibility_tree")
+    results = env.reset_batch([None, None])
+    assert len(results) == 2
+    assert env.envs[0].browser is env.envs[1].browser
+    assert env.envs[0].context is not env.envs[1].context
+
+    msgs = env.step_batch(
+        [
+            create_goto_url_action("http://www.example.com"),
+            create_goto_url_action(
+                "https://www.rfc-editor.org/rfc/rfc2606.html"
+            ),
+        ]
+    )
+    assert msgs[0] is not None and msgs[1] is not None
+    assert "example.com" in msgs[0][4]["page"].url
+    assert "RFC 2606" in msgs[1][0]["text"]
+
+    # only the first episode moves on
+    msgs = env.step_batch([create_scroll_action("down"), None])
+    assert msgs[0] is not None and msgs[1] is None
+    env.close()
+
+
 @pytest.mark.asyncio
 async def test_async_script_browser_env(
     async_script_browser_env: AsyncScriptBrowserEnv,
 ) -> None:
     env = async_script_browser_env
-    await env.areset()
+    _, info = await env.areset()
+    assert info["page"].content.startswith("<html")
     await env.astep(
         create_goto_url_action("http://www.example.com"),
     )
@@ -76,6 +261,40 @@ async def test_async_script_browser_env(
     assert info["page"].url == "https://www.rfc-editor.org/rfc/rfc2606.html"
 
 
+def test_async_step_waits_for_page_to_settle() -> None:
+    env = AsyncScriptBrowserEnv(settle_timeout=5.0, settle_quiet_window=0.2)
+    env.reset()
+    _, _, _, _, info = env.step(
+        create_goto_url_action("http://www.example.com")
+    )
+    # the page was quiet for the window before the observation
+    assert 0.2 <= info["settle_time"] <= 5.0
+    assert "Example Domain" in info["page"].content
+    env.close()
+
+
+def test_async_script_browser_env_id_based_actions() -> None:
+    env = AsyncScriptBrowserEnv(
+        observation_type="accessibility_tree", capture_screenshot=False
+    )
+    obs, info = env.reset()
+    obs, *_ = env.step(create_goto_url_action("http://www.example.com"))
+    assert "screenshot" not in obs
+    assert isinstance(obs["text"], str)
+    link_id = obs["text"].split("] link 'More")[0].split("[")[-1]
+    _, success, _, _, info = env.step(
+        create_id_based_action(f"click [{link_id}]")
+    )
+    assert success
+    assert "iana.org" in info["page"].url
+    assert info["observation_metadata"]["text"]["obs_nodes_info"]
+    # the sync methods run on the same long-lived event loop
+    loop = env.loop
+    env.step(create_id_based_action("scroll [down]"))
+    assert env.loop is loop
+    env.close()
+
+
 def collate_actions(actions: list[Action]) -> dict[str, list[object]]:
     action_dict = collections.defaultdict(list)
     for action in actions: